@@ -186,6 +186,59 @@ class PropertyFlags:
     # : Property being set should be handled as a value
     VALUE = 8
     
+class InheritedProperties(collections.MutableMapping):
+    '''
+    Properties of a map instance: the vars it overrides, falling through to its type's properties
+    for everything else.  Iterates in the same order a full copy of the type's properties would.
+    
+    :param base collections.Mapping:
+        The type's properties.  Never written to.
+    '''
+    def __init__(self, base, overrides=None, deleted=None):
+        self.base = base
+        self.overrides = overrides if overrides is not None else collections.OrderedDict()
+        self.deleted = deleted
+        
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        if self.deleted and key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+    
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+        if self.deleted:
+            self.deleted.discard(key)
+        
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overrides.pop(key, None)
+        if key in self.base:
+            if self.deleted is None:
+                self.deleted = set()
+            self.deleted.add(key)
+            
+    def __contains__(self, key):
+        if key in self.overrides:
+            return True
+        return key in self.base and not (self.deleted and key in self.deleted)
+    
+    def __iter__(self):
+        for key in self.base:
+            if not (self.deleted and key in self.deleted):
+                yield key
+        for key in self.overrides:
+            if key not in self.base:
+                yield key
+                
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def copy(self):
+        return InheritedProperties(self.base, self.overrides.copy(), set(self.deleted) if self.deleted else None)
+    
 class Atom:
     '''
     An atom is, in simple terms, what BYOND considers a class.
@@ -244,6 +297,7 @@ class Atom:
         #    raise Exception('God damnit')
         
         self._hash = None
+        self._identity = None
         
         # : Coords
         self.coords = None
@@ -256,7 +310,7 @@ class Atom:
             self.locations.remove(coord)
         if autoclean and len(self.locations) == 0:
             map.instances[self.ID] = None  # Mark ready for recovery
-            map._instance_idmap.pop(self.GetHash(), None)
+            map._instance_idmap.pop(self.GetIdentity(), None)
     
     def addLocation(self, coord):
         self.locations.append(coord)
@@ -266,16 +320,26 @@ class Atom:
             self._hash = hashlib.md5(str(self)).hexdigest()
 
     def UpdateMap(self, map):
-        self.UpdateHash()
         map.UpdateAtom(self)
         
     def InvalidateHash(self):
         self._hash = None
+        self._identity = None
         
     def GetHash(self):
         self.UpdateHash()
         return self._hash
     
+    def GetIdentity(self):
+        '''
+        What tells this atom apart from others on a map: (path, ((var, value), ...)) over the map-specified
+        vars.  Cheaper than :meth:`GetHash`, and what :class:`byond.map.Map` dedups instances by.
+        '''
+        if self._identity is None:
+            props = self.properties
+            self._identity = (self.path, tuple((key, str(props[key])) for key in self.mapSpecified if key in props))
+        return self._identity
+    
     def copy(self, toNewMap=False):
         '''
         Make a copy of this atom, without dangling references.
@@ -284,14 +348,26 @@ class Atom:
         '''
         new_node = Atom(self.path, self.filename, self.line, missing=self.missing)
         new_node.properties = self.properties.copy()
-        new_node.mapSpecified = self.mapSpecified
+        new_node.mapSpecified = list(self.mapSpecified)
         if not toNewMap:
             new_node.ID = self.ID
             new_node.old_id = self.old_id
-        new_node.UpdateHash()
+        new_node._hash = self._hash
+        new_node._identity = self._identity
         # new_node.parent = self.parent
         return new_node
     
+    def Instantiate(self):
+        '''
+        Make a map instance of this type.  Its properties are an :class:`InheritedProperties`, so only
+        the vars changed on the instance take up memory.
+        
+        :returns byond.basetypes.Atom
+        '''
+        new_node = Atom(self.path, self.filename, self.line, missing=self.missing)
+        new_node.properties = InheritedProperties(self.properties)
+        return new_node
+    
     def getProperty(self, index, default=None):
         '''
         Get the value of the specified property.
@@ -357,7 +433,7 @@ class Atom:
         else:
             self.properties[index] = BYONDValue(value)
         
-        self.UpdateHash()
+        self.InvalidateHash()
 
     def InheritProperties(self):
         if self.ob_inherited: return
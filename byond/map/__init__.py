@@ -22,8 +22,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 
 """
-import os, itertools, sys, numpy, logging, hashlib
-from byond.map.format import GetMapFormat, Load as LoadMapFormats
+import os, itertools, sys, numpy, logging, hashlib, collections, operator, weakref
+from byond.map.format import GetMapFormat, MapFormat, Load as LoadMapFormats
+from byond.map.format.dmm import TokenizeTileChunk, ClipBBox
+from byond.utils import md5sum, splitCompression, clock, getElapsed
 from byond.DMI import DMI
 from byond.directions import SOUTH, IMAGE_INDICES
 from byond.basetypes import Atom, BYONDString, BYONDValue, BYONDFileRef, BYOND2RGBA
@@ -135,6 +137,8 @@ class Tile(object):
         self.coords = (0, 0, 0)
         self.origID = ''
         self.ID = -1
+        self._raw = None
+        self._loader = None
         self.instances = []
         self.locations = []
         self.frame = None
@@ -143,13 +147,63 @@ class Tile(object):
         self.log = logging.getLogger(__name__ + '.Tile')
         self.map = _map
         self._hash = None
+        self._identity = None
         self.orig_hash = None
         
+    @property
+    def instances(self):
+        '''Instance IDs of the atoms on this tile.  Parses lazily loaded tiles on first access.'''
+        if self._raw is not None:
+            self.Materialize()
+        return self._instances
+    
+    @instances.setter
+    def instances(self, value):
+        self._raw = None
+        self._loader = None
+        self._instances = value
+        self._hash = None
+        self._identity = None
+        
+    def SetLazy(self, raw, loader):
+        '''
+        Defer parsing this tile's atoms until they are needed.
+        
+        :param raw str:
+            The tile's serialized atoms.
+        :param loader callable:
+            Called with *raw* on first use; returns the list of instance IDs.
+        '''
+        self._instances = []
+        self._raw = raw
+        self._loader = loader
+        self._hash = None
+        self._identity = None
+        
+    def IsMaterialized(self):
+        return self._raw is None
+    
+    def GetRaw(self):
+        '''The serialized atoms of a lazy tile that has not been parsed yet, otherwise None.'''
+        return self._raw
+    
+    def Materialize(self):
+        '''Parse the atoms of a lazily loaded tile.'''
+        if self._raw is None:
+            return
+        raw, loader = self._raw, self._loader
+        self._raw = self._loader = None
+        self._instances = loader(raw)
+        if self.master:
+            self.map._tile_idmap.setdefault(self.GetIdentity(), self.ID)
+        
     def UpdateHash(self, no_map_update=False):
-        if self._hash is None:
-            # Why MD5?  Because the shorter the string, the faster the comparison.
-            self._hash = hashlib.md5(str(self)).hexdigest()
-            if not no_map_update: 
+        if self._identity is None:
+            self.GetIdentity()
+            if self.master:
+                # Edited in place: it stays the map's tile type with this ID.
+                self.map._tile_idmap.setdefault(self._identity, self.ID)
+            elif not no_map_update: 
                 self.ID=self.map.UpdateTile(self)
                 if self.ID==-1:
                     raise Error('self.ID == -1')
@@ -158,10 +212,26 @@ class Tile(object):
         if self._hash is not None:
             self.orig_hash = self._hash
         self._hash = None
+        self._identity = None
         
     def GetHash(self):
+        '''
+        MD5 of the tile's atoms, stable between runs (patch files use it).  Use :meth:`GetIdentity` to
+        compare tiles within a map.
+        '''
         self.UpdateHash()
+        if self._hash is None:
+            self._hash = hashlib.md5(str(self)).hexdigest()
         return self._hash
+    
+    def GetIdentity(self):
+        '''
+        The tile's instance IDs as a tuple.  Tiles with the same identity are the same tile type, and
+        :class:`Map` dedups tile types by it.
+        '''
+        if self._identity is None:
+            self._identity = tuple(self.instances)
+        return self._identity
         
     def RemoveAtom(self, atom, hash=True):
         '''
@@ -169,6 +239,8 @@ class Tile(object):
             Atom to remove.  Raises ValueError if not found.
         '''
         if atom is None: return
+        if self.master:
+            self.map._EditTileType()
         self.instances.remove(atom.ID)
         self.InvalidateHash()
         if hash: self.UpdateHash()
@@ -180,6 +252,8 @@ class Tile(object):
         '''
         if atom is None: return
         atom.UpdateMap(self.map)
+        if self.master:
+            self.map._EditTileType()
         self.instances.append(atom.ID)
         self.InvalidateHash()
         if hash: self.UpdateHash()
@@ -195,14 +269,18 @@ class Tile(object):
     def copy(self, origID=False):
         tile = self.map.CreateTile()
         tile.ID = self.ID
-        tile.instances = [x for x in self.instances]
         
         if origID:
             tile.origID = self.origID
+            
+        if self._raw is not None:
+            # Stay lazy; the copy takes the atoms from us once someone looks at it.
+            tile.SetLazy(self._raw, lambda raw: [x for x in self.instances])
+            return tile
         
-        if not self._hash:
-            self.UpdateHash(no_map_update=True)
+        tile.instances = [x for x in self.instances]
         tile._hash = self._hash
+        tile._identity = self._identity
         
         return tile
     
@@ -232,7 +310,7 @@ class Tile(object):
             self.locations.remove(coord)
         if autoclean and len(self.locations) == 0:
             self.map.tiles[self.ID] = None  # Mark ready for recovery
-            self.map._tile_idmap.pop(self.GetHash(), None)
+            self.map._tile_idmap.pop(self.GetIdentity(), None)
     
     def addLocation(self, coord):
         if coord not in self.locations:
@@ -245,12 +323,12 @@ class Tile(object):
         return not self.__eq__(tile)
     
     def __eq__(self, other):
-        return other and ((other._hash and self._hash and self._hash == other._hash) or (len(self.instances) == len(other.instances) and self.instances == other.instances))
+        return other and self.GetIdentity() == other.GetIdentity()
         # else:
         #    return all(self.instances[i] == other.instances[i] for i in xrange(len(self.instances)))
     
     def _serialize(self):
-        return ','.join([str(i) for i in self.GetAtoms()])
+        return ','.join([str(self.map.instances[id]) for id in self.instances if id is not None and self.map.instances[id] is not None])
         
     def RenderToMapTile(self, passnum, basedir, renderflags, **kwargs):
         img = Image.new('RGBA', (96, 96))
@@ -379,16 +457,484 @@ class Tile(object):
         
         return img
 
-class MapLayer:
-    def __init__(self, z, _map, height=255, width=255):
+class _View(object):
+    '''
+    Copy-on-write stand-in for a map's master Tile or Atom.
+    
+    Reads go straight to the master.  The first write (setting an attribute, or calling a mutating
+    method) swaps in a private copy first, so the master and other views never see it.
+    '''
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_owned', False)
+        
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+    
+    def __setattr__(self, name, value):
+        setattr(self.Detach(), name, value)
+        
+    def _copy(self):
+        return self._target.copy()
+        
+    def Detach(self):
+        '''
+        Make this view's own copy of the master, if it has not already.
+        
+        :returns: The copy.
+        '''
+        if not self._owned:
+            object.__setattr__(self, '_target', self._copy())
+            object.__setattr__(self, '_owned', True)
+        return self._target
+    
+    def IsDetached(self):
+        return self._owned
+    
+    def __str__(self):
+        return str(self._target)
+    
+    def __eq__(self, other):
+        return self._target.__eq__(other)
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __lt__(self, other):
+        return self._target.__lt__(other)
+    
+    def __gt__(self, other):
+        return self._target.__gt__(other)
+        
+class _PropertiesView(collections.MutableMapping):
+    '''AtomView.properties: the master's properties until something writes to them.'''
+    def __init__(self, view):
+        self._view = view
+        
+    def __getitem__(self, key):
+        return self._view._target.properties[key]
+    
+    def __setitem__(self, key, value):
+        self._view.Detach().properties[key] = value
+        
+    def __delitem__(self, key):
+        del self._view.Detach().properties[key]
+        
+    def __iter__(self):
+        return iter(self._view._target.properties)
+    
+    def __len__(self):
+        return len(self._view._target.properties)
+    
+    def __contains__(self, key):
+        return key in self._view._target.properties
+    
+    def copy(self):
+        return self._view._target.properties.copy()
+
+class AtomView(_View):
+    '''
+    Read-only view of a map instance, from :meth:`Map.ViewInstance`.  See :class:`_View`.
+    
+    mapSpecified is a tuple until the view is detached.
+    '''
+    @property
+    def properties(self):
+        if self._owned:
+            return self._target.properties
+        return _PropertiesView(self)
+    
+    @property
+    def mapSpecified(self):
+        if self._owned:
+            return self._target.mapSpecified
+        return tuple(self._target.mapSpecified)
+    
+    def setProperty(self, index, value, flags=0):
+        return self.Detach().setProperty(index, value, flags)
+    
+    def InvalidateHash(self):
+        return self.Detach().InvalidateHash()
+    
+    def InheritProperties(self):
+        return self.Detach().InheritProperties()
+        
+class TileView(_View):
+    '''
+    Read-only view of a tile on the map, from :meth:`Map.ViewTileAt`.  See :class:`_View`.
+    
+    Its atoms come back as :class:`AtomView`\ s.  Don't modify instances in place; use
+    :meth:`Tile.AppendAtom`/:meth:`Tile.RemoveAtom`, or :meth:`Detach` first.
+    '''
+    def __init__(self, target, coords=(0, 0, 0)):
+        _View.__init__(self, target)
+        object.__setattr__(self, 'coords', coords)
+        
+    def _copy(self):
+        tile = self._target.copy(origID=True)
+        tile.master = False
+        tile.coords = self.coords
+        return tile
+    
+    def GetAtoms(self):
+        atoms = []
+        for id in self.instances:
+            if id is None:
+                continue
+            a = self.map.ViewInstance(id)
+            if a is None:
+                continue
+            atoms += [a]
+        return atoms
+    
+    def SortAtoms(self):
+        return sorted(self.GetAtoms(), reverse=True)
+    
+    def GetAtom(self, idx):
+        return self.map.ViewInstance(self.instances[idx])
+    
+    def AppendAtom(self, atom, hash=True):
+        return self.Detach().AppendAtom(atom, hash)
+    
+    def RemoveAtom(self, atom, hash=True):
+        return self.Detach().RemoveAtom(atom, hash)
+    
+    def InvalidateHash(self):
+        return self.Detach().InvalidateHash()
+    
+    def SetLazy(self, raw, loader):
+        return self.Detach().SetLazy(raw, loader)
+
+def TileIDType(maxid):
+    '''Smallest unsigned dtype that holds tile IDs up to *maxid*.'''
+    return numpy.min_scalar_type(max(int(maxid), 0))
+
+class ChunkedTiles(object):
+    '''
+    Sparse stand-in for a layer's tile ID array.  Every cell holds *fill*, except in the CHUNK x CHUNK
+    chunks that have been written to, so a mostly empty level only costs the chunks with something in them.
+    
+    Supports the part of :class:`numpy.ndarray` that :class:`MapLayer` and the map formats use: integer
+    and contiguous slice indexing, ravel(), tolist(), copy() and astype().  numpy.asarray() gives the
+    dense array.
+    '''
+    CHUNK = 32
+    
+    def __init__(self, shape, fill=0, dtype=numpy.uint8):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.fill = fill
+        self.ndim = 2
+        
+        #: Like ndarray.flags.writeable.
+        self.writeable = True
+        
+        #: (chunk x, chunk y) -> CHUNK x CHUNK array
+        self.chunks = {}
+        
+    @classmethod
+    def FromArray(cls, tiles, fill=None):
+        '''
+        :param tiles numpy.ndarray:
+        :param fill int:
+            Tile ID to leave out.  Defaults to the most common one.
+        '''
+        tiles = numpy.asarray(tiles)
+        if fill is None:
+            fill = int(numpy.bincount(tiles.ravel()).argmax()) if tiles.size else 0
+        out = cls(tiles.shape, fill, tiles.dtype)
+        C = cls.CHUNK
+        nx, ny = -(-tiles.shape[0] // C), -(-tiles.shape[1] // C)
+        padded = numpy.full((nx * C, ny * C), fill, dtype=tiles.dtype)
+        padded[:tiles.shape[0], :tiles.shape[1]] = tiles
+        blocks = padded.reshape(nx, C, ny, C)
+        for cx, cy in zip(*numpy.nonzero((blocks != fill).any(axis=(1, 3)))):
+            out.chunks[cx, cy] = blocks[cx, :, cy, :].copy()
+        return out
+    
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+    
+    @property
+    def nbytes(self):
+        return len(self.chunks) * self.CHUNK * self.CHUNK * self.dtype.itemsize
+    
+    @property
+    def T(self):
+        return numpy.asarray(self).T
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def _bounds(self, key):
+        if key is Ellipsis:
+            key = (slice(None), slice(None))
+        elif not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            return None
+        bounds = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    return None
+                bounds.append((start, max(start, stop), False))
+                continue
+            try:
+                i = operator.index(k)
+            except TypeError:
+                return None
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError('index {} is out of bounds for axis with size {}'.format(k, n))
+            bounds.append((i, i + 1, True))
+        return bounds
+    
+    def _overlapping(self, x0, x1, y0, y1):
+        C = self.CHUNK
+        for cx in xrange(x0 // C, -(-x1 // C)):
+            for cy in xrange(y0 // C, -(-y1 // C)):
+                ax0, ax1 = max(x0, cx * C), min(x1, cx * C + C)
+                ay0, ay1 = max(y0, cy * C), min(y1, cy * C + C)
+                yield (cx, cy), (slice(ax0 - cx * C, ax1 - cx * C), slice(ay0 - cy * C, ay1 - cy * C)), (slice(ax0 - x0, ax1 - x0), slice(ay0 - y0, ay1 - y0))
+    
+    def __getitem__(self, key):
+        bounds = self._bounds(key)
+        if bounds is None:
+            return numpy.asarray(self)[key]
+        (x0, x1, sx), (y0, y1, sy) = bounds
+        C = self.CHUNK
+        if sx and sy:
+            chunk = self.chunks.get((x0 // C, y0 // C))
+            if chunk is None:
+                return self.dtype.type(self.fill)
+            return chunk[x0 % C, y0 % C]
+        out = numpy.full((x1 - x0, y1 - y0), self.fill, dtype=self.dtype)
+        for ckey, inchunk, inout in self._overlapping(x0, x1, y0, y1):
+            chunk = self.chunks.get(ckey)
+            if chunk is not None:
+                out[inout] = chunk[inchunk]
+        if sx:
+            return out[0]
+        if sy:
+            return out[:, 0]
+        return out
+    
+    def __setitem__(self, key, value):
+        if not self.writeable:
+            raise ValueError('assignment destination is read-only')
+        bounds = self._bounds(key)
+        if bounds is None:
+            raise IndexError('ChunkedTiles only takes integer and contiguous slice indices.')
+        (x0, x1, sx), (y0, y1, sy) = bounds
+        C = self.CHUNK
+        if sx and sy:
+            chunk = self.chunks.get((x0 // C, y0 // C))
+            if chunk is None:
+                if value == self.fill:
+                    return
+                chunk = self.chunks[x0 // C, y0 // C] = numpy.full((C, C), self.fill, dtype=self.dtype)
+            chunk[x0 % C, y0 % C] = value
+            return
+        value = numpy.asarray(value)
+        if sy and not sx and value.ndim == 1:
+            value = value[:, None]
+        value = numpy.broadcast_to(value, (x1 - x0, y1 - y0))
+        for ckey, inchunk, inout in self._overlapping(x0, x1, y0, y1):
+            chunk = self.chunks.get(ckey)
+            if chunk is None:
+                if (value[inout] == self.fill).all():
+                    continue
+                chunk = self.chunks[ckey] = numpy.full((C, C), self.fill, dtype=self.dtype)
+            chunk[inchunk] = value[inout]
+    
+    def __array__(self, dtype=None):
+        out = self[:, :]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+    
+    def ravel(self):
+        return numpy.asarray(self).ravel()
+    
+    def tolist(self):
+        return numpy.asarray(self).tolist()
+    
+    def astype(self, dtype):
+        out = ChunkedTiles(self.shape, self.fill, dtype)
+        out.chunks = dict((key, chunk.astype(dtype)) for key, chunk in self.chunks.items())
+        return out
+    
+    def copy(self):
+        return self.astype(self.dtype)
+    
+    def Remap(self, lut, dtype=None):
+        '''
+        :param lut numpy.ndarray:
+            New tile ID, indexed by old tile ID.
+        :returns ChunkedTiles:
+        '''
+        lut = lut.astype(dtype or self.dtype)
+        out = ChunkedTiles(self.shape, lut[self.fill], lut.dtype)
+        out.chunks = dict((key, lut[chunk]) for key, chunk in self.chunks.items())
+        return out
+    
+class MapLayer(object):
+    def __init__(self, z, _map, height=255, width=255, tiles=None, sparse=False):
+        '''
+        :param tiles numpy.ndarray:
+            Tile IDs indexed [x, y] to adopt as-is, instead of filling the layer with the basetile.
+        :param sparse bool:
+            Store the tile IDs as a :class:`ChunkedTiles`, for big and mostly empty levels.
+        '''
         self.initial_load=False
         self.map = _map
+        self.z = z
+        
+        #: Bumped whenever the tile IDs change.  See :meth:`Touch`.
+        self.revision = 0
+        
+        # ((revision, index version), area ID array, stats), built by GetAreaIDs().
+        self._areas = None
+        
+        # ((revision, index version), stats), built by GetStats().
+        self._stats = None
+        
+        self._tiles = None
+        if tiles is not None:
+            width, height = tiles.shape
+            self.height = height
+            self.width = width
+            self.tiles = ChunkedTiles.FromArray(tiles) if sparse else tiles
+        else:
+            self.Resize(height, width, sparse)
         self.min = (0, 0)
         self.max = (height - 1, width - 1)
-        self.tiles = None
-        self.Resize(height, width)
-        self.z = z
         
+        #: (x, y, z) of this layer's first tile in the file it was loaded from.
+        self.origin = (0, 0, z)
+        
+    @property
+    def tiles(self):
+        '''
+        Tile IDs, indexed [x, y], in the smallest unsigned dtype that holds the map's tile table.  A
+        :class:`ChunkedTiles` for sparse layers.
+        '''
+        return self._tiles
+    
+    @tiles.setter
+    def tiles(self, value):
+        self._tiles = value
+        self._maxid = numpy.iinfo(value.dtype).max
+        self.revision += 1
+        
+    def Reserve(self, maxid):
+        '''Widen the dtype of :attr:`tiles`, if needed, so it holds tile IDs up to *maxid*.'''
+        if maxid > self._maxid:
+            self.tiles = self.tiles.astype(TileIDType(max(maxid, len(self.map.tiles) - 1)))
+            
+    def Remap(self, lut):
+        '''
+        Replace every tile ID with lut[ID], in one pass.
+        
+        :param lut numpy.ndarray:
+            New tile ID, indexed by old tile ID.
+        '''
+        dtype = TileIDType(max(len(self.map.tiles) - 1, lut.max() if len(lut) else 0))
+        if isinstance(self.tiles, ChunkedTiles):
+            self.SetArray(self.tiles.Remap(lut, dtype))
+        else:
+            self.SetArray(lut.astype(dtype)[self.tiles])
+            
+    def IsSparse(self):
+        return isinstance(self.tiles, ChunkedTiles)
+    
+    def SetSparse(self, sparse=True):
+        '''Switch :attr:`tiles` between a dense array and a :class:`ChunkedTiles`.'''
+        if sparse and not self.IsSparse():
+            self.tiles = ChunkedTiles.FromArray(self.tiles)
+        elif not sparse and self.IsSparse():
+            self.tiles = numpy.asarray(self.tiles)
+        
+    def Touch(self):
+        '''Call after writing to :attr:`tiles` directly, so cached data derived from it is rebuilt.'''
+        self.revision += 1
+        
+    def GetAreaIDs(self):
+        '''
+        Area ID of every tile, indexed [x, y].  See :meth:`Map.GetAreaTable`.
+        
+        :rtype numpy.ndarray:
+        '''
+        lut = self.map.GetTileAreas()
+        key = (self.revision, self.map._index_version)
+        if self._areas is None or self._areas[0] != key:
+            self._areas = (key, lut[numpy.asarray(self.tiles)], None)
+        return self._areas[1]
+    
+    def GetStats(self):
+        '''
+        Counts for :meth:`Map.Stats`, cached until the layer or the map's tile types change.
+        
+        :returns dict:
+        '''
+        key = (self.revision, self.map._index_version)
+        if self._stats is not None and self._stats[0] == key:
+            return self._stats[1]
+        tids, counts = numpy.unique(numpy.asarray(self.tiles), return_counts=True)
+        
+        # Join tile type counts to atom types through each type's paths.
+        paths = {}
+        pidx = []
+        weights = []
+        for tid, count in zip(tids.tolist(), counts.tolist()):
+            tile = self.map.tiles[tid]
+            if tile is None:
+                continue
+            for path in self.map._GetTilePaths(tile):
+                pidx.append(paths.setdefault(path, len(paths)))
+                weights.append(count)
+        atoms = numpy.bincount(numpy.array(pidx, dtype=int), weights=numpy.array(weights, dtype=int), minlength=len(paths))
+        
+        table = self.map.GetAreaTable()
+        areaCounts, _ = self.GetAreaStats()
+        stats = {
+            'cells': self.width * self.height,
+            'distinct': len(tids),
+            'tiles': dict(zip(tids.tolist(), counts.tolist())),
+            'atoms': dict((path, int(atoms[i])) for path, i in paths.items()),
+            'areas': dict((table[aid], int(areaCounts[aid])) for aid in numpy.flatnonzero(areaCounts) if aid > 0),
+        }
+        self._stats = (key, stats)
+        return stats
+    
+    def GetAreaStats(self):
+        '''
+        Tile count and bounding box of every area on this layer, from a single pass over :meth:`GetAreaIDs`.
+        
+        :returns tuple:
+            (counts, bboxes), both indexed by area ID.  bboxes rows are (x0, y0, x1, y1) with exclusive
+            ends, or all -1 for areas not on this layer.
+        '''
+        ids = self.GetAreaIDs()
+        if self._areas[2] is None:
+            n = len(self.map.GetAreaTable())
+            flat = ids.ravel()
+            counts = numpy.bincount(flat, minlength=n)
+            xs, ys = numpy.indices(ids.shape).reshape(2, -1)
+            bboxes = numpy.empty((n, 4), dtype=int)
+            bboxes[:, :2] = max(ids.shape)
+            bboxes[:, 2:] = -1
+            numpy.minimum.at(bboxes[:, 0], flat, xs)
+            numpy.minimum.at(bboxes[:, 1], flat, ys)
+            numpy.maximum.at(bboxes[:, 2], flat, xs + 1)
+            numpy.maximum.at(bboxes[:, 3], flat, ys + 1)
+            bboxes[counts == 0] = -1
+            self._areas = (self._areas[0], ids, (counts, bboxes))
+        return self._areas[2]
         
     def GetTile(self, x, y):
         # return self.tiles[y][x]
@@ -396,6 +942,13 @@ class MapLayer:
         t.coords = (x, y, self.z)
         return t
     
+    def ViewTile(self, x, y):
+        '''Like :meth:`GetTile`, but returns a :class:`TileView` instead of a copy.'''
+        t = self.map.tiles[self.tiles[x, y]]
+        if t is None:
+            return None
+        return TileView(t, (x, y, self.z))
+    
     def SetTile(self, x, y, tile):
         '''
         :param x int:
@@ -415,7 +968,7 @@ class MapLayer:
         # Set new tile.
         if not self.initial_load: 
             tile.ID=self.map.UpdateTile(tile)
-        self.tiles[x, y] = tile.ID
+        self._SetCell(x, y, tile.ID)
         #self.map.tiles[tile.ID].addLocation((x, y, self.z))
         
         
@@ -444,24 +997,160 @@ class MapLayer:
                 if t: t.rmLocation((x, y, self.z))
         '''
        
-        self.tiles[x, y] = newID
+        self._SetCell(x, y, newID)
         #self.map.tiles[newID].addLocation((x, y, self.z))
         
-    def Resize(self, height, width):
-        self.height = height
-        self.width = width
+    def _SetCell(self, x, y, tid):
+        if tid > self._maxid:
+            self.Reserve(tid)
+        self.Own()
+        if self.map.journal is not None:
+            self.map.journal.Record(self, (x, y, x + 1, y + 1), self.tiles[x, y], tid)
+        self.tiles[x, y] = tid
+        self.revision += 1
         
-        basetile = self.map.basetile;
-        if self.tiles is None:
-            self.tiles = numpy.empty((height, width), int)  # object)
-            for y in xrange(height):
-                for x in xrange(width):
-                    self.SetTile(x, y, basetile)
+    def SetRegion(self, x0, y0, x1, y1, values):
+        '''
+        Set a box of tile IDs at once.
+        
+        :param values numpy.ndarray:
+            Tile IDs indexed [x, y], or a single tile ID.
+        '''
+        self.Reserve(int(numpy.max(values)))
+        self.Own()
+        if self.map.journal is not None:
+            self.map.journal.Record(self, (x0, y0, x1, y1), numpy.array(self.tiles[x0:x1, y0:y1]), values)
+        self.tiles[x0:x1, y0:y1] = values
+        self.revision += 1
+        
+    def SetCells(self, xs, ys, values):
+        '''
+        Set scattered cells at once.
+        
+        :param xs numpy.ndarray:
+        :param ys numpy.ndarray:
+        :param values numpy.ndarray:
+            Tile ID for each cell, or a single tile ID.
+        '''
+        if len(xs) == 0:
+            return
+        x0, y0 = int(xs.min()), int(ys.min())
+        x1, y1 = int(xs.max()) + 1, int(ys.max()) + 1
+        box = numpy.array(self.tiles[x0:x1, y0:y1], dtype=numpy.int64)
+        box[xs - x0, ys - y0] = values
+        self.SetRegion(x0, y0, x1, y1, box)
+        
+    def SetArray(self, tiles):
+        '''Replace :attr:`tiles` with a new array, which may be of a different size.'''
+        if self.map.journal is not None:
+            self.map.journal.Record(self, None, (self.tiles, self.width, self.height), (tiles, tiles.shape[0], tiles.shape[1]))
+        self.width, self.height = tiles.shape
+        self.tiles = tiles
+        
+    def Own(self):
+        '''
+        Stop sharing :attr:`tiles` with a snapshot (see :meth:`Map.Snapshot`), copying it.  Call before
+        writing to :attr:`tiles` directly.
+        '''
+        if isinstance(self._tiles, ChunkedTiles):
+            if not self._tiles.writeable:
+                self._tiles = self._tiles.copy()
+        elif not self._tiles.flags.writeable:
+            self._tiles = self._tiles.copy()
+            
+    def Resize(self, height, width, sparse=None):
+        '''
+        Resize the layer, keeping the tiles that still fit and filling new space with the basetile.
+        
+        :param sparse bool:
+            Also switch to (True) or from (False) a :class:`ChunkedTiles`.
+        '''
+        fill = 0
+        if self.map.basetile is not None:
+            fill = self.map.UpdateTile(self.map.basetile)
+        old = self.tiles
+        if sparse is None:
+            sparse = isinstance(old, ChunkedTiles)
+        dtype = TileIDType(max(fill, len(self.map.tiles) - 1))
+        if old is not None:
+            dtype = numpy.promote_types(dtype, old.dtype)
+        if sparse:
+            tiles = ChunkedTiles((width, height), fill, dtype)
         else:
-            self.tiles.resize(height, width)
-                
-        # self.tiles = [[Tile(self.map) for _ in xrange(width)] for _ in xrange(height)]
+            tiles = numpy.full((width, height), fill, dtype=dtype)
+        if old is None:
+            self.height = height
+            self.width = width
+            self.tiles = tiles
+            return
+        w, h = min(width, old.shape[0]), min(height, old.shape[1])
+        tiles[:w, :h] = old[:w, :h]
+        self.SetArray(tiles)
+    
+class MapJournal(object):
+    '''
+    Undo and redo history of the edits made to a map's z-levels.  See :meth:`Map.EnableJournal`.
     
+    Tile types and instances are only ever added while the journal is kept, so an entry only has to
+    remember the tile IDs a box held before and after the edit.
+    '''
+    def __init__(self, limit=None):
+        #: Most undo steps kept, or None for no limit.
+        self.limit = limit
+        
+        # (label, entries) steps.  An entry is (layer, bbox, before, after); bbox is None when the whole
+        # array was replaced, and before/after are then (tiles, width, height).
+        self.undo = []
+        self.redo = []
+        self.pending = []
+        self.replaying = False
+        
+    def Record(self, layer, bbox, before, after):
+        if self.replaying:
+            return
+        self.pending.append((layer, bbox, before, after))
+        self.redo = []
+        
+    def Checkpoint(self, label=None):
+        '''End the current undo step.'''
+        if not self.pending:
+            return
+        self.undo.append((label, self.pending))
+        self.pending = []
+        if self.limit is not None and len(self.undo) > self.limit:
+            del self.undo[0]
+            
+    def Undo(self):
+        ''':returns bool: False if there was nothing to undo.'''
+        self.Checkpoint()
+        if not self.undo:
+            return False
+        step = self.undo.pop()
+        self._apply(reversed(step[1]), 2)
+        self.redo.append(step)
+        return True
+    
+    def Redo(self):
+        ''':returns bool: False if there was nothing to redo.'''
+        if self.pending or not self.redo:
+            return False
+        step = self.redo.pop()
+        self._apply(step[1], 3)
+        self.undo.append(step)
+        return True
+    
+    def _apply(self, entries, which):
+        self.replaying = True
+        try:
+            for entry in entries:
+                layer, bbox, value = entry[0], entry[1], entry[which]
+                if bbox is None:
+                    layer.SetArray(value[0])
+                else:
+                    layer.SetRegion(*(bbox + (value,)))
+        finally:
+            self.replaying = False
+            
 class MapRenderFlags:
     RENDER_STARS = 1
     RENDER_AREAS = 2
@@ -470,8 +1159,8 @@ class Map:
     def __init__(self, tree=None, **kwargs):
         self.zLevels = []
         
-        self._instance_idmap = {}  # md5 -> id
-        self._tile_idmap = {}  # md5 -> id
+        self._instance_idmap = {}  # Atom.GetIdentity() -> id
+        self._tile_idmap = {}  # Tile.GetIdentity() -> id
         
         self.basetile = Tile(self)
         
@@ -489,6 +1178,28 @@ class Map:
         
         self.missing_atoms = set()
         
+        #: :class:`MapJournal` of the edits made, once :meth:`EnableJournal` is called.
+        self.journal = None
+        
+        # Maps that share our tile and instance tables.  See Snapshot().
+        self._sharing = weakref.WeakSet([self])
+        
+        # Prefab map -> [(our index version, theirs), their tile ID -> ours, (their tile ID in our table,
+        # area group) -> tile ID with our area, our tile ID -> area group, area instance IDs -> area
+        # group], built by Stamp().
+        self._stamp_tables = weakref.WeakKeyDictionary()
+        
+        # Type path -> set of tile IDs, built by GetTypeIndex().
+        self._type_index = None
+        self._type_indexed = 0
+        
+        # Area ID -> path, path -> area ID and tile ID -> area ID, built by GetTileAreas().
+        # _index_version is bumped whenever tile types change in place.
+        self._area_paths = [None]
+        self._area_ids = {}
+        self._tile_areas = numpy.zeros(0, dtype=int)
+        self._index_version = 0
+        
         self.basetile.UpdateHash();
         
     def ResetTilestore(self):
@@ -496,8 +1207,412 @@ class Map:
         
         self.instances = []  # Atom
         self.tiles = []  # Tile
+        self._instance_idmap = {}
+        self._tile_idmap = {}
         self.basetile = None
+        # The new tables are ours alone.
+        self._sharing.discard(self)
+        self._sharing = weakref.WeakSet([self])
+        self._area_paths = [None]
+        self._area_ids = {}
+        self.InvalidateTypeIndex()
+        
+    def _EditTileType(self):
+        '''Call before changing the atoms of one of our tile types in place.'''
+        # Maps sharing the tables with us (see Snapshot()) keep the tile type as it was.
+        self._Unshare()
+        self.InvalidateTypeIndex()
+        
+    def InvalidateTypeIndex(self):
+        '''Call after changing the atoms of a tile type in place.  Also drops the area table.'''
+        self._type_index = None
+        self._type_indexed = 0
+        self._tile_areas = numpy.zeros(0, dtype=int)
+        self._index_version += 1
+        
+    def _GetTilePaths(self, tile):
+        raw = tile.GetRaw()
+        if raw is not None:
+            return [path.rstrip('/') for _, path, _ in TokenizeTileChunk(raw)]
+        return [self.instances[iid].path for iid in tile.instances if iid is not None and self.instances[iid] is not None]
+        
+    def GetTypeIndex(self):
+        '''
+        Type path -> set of IDs of the tile types containing it.
+        
+        Built on first use and extended as tile types are added.  Tile types that have not been parsed
+        yet are indexed from their text.
+        '''
+        if self._type_index is None:
+            self._type_index = collections.defaultdict(set)
+            self._type_indexed = 0
+        index = self._type_index
+        for tid in xrange(self._type_indexed, len(self.tiles)):
+            tile = self.tiles[tid]
+            if tile is None:
+                continue
+            for path in self._GetTilePaths(tile):
+                index[path].add(tid)
+        self._type_indexed = len(self.tiles)
+        return index
+    
+    def _GetTypeTileIDs(self, path, subtypes=True):
+        ''':returns set: IDs of the tile types holding an atom of the given type.'''
+        index = self.GetTypeIndex()
+        path = path.rstrip('/')
+        if not subtypes:
+            return index.get(path, set())
+        prefix = path + '/'
+        tids = set()
+        for key, ids in index.items():
+            if key == path or key.startswith(prefix):
+                tids.update(ids)
+        return tids
+    
+    def FindByType(self, path, subtypes=True, z=None):
+        '''
+        Find the tiles holding an atom of the given type.
+        
+        :param path str:
+            Type path, like /obj/machinery/door/airlock.
+        :param subtypes bool:
+            Match subtypes of *path* too.
+        :param z int:
+            Only search this z-level.
+        :returns numpy.ndarray:
+            (n, 3) array of (x, y, z) coordinates, in z, x, y order.
+        '''
+        tids = self._GetTypeTileIDs(path, subtypes)
+        found = []
+        if tids:
+            tids = numpy.array(sorted(tids))
+            for zi in (xrange(len(self.zLevels)) if z is None else [z]):
+                tiles = self.zLevels[zi].tiles
+                xs, ys = numpy.nonzero(numpy.in1d(tiles.ravel(), tids).reshape(tiles.shape))
+                found.append(numpy.column_stack((xs, ys, numpy.full(len(xs), zi, dtype=xs.dtype))))
+        if not found:
+            return numpy.zeros((0, 3), dtype=int)
+        return numpy.concatenate(found)
+    
+    def GetTileAreas(self):
+        '''
+        Tile ID -> area ID lookup table, extended as tile types are added.  Tiles without an /area
+        atom get area ID 0.
+        
+        :rtype numpy.ndarray:
+        '''
+        done = len(self._tile_areas)
+        if done < len(self.tiles):
+            added = numpy.zeros(len(self.tiles) - done, dtype=int)
+            for tid in xrange(done, len(self.tiles)):
+                tile = self.tiles[tid]
+                if tile is None:
+                    continue
+                for path in self._GetTilePaths(tile):
+                    if path.startswith('/area'):
+                        if path not in self._area_ids:
+                            self._area_ids[path] = len(self._area_paths)
+                            self._area_paths.append(path)
+                        added[tid - done] = self._area_ids[path]
+            self._tile_areas = numpy.concatenate((self._tile_areas, added))
+        return self._tile_areas
+    
+    def GetAreaTable(self):
+        '''
+        Area ID -> area path.  Area ID 0 is reserved for tiles without an area, and its path is None.
+        
+        :rtype list:
+        '''
+        self.GetTileAreas()
+        return self._area_paths
+    
+    def _GetAreaIDs(self, areas):
+        if isinstance(areas, basestring):
+            areas = [areas]
+        self.GetTileAreas()
+        return [self._area_ids[path] for path in areas if path in self._area_ids]
+    
+    def GetAreaMask(self, areas, z, unassigned=False):
+        '''
+        Which tiles of a z-level are in the given areas.
+        
+        :param areas list:
+            Area path, or list of area paths.  Subtypes are not matched.
+        :param z int:
+        :param unassigned bool:
+            Also include tiles without an /area atom.
+        :returns numpy.ndarray:
+            Booleans, indexed [x, y].
+        '''
+        ids = self._GetAreaIDs(areas)
+        if unassigned:
+            ids.append(0)
+        return numpy.in1d(self.zLevels[z].GetAreaIDs(), ids).reshape(self.zLevels[z].tiles.shape)
+    
+    def CountArea(self, areas, z=None):
+        '''
+        Number of tiles in the given areas.
+        
+        :param areas list:
+            Area path, or list of area paths.
+        :param z int:
+            Only count this z-level.
+        '''
+        ids = self._GetAreaIDs(areas)
+        total = 0
+        for zi in (xrange(len(self.zLevels)) if z is None else [z]):
+            counts, _ = self.zLevels[zi].GetAreaStats()
+            total += int(counts[ids].sum())
+        return total
+    
+    def GetAreaBBox(self, areas, z):
+        '''
+        Bounding box of the given areas on a z-level.  The area's crop is then
+        ``map.zLevels[z].tiles[x0:x1, y0:y1]``.
+        
+        :param areas list:
+            Area path, or list of area paths.
+        :param z int:
+        :returns tuple:
+            (x0, y0, x1, y1) with exclusive ends, or None if none of the areas are on the z-level.
+        '''
+        counts, bboxes = self.zLevels[z].GetAreaStats()
+        ids = [i for i in self._GetAreaIDs(areas) if counts[i] > 0]
+        if not ids:
+            return None
+        found = bboxes[ids]
+        return (int(found[:, 0].min()), int(found[:, 1].min()), int(found[:, 2].max()), int(found[:, 3].max()))
+    
+    def Snapshot(self):
+        '''
+        Cheap copy-on-write clone of the map, for what-if edits and before/after comparisons.
+        
+        Both maps keep using the same z-level arrays, read-only, until one of them writes to a level through
+        the :class:`Map` or :class:`MapLayer` methods and gets its own copy of it (call :meth:`MapLayer.Own`
+        before writing to :attr:`MapLayer.tiles` directly).  The tile and instance tables are shared as
+        well, as long as both maps only add to them.  :meth:`Compact`, or editing one of the tile types in
+        place (:meth:`Tile.AppendAtom` or :meth:`Tile.RemoveAtom` on a tile from :attr:`tiles`), stops
+        the sharing first.  The shared tile types belong to this map, so the snapshot keeps them as
+        they were.
+        
+        :rtype Map:
+        '''
+        snap = Map(self.tree, forgiving_atom_lookups=self.forgiving_atom_lookups)
+        snap.tiles = self.tiles
+        snap.instances = self.instances
+        snap._tile_idmap = self._tile_idmap
+        snap._instance_idmap = self._instance_idmap
+        snap.basetile = self.basetile
+        snap.DMIs = self.DMIs
+        snap.whitelistTypes = self.whitelistTypes
+        snap.missing_atoms = set(self.missing_atoms)
+        for layer in self.zLevels:
+            if isinstance(layer.tiles, ChunkedTiles):
+                layer.tiles.writeable = False
+            else:
+                layer.tiles.flags.writeable = False
+            copy = MapLayer(layer.z, snap, tiles=layer.tiles)
+            copy.origin = layer.origin
+            snap.zLevels.append(copy)
+        self._sharing.add(snap)
+        snap._sharing = self._sharing
+        return snap
+    
+    @staticmethod
+    def Merge3(base, ours, theirs):
+        '''
+        Three-way merge of two edited versions of a map.  Cells only one side changed are taken from that
+        side; cells both sides changed get the atoms either side added or removed.  Where both changed the
+        same atoms differently, or both replaced the turf or area, ours is kept and marked with a
+        /obj/effect/byondtools/changed whose tag is "merge".
+        
+        :param base Map:
+            The version both sides started from.
+        :param ours Map:
+        :param theirs Map:
+        :returns tuple:
+            (merged Map, :class:`byond.map.merge.MapMerge` with the stats and the conflicting cells)
+        '''
+        from byond.map.merge import MapMerge
+        merge = MapMerge(base, ours, theirs)
+        return merge.Merge(), merge
+    
+    def _Unshare(self):
+        '''Give every other map sharing our tables (see :meth:`Snapshot`) its own copy of them.'''
+        others = [other for other in self._sharing if other is not self]
+        if not others:
+            return
+        # Parse lazy tile types into the tables while they are still shared.
+        self.Materialize()
+        for other in others:
+            other.instances = [atom.copy() if atom is not None else None for atom in other.instances]
+            tiles = []
+            for tile in other.tiles:
+                if tile is not None:
+                    tile = tile.copy(origID=True)
+                    tile.map = other
+                    tile.master = True
+                tiles.append(tile)
+            other.tiles = tiles
+            other._tile_idmap = dict(other._tile_idmap)
+            other._instance_idmap = dict(other._instance_idmap)
+            if other.basetile is not None and 0 <= other.basetile.ID < len(tiles):
+                other.basetile = tiles[other.basetile.ID]
+            other.InvalidateTypeIndex()
+            other._sharing = weakref.WeakSet([other])
+        for tile in self.tiles:
+            if tile is not None:
+                tile.map = self
+        self._sharing = weakref.WeakSet([self])
+        
+    def EnableJournal(self, limit=None):
+        '''
+        Start recording z-level edits, so they can be rolled back with :meth:`Undo` and :meth:`Redo`
+        without reloading the map.
+        
+        :param limit int:
+            Most undo steps to keep.
+        '''
+        self.journal = MapJournal(limit)
+        
+    def Checkpoint(self, label=None):
+        '''End the current undo step: :meth:`Undo` rolls back everything since the previous checkpoint.'''
+        if self.journal is not None:
+            self.journal.Checkpoint(label)
+            
+    def Undo(self):
+        ''':returns bool: False if there was nothing to undo.'''
+        return self.journal is not None and self.journal.Undo()
+    
+    def Redo(self):
+        ''':returns bool: False if there was nothing to redo.'''
+        return self.journal is not None and self.journal.Redo()
+    
+    def Stats(self, z=None):
+        '''
+        Counts of what is on the map, from one numpy.unique pass per z-level.  Only z-levels edited since the
+        last call are counted again.
+        
+        :param z int:
+            Only count this z-level.
+        :returns dict:
+            cells: number of cells.
+            distinct: number of distinct tile types used.
+            tiles: tile ID -> cells.
+            atoms: atom type path -> cells holding it (once per atom on the tile).
+            areas: area path -> cells.
+        '''
+        out = {'cells': 0, 'distinct': 0, 'tiles': {}, 'atoms': {}, 'areas': {}}
+        for zi in (xrange(len(self.zLevels)) if z is None else [z]):
+            stats = self.zLevels[zi].GetStats()
+            out['cells'] += stats['cells']
+            for key in ('tiles', 'atoms', 'areas'):
+                total = out[key]
+                for item, count in stats[key].items():
+                    total[item] = total.get(item, 0) + count
+        out['distinct'] = len(out['tiles'])
+        return out
+    
+    def GetTileRefcounts(self):
+        '''
+        How many cells of all z-levels use each tile type.
+        
+        :returns numpy.ndarray:
+            Counts, indexed by tile ID.
+        '''
+        counts = numpy.zeros(len(self.tiles), dtype=int)
+        for zLevel in self.zLevels:
+            counts += numpy.bincount(zLevel.tiles.ravel(), minlength=len(self.tiles))[:len(self.tiles)]
+        return counts
+    
+    def GetInstanceRefcounts(self, tile_refs=None):
+        '''
+        How many cells of all z-levels hold each instance.  Tile types that have not been parsed yet hold
+        no instances.
+        
+        :param tile_refs numpy.ndarray:
+            Tile refcounts to weigh by, if not :meth:`GetTileRefcounts`.
+        :returns numpy.ndarray:
+            Counts, indexed by instance ID.
+        '''
+        if tile_refs is None:
+            tile_refs = self.GetTileRefcounts()
+        tids = []
+        iids = []
+        for tid, tile in enumerate(self.tiles):
+            if tile is None or tile_refs[tid] == 0 or not tile.IsMaterialized():
+                continue
+            for iid in tile.instances:
+                if iid is not None:
+                    tids.append(tid)
+                    iids.append(iid)
+        iids = numpy.array(iids, dtype=int)
+        weights = tile_refs[numpy.array(tids, dtype=int)]
+        return numpy.bincount(iids, weights=weights, minlength=len(self.instances)).astype(int)
+    
+    def Compact(self):
+        '''
+        Drop tile types no z-level uses and instances no remaining tile type uses, merge duplicate tile
+        types, and renumber the rest.  Tile and instance IDs held elsewhere (copies from :meth:`GetTileAt`
+        and the like) are invalid afterwards, and the journal is cleared.
+        
+        :returns tuple:
+            (tile types dropped, instances dropped)
+        '''
+        start = clock()
+        self._Unshare()
+        ntiles = len(self.tiles)
+        refs = self.GetTileRefcounts()
+        basetileID = None
+        if self.basetile is not None and 0 <= self.basetile.ID < ntiles:
+            basetileID = self.basetile.ID
+            refs[basetileID] += 1
+        refs[numpy.array([tile is None for tile in self.tiles], dtype=bool)] = 0
+        # Lazy tile types would parse their atoms with the old instance IDs, so parse the ones we keep now.
+        for tid in numpy.flatnonzero(refs > 0):
+            self.tiles[tid].Materialize()
+        ninstances = len(self.instances)
+        
+        ikeep = self.GetInstanceRefcounts(refs) > 0
+        ikeep &= numpy.array([atom is not None for atom in self.instances], dtype=bool)
+        iremap = numpy.cumsum(ikeep) - 1
+        instances = []
+        self._instance_idmap = {}
+        for iid in numpy.flatnonzero(ikeep):
+            atom = self.instances[iid]
+            atom.ID = len(instances)
+            instances.append(atom)
+            self._instance_idmap.setdefault(atom.GetIdentity(), atom.ID)
+        self.instances = instances
+        
+        remap = numpy.zeros(ntiles, dtype=int)
+        tiles = []
+        self._tile_idmap = {}
+        for tid in numpy.flatnonzero(refs > 0):
+            tile = self.tiles[tid]
+            tile.instances = [int(iremap[iid]) for iid in tile.instances if iid is not None and ikeep[iid]]
+            identity = tile.GetIdentity()
+            if identity in self._tile_idmap:
+                remap[tid] = self._tile_idmap[identity]
+                continue
+            self._tile_idmap[identity] = len(tiles)
+            tile.ID = len(tiles)
+            remap[tid] = tile.ID
+            tiles.append(tile)
+        self.tiles = tiles
+        
+        for zLevel in self.zLevels:
+            zLevel.Remap(remap)
+        if basetileID is not None:
+            self.basetile = self.tiles[remap[basetileID]]
+        self.InvalidateTypeIndex()
+        if self.journal is not None:
+            # Its tile IDs are stale now.
+            self.journal = MapJournal(self.journal.limit)
         
+        self.log.info('Compacted {} -> {} tile types, {} -> {} instances in {}'.format(ntiles, len(self.tiles), ninstances, len(self.instances), getElapsed(start)))
+        return ntiles - len(self.tiles), ninstances - len(self.instances)
+    
     def GetTileByID(self, tileID):
         t = self.tiles[tileID]
         if t is None:
@@ -506,6 +1621,17 @@ class Map:
         t.master = False
         return t
         
+    def ViewInstance(self, atomID):
+        '''
+        Like :meth:`GetInstance`, but without copying the atom.
+        
+        :rtype AtomView:
+        '''
+        a = self.instances[atomID]
+        if a is None:
+            return None
+        return AtomView(a)
+        
     def GetInstance(self, atomID):
         a=None
         try:
@@ -528,7 +1654,7 @@ class Map:
             Tile to update.
         :return Tile ID:
         '''
-        thash = t.GetHash()
+        thash = t.GetIdentity()
 
         # if t.ID >= 0 and t.ID < len(self.tiles) and self.tiles[t.ID] is not None:
         #    self.tiles[t.ID].rmLocation(t.coords)
@@ -545,7 +1671,9 @@ class Map:
             idmap_action = "Added"
             
             t.ID = len(self.tiles)
-            self.tiles += [t.copy()]
+            master = t.copy()
+            master.master = True
+            self.tiles += [master]
             self._tile_idmap[thash] = t.ID
             tiles_action = "Added"
             #print('Assigned ID #{} to tile {}'.format(t.ID,thash))
@@ -565,7 +1693,7 @@ class Map:
         
         :param a Atom: Tile to update.
         '''
-        thash = a.GetHash()
+        thash = a.GetIdentity()
         
         if a.ID and len(self.instances) < a.ID and self.instances[a.ID] is not None:
             self.instances[a.ID].rmLocation(self, a.coords)
@@ -587,7 +1715,7 @@ class Map:
         
         :param a Atom: Tile to update.
         '''
-        thash = a.GetHash()
+        thash = a.GetIdentity()
         
         if a.ID and len(self.instances) < a.ID and self.instances[a.ID] is not None:
             self.instances[a.ID].rmLocation(self, a.coords)
@@ -596,8 +1724,14 @@ class Map:
         if thash in self._instance_idmap:
             del self._instance_idmap[thash]
         
-    def CreateZLevel(self, height, width, z= -1):
-        zLevel = MapLayer(z if z >= 0 else len(self.zLevels), self, height, width)
+    def Materialize(self):
+        '''Parse every lazily loaded tile type now.'''
+        for tile in self.tiles:
+            if tile is not None:
+                tile.Materialize()
+        
+    def CreateZLevel(self, height, width, z= -1, tiles=None, sparse=False):
+        zLevel = MapLayer(z if z >= 0 else len(self.zLevels), self, height, width, tiles=tiles, sparse=sparse)
         if z >= 0:
             self.zLevels[z] = zLevel
         else:
@@ -618,17 +1752,94 @@ class Map:
         return LocationIterator(self)
     
     def Load(self, filename, **kwargs):
-        _, ext = os.path.splitext(filename)
-        fmt = kwargs.get('format', 'dmm2' if ext == 'dmm2' else 'dmm')
-        reader = GetMapFormat(self, fmt)
-        reader.Load(filename, **kwargs)
+        '''
+        Load a map, picking the format from the extension unless format= is given.
+        
+        With cache=True, .dmm files are cached as a .dmmc next to them (see
+        :class:`byond.map.format.dmmc.DMMCFormat`), which is used instead of the text for as long as the
+        .dmm's hash matches.  Nothing is written next to the map otherwise.
+        
+        Tile types are parsed on first use unless eager=True is passed.
+        
+        Maps ending in .gz, .bz2 or .xz are decompressed on the fly (and not cached).
+        
+        z=[...] and/or bbox=(x0, y0, x1, y1) load only those z-levels and that part of them, reading
+        the .dmm through its .dmmi index (see :class:`byond.map.format.dmm.DMMIndex`), which is only
+        kept next to the map with cache=True.  Each loaded layer's origin is its (x0, y0, z) in the file.
+        
+        sparse=True stores z-levels that are mostly one tile type (like empty space) as
+        :class:`ChunkedTiles` wherever that takes less memory.
+        '''
+        fmt = kwargs.get('format', self._GuessFormat(filename))
+        partial = kwargs.get('z', None) is not None or kwargs.get('bbox', None) is not None
+        compressed = splitCompression(filename)[1] is not None
+        if fmt == 'dmm' and kwargs.get('cache', False) and not partial and not compressed and os.path.isfile(filename):
+            cachefile = os.path.splitext(filename)[0] + '.dmmc'
+            source_md5 = md5sum(filename)
+            cache = GetMapFormat(self, 'dmmc')
+            if cache.IsCurrent(cachefile, source_md5):
+                self.log.info('Loading cached map {}...'.format(cachefile))
+                cache.Load(cachefile, **kwargs)
+                if kwargs.get('eager', False):
+                    self.Materialize()
+            else:
+                GetMapFormat(self, fmt).Load(filename, **kwargs)
+                try:
+                    cache.Save(cachefile, source=source_md5)
+                except (IOError, OSError) as e:
+                    self.log.warn('Unable to write map cache {}: {}'.format(cachefile, e))
+        else:
+            reader = GetMapFormat(self, fmt)
+            reader.Load(filename, **kwargs)
+        if kwargs.get('sparse', False):
+            self.Sparsify()
+            
+    def Sparsify(self):
+        '''Switch each z-level to a :class:`ChunkedTiles` if that takes less memory than its array.'''
+        for zLevel in self.zLevels:
+            if zLevel.IsSparse():
+                continue
+            tiles = ChunkedTiles.FromArray(zLevel.tiles)
+            if tiles.nbytes < zLevel.tiles.nbytes:
+                zLevel.tiles = tiles
+    
+    def LoadFile(self, f, **kwargs):
+        '''
+        Load a map from an open file object, such as a pipe or sys.stdin.  format= defaults to dmm.
+        '''
+        GetMapFormat(self, kwargs.get('format', 'dmm')).LoadFile(f, **kwargs)
+        if kwargs.get('sparse', False):
+            self.Sparsify()
+        
+    def Loads(self, data, **kwargs):
+        '''
+        Load a map from its text (bytes, a buffer, or a string).  format= defaults to dmm.
+        '''
+        GetMapFormat(self, kwargs.get('format', 'dmm')).Loads(data, **kwargs)
+        if kwargs.get('sparse', False):
+            self.Sparsify()
+        
+    def Dumps(self, **kwargs):
+        '''
+        :returns str: The map as text.  format= defaults to dmm.
+        '''
+        return GetMapFormat(self, kwargs.get('format', 'dmm')).Dumps(**kwargs)
     
     def Save(self, filename, **kwargs):
-        _, ext = os.path.splitext(filename)
-        fmt = kwargs.get('format', 'dmm2' if ext == 'dmm2' else 'dmm')
+        '''
+        Save the map, picking the format from the extension unless format= is given.
+        
+        Adding .gz, .bz2 or .xz compresses the output, at compresslevel= (1-9, default 9).
+        '''
+        fmt = kwargs.get('format', self._GuessFormat(filename))
         reader = GetMapFormat(self, fmt)
         reader.Save(filename, **kwargs)
         
+    def _GuessFormat(self, filename):
+        _, ext = os.path.splitext(splitCompression(filename)[0])
+        ext = ext.strip('.')
+        return ext if ext in MapFormat.all else 'dmm'
+        
     def writeMap2(self, filename, flags=0):
         self.filename = filename
         tileFlags = 0
@@ -668,6 +1879,16 @@ class Map:
         if z < len(self.zLevels):
             return self.zLevels[z].GetTile(x, y)
                 
+    def ViewTileAt(self, x, y, z):
+        '''
+        Like :meth:`GetTileAt`, but without copying the tile.  Changes to the returned
+        :class:`TileView` go to a private copy, as they would with GetTileAt.
+        
+        :rtype TileView:
+        '''
+        if z < len(self.zLevels):
+            return self.zLevels[z].ViewTile(x, y)
+    
     def CopyTileAt(self, x, y, z):
         '''
         :param int x:
@@ -686,6 +1907,262 @@ class Map:
         if z < len(self.zLevels):
             self.zLevels[z].SetTile(x, y, tile)
                 
+    def _GetTileID(self, tile):
+        if isinstance(tile, TileView):
+            if not tile.IsDetached():
+                return tile.ID
+            tile = tile.Detach()
+        if isinstance(tile, Tile):
+            return self.UpdateTile(tile)
+        if not 0 <= tile < len(self.tiles) or self.tiles[tile] is None:
+            raise KeyError('Unknown tile #{}'.format(tile))
+        return tile
+    
+    def ImportTiles(self, src_map, tile_ids):
+        '''
+        Register tile types of another map in this one, with their atoms.
+        
+        :param src_map Map:
+        :param tile_ids list:
+            IDs of the tile types in src_map.
+        :returns numpy.ndarray:
+            Tile ID in this map, indexed by tile ID in src_map.  Tile types that were not imported map to 0.
+        '''
+        if src_map is self:
+            return numpy.arange(len(self.tiles))
+        lut = numpy.zeros(len(src_map.tiles), dtype=int)
+        # Instance ID in src_map -> ours, so each atom is copied at most once.
+        imported = {}
+        for tid in tile_ids:
+            src = src_map.tiles[tid]
+            if src is None:
+                continue
+            instances = []
+            for iid in src.instances:
+                if iid not in imported:
+                    atom = src_map.instances[iid] if iid is not None else None
+                    if atom is None:
+                        imported[iid] = None
+                    else:
+                        imported[iid] = self._instance_idmap.get(atom.GetIdentity())
+                        if imported[iid] is None:
+                            imported[iid] = self.UpdateAtom(atom.copy(toNewMap=True))
+                if imported[iid] is not None:
+                    instances.append(imported[iid])
+            tile = self.CreateTile()
+            tile.instances = instances
+            lut[tid] = self.UpdateTile(tile)
+        return lut
+    
+    def ImportZLevel(self, src_map, z):
+        '''
+        Append a copy of a z-level of another map.  Only the tile types and instances the level uses are
+        copied, once each, and the level's tile IDs are translated in one pass.
+        
+        :param src_map Map:
+        :param z int:
+            z-level of src_map to copy.
+        :rtype MapLayer:
+        '''
+        tiles = numpy.asarray(src_map.zLevels[z].tiles)
+        lut = self.ImportTiles(src_map, numpy.unique(tiles).tolist())
+        return self.CreateZLevel(0, 0, tiles=lut.astype(TileIDType(len(self.tiles) - 1))[tiles])
+    
+    def ExtractZ(self, z):
+        '''
+        A new map holding only one of our z-levels, and only the tile types and instances it uses.
+        
+        :param z int:
+        :rtype Map:
+        '''
+        return Map.JoinZ([self], z=[z])
+    
+    @staticmethod
+    def JoinZ(maps, z=None):
+        '''
+        A new map with the z-levels of several maps, in order.
+        
+        :param maps list:
+            Maps to take the z-levels of.  The first one's object tree is used.
+        :param z list:
+            z-levels to take from each map, if not all of them.
+        :rtype Map:
+        '''
+        joined = Map(maps[0].tree, forgiving_atom_lookups=maps[0].forgiving_atom_lookups)
+        joined.whitelistTypes = maps[0].whitelistTypes
+        # Start without the empty basetile, so tile IDs follow the source maps'.
+        joined.ResetTilestore()
+        for src_map in maps:
+            joined.missing_atoms |= src_map.missing_atoms
+            for zi in (xrange(len(src_map.zLevels)) if z is None else z):
+                joined.ImportZLevel(src_map, zi)
+        basetile = maps[0].basetile
+        if basetile is not None and 0 <= basetile.ID < len(maps[0].tiles) and maps[0].tiles[basetile.ID] is not None:
+            joined.basetile = joined.tiles[joined.ImportTiles(maps[0], [basetile.ID])[basetile.ID]]
+        return joined
+    
+    def Fill(self, z, bbox, tile):
+        '''
+        Set every cell in a box to the same tile.
+        
+        :param z int:
+        :param bbox tuple:
+            (x0, y0, x1, y1) with exclusive ends, clipped to the z-level.  None fills the whole z-level.
+        :param tile Tile:
+            Tile, or tile ID.
+        :returns int:
+            Number of cells set.
+        '''
+        layer = self.zLevels[z]
+        x0, y0, x1, y1 = ClipBBox(bbox, layer.width, layer.height, 'z-level {}'.format(z))
+        layer.SetRegion(x0, y0, x1, y1, self._GetTileID(tile))
+        return (x1 - x0) * (y1 - y0)
+    
+    def ReplaceTiles(self, z, mapping):
+        '''
+        Swap tile types for others wherever they are used.
+        
+        :param z int:
+            z-level to change, or None for all of them.
+        :param mapping dict:
+            Old tile -> new tile.  Both can be tile IDs or Tiles.
+        :returns int:
+            Number of cells changed.
+        '''
+        pairs = [(self._GetTileID(old), self._GetTileID(new)) for old, new in mapping.items()]
+        lut = numpy.arange(len(self.tiles))
+        for old, new in pairs:
+            lut[old] = new
+        changed = numpy.flatnonzero(lut != numpy.arange(len(lut)))
+        count = 0
+        for zi in (xrange(len(self.zLevels)) if z is None else [z]):
+            layer = self.zLevels[zi]
+            n = int(numpy.bincount(layer.tiles.ravel(), minlength=len(lut))[changed].sum())
+            if n > 0:
+                layer.Remap(lut)
+                count += n
+        return count
+    
+    def Blit(self, src_map, src_bbox, dst_z, dst_xy, src_z=0):
+        '''
+        Copy a box of tiles from a map (this one or another) onto a z-level.  Tile types new to this map
+        are imported once each, rather than once per cell.
+        
+        :param src_map Map:
+        :param src_bbox tuple:
+            (x0, y0, x1, y1) in src_map, with exclusive ends.  None copies the whole z-level.
+        :param dst_z int:
+        :param dst_xy tuple:
+            (x, y) the box's lower left corner goes to.  Whatever falls outside of the z-level is dropped.
+        :param src_z int:
+            z-level of src_map to copy from.
+        :returns int:
+            Number of cells set.
+        '''
+        src = src_map.zLevels[src_z]
+        dst = self.zLevels[dst_z]
+        x0, y0, x1, y1 = ClipBBox(src_bbox, src.width, src.height, 'source z-level {}'.format(src_z))
+        dx, dy = dst_xy
+        cx0, cy0, cx1, cy1 = ClipBBox((dx, dy, dx + x1 - x0, dy + y1 - y0), dst.width, dst.height, 'z-level {}'.format(dst_z))
+        x0, y0 = x0 + cx0 - dx, y0 + cy0 - dy
+        region = numpy.asarray(src.tiles[x0:x0 + cx1 - cx0, y0:y0 + cy1 - cy0])
+        lut = self.ImportTiles(src_map, numpy.unique(region).tolist())
+        dst.SetRegion(cx0, cy0, cx1, cy1, lut[region])
+        return region.size
+    
+    def Stamp(self, prefab, z, x, y, rotate=0, mask=None, keep_area=False, src_z=0):
+        '''
+        Copy a prefab map's z-level onto one of ours.  The prefab's tile types are imported on the first
+        stamp and the lookup table is kept, so stamping the same prefab again only writes the array.
+        
+        :param prefab Map:
+        :param z int:
+        :param x int:
+        :param y int:
+            Where the prefab's (0, 0) goes, after rotating.  Whatever falls outside of the z-level is dropped.
+        :param rotate int:
+            Degrees clockwise as the map is drawn, a multiple of 90.  Only the layout turns; atoms keep
+            their dir.
+        :param mask:
+            None to stamp every cell.  A bool array [x, y] the size of the prefab level, False where ours
+            should show through.  Or a type path: prefab cells holding it show ours through.
+        :param keep_area bool:
+            Keep our areas under the stamped cells.
+        :param src_z int:
+            z-level of the prefab to stamp.
+        :returns int:
+            Number of cells set.
+        '''
+        if rotate % 90:
+            raise ValueError('Can only rotate by multiples of 90 degrees, not {}.'.format(rotate))
+        src = numpy.asarray(prefab.zLevels[src_z].tiles)
+        table = self._GetStampTable(prefab, src)
+        ids = table[1][src]
+        keep = None
+        if isinstance(mask, basestring):
+            keep = ~numpy.in1d(src, sorted(prefab._GetTypeTileIDs(mask))).reshape(src.shape)
+        elif mask is not None:
+            keep = numpy.asarray(mask, dtype=bool)
+        turns = (rotate // 90) % 4
+        ids = numpy.rot90(ids, turns)
+        if keep is not None:
+            keep = numpy.rot90(keep, turns)
+        
+        layer = self.zLevels[z]
+        w, h = ids.shape
+        x0, y0, x1, y1 = ClipBBox((x, y, x + w, y + h), layer.width, layer.height, 'z-level {}'.format(z))
+        ids = ids[x0 - x:x1 - x, y0 - y:y1 - y]
+        if keep is None and not keep_area:
+            layer.SetRegion(x0, y0, x1, y1, ids)
+            return ids.size
+        ours = numpy.asarray(layer.tiles[x0:x1, y0:y1]).astype(numpy.int64)
+        if keep is None:
+            keep = numpy.ones(ids.shape, dtype=bool)
+        else:
+            keep = keep[x0 - x:x1 - x, y0 - y:y1 - y]
+        if keep_area:
+            ids = self._StampAreas(table, ids, ours)
+        layer.SetRegion(x0, y0, x1, y1, numpy.where(keep, ids, ours))
+        return int(keep.sum())
+    
+    def _GetStampTable(self, prefab, src):
+        '''The cached :meth:`Stamp` lookup tables for a prefab, with the tile types *src* uses imported.'''
+        versions = (self._index_version, prefab._index_version)
+        table = self._stamp_tables.get(prefab)
+        if table is None or table[0] != versions:
+            # Our tile types were changed in place, or compacted.
+            table = self._stamp_tables[prefab] = [versions, numpy.zeros(0, dtype=numpy.int64), {}, numpy.zeros(0, dtype=numpy.int64), {}]
+        if len(table[1]) < len(prefab.tiles):
+            table[1] = numpy.concatenate((table[1], numpy.full(len(prefab.tiles) - len(table[1]), -1, dtype=numpy.int64)))
+        used = numpy.unique(src)
+        missing = used[table[1][used] < 0]
+        if len(missing):
+            table[1][missing] = self.ImportTiles(prefab, missing.tolist())[missing]
+        return table
+    
+    def _StampAreas(self, table, ids, ours):
+        '''Swap the areas of stamped tile types for those of the tiles they replace.'''
+        isArea = lambda iid: iid is not None and self.instances[iid] is not None and self.instances[iid].path.startswith('/area')
+        # Our tile types only matter here for their areas, so group them by those.
+        if len(table[3]) < len(self.tiles):
+            groups = [table[4].setdefault(tuple(iid for iid in tile.instances if isArea(iid)) if tile is not None else (), len(table[4])) for tile in self.tiles[len(table[3]):]]
+            table[3] = numpy.concatenate((table[3], numpy.array(groups, dtype=numpy.int64)))
+        areas = table[3][ours]
+        ngroups = len(table[4])
+        pairs, inverse = numpy.unique(ids.astype(numpy.int64) * ngroups + areas, return_inverse=True)
+        merged = numpy.empty(len(pairs), dtype=numpy.int64)
+        for i, pair in enumerate(pairs.tolist()):
+            pair = divmod(pair, ngroups)
+            result = table[2].get(pair)
+            if result is None:
+                stamped, group = pair
+                area = ours.flat[numpy.flatnonzero(areas == group)[0]]
+                tile = self.CreateTile()
+                tile.instances = [iid for iid in self.tiles[stamped].instances if not isArea(iid)] + [iid for iid in self.tiles[area].instances if isArea(iid)]
+                result = table[2][pair] = self.UpdateTile(tile)
+            merged[i] = result
+        return merged[inverse].reshape(ids.shape)
+    
     def CreateTile(self):
         '''
         :rtype Tile:
@@ -914,26 +2391,28 @@ class Map:
             skip_alpha = kwargs['skip_alpha']
             
         print('Checking z-level {0}...'.format(z))
+        x0, y0, x1, y1 = 0, 0, self.zLevels[z].width, self.zLevels[z].height
+        mask = None
+        if len(self.selectedAreas) > 0:
+            # Tiles in one of the areas (by exact path), and tiles with no area at all.
+            mask = self.GetAreaMask(self.selectedAreas, z, unassigned=True)
+            xs, ys = numpy.nonzero(mask)
+            if len(xs) == 0:
+                print(' No selected areas on this level.')
+                return
+            x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
         instancePositions = {}
-        for y in range(self.zLevels[z].height):
-            for x in range(self.zLevels[z].width):
-                t = self.zLevels[z].GetTile(x, y)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                if mask is not None and not mask[x, y]:
+                    continue
+                t = self.zLevels[z].ViewTile(x, y)
                 # print('*** {},{}'.format(x,y))
                 if t is None:
                     continue
-                if len(self.selectedAreas) > 0:
-                    renderThis = True
-                    for atom in t.GetAtoms():
-                        if atom.path.startswith('/area'):
-                            if  atom.path not in self.selectedAreas:
-                                renderThis = False
-                    if not renderThis: continue
                 for atom in t.GetAtoms():
                     if atom is None: continue
                     iid = atom.ID
-                    if atom.path.startswith('/area'):
-                        if  atom.path not in self.selectedAreas:
-                            continue
                             
                     # Check for render restrictions
                     if len(render_types) > 0:
@@ -977,7 +2456,7 @@ class Map:
         print(' Rendering...')
         levelAtoms = []
         for iid in instancePositions:
-            levelAtoms += [self.GetInstance(iid)]
+            levelAtoms += [self.ViewInstance(iid)]
         
         pic = Image.new('RGBA', ((self.zLevels[z].width + 2) * 32, (self.zLevels[z].height + 2) * 32), "black")
             
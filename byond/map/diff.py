@@ -0,0 +1,249 @@
+'''
+Map comparison.
+
+:class:`MapDiff` gives the tile types of both maps IDs in one shared space (:class:`TileTypes`), finds the cells whose IDs
+differ with numpy, and only serializes and compares the tile types of those cells, once per
+(theirs, mine) pair of types.
+'''
+import collections, logging
+import numpy
+
+from byond.map.format.dmm import DMMFormat
+
+class TileChange(object):
+    '''
+    What changed between two tile types.
+    '''
+    def __init__(self, before, after, tiledata, removals, additions, kept):
+        #: :meth:`byond.map.Tile.GetHash` of their tile.
+        self.before = before
+
+        #: :meth:`byond.map.Tile.GetHash` of my tile.
+        self.after = after
+
+        #: My tile, serialized.
+        self.tiledata = tiledata
+
+        #: (serialized atom, amount, count on my tile) of the atoms removed.
+        self.removals = removals
+
+        #: (serialized atom, amount, count on my tile) of the atoms added.
+        self.additions = additions
+
+        #: Whether any of their atoms are left on my tile.
+        self.kept = kept
+
+class TileTypes(object):
+    '''
+    Tile types of several maps in one ID space, so their z-levels can be compared as arrays.  Types are
+    matched by their text, and each map's tiles are serialized with its own instance table.
+    '''
+    def __init__(self):
+        # Shared ID -> [map, tile ID, atom keys], and tile text -> shared ID.
+        self._types = []
+        self._ids = {}
+
+        # id(map) -> DMMFormat, and id(map) -> instance ID -> serialized atom.
+        self._formats = {}
+        self._atomkeys = {}
+
+    def GetFormat(self, _map):
+        fmt = self._formats.get(id(_map))
+        if fmt is None:
+            fmt = self._formats[id(_map)] = DMMFormat(_map)
+        return fmt
+
+    def AddMap(self, _map, nz=None):
+        '''
+        Give every tile type used on the first nz z-levels of a map (all of them by default) a shared ID.
+
+        :returns numpy.ndarray:
+            Shared ID, indexed by the map's tile ID.  Unused tile types and missing tiles map to -1.
+        '''
+        fmt = self.GetFormat(_map)
+        used = set()
+        for layer in _map.zLevels[:nz]:
+            used.update(numpy.unique(numpy.asarray(layer.tiles)).tolist())
+        lut = numpy.full(len(_map.tiles), -1, dtype=int)
+        for tid in used:
+            tile = _map.tiles[tid]
+            if tile is None:
+                continue
+            # Tile types that were never parsed are matched by their text.  Types that only differ in
+            # formatting then get different IDs, which costs a comparison but changes nothing.
+            text = tile.GetRaw()
+            if text is None:
+                text = fmt.SerializeTile(tile)[1:-1]
+            sid = self._ids.get(text)
+            if sid is None:
+                sid = self._ids[text] = len(self._types)
+                self._types.append([_map, tid, None])
+            lut[tid] = sid
+        return lut
+
+    def GetAtomKeys(self, sid):
+        '''
+        :returns list:
+            (serialized atom, instance ID) of each atom on a tile type, in order.  Instance IDs are those of
+            the first map the type was found in.
+        '''
+        if sid < 0:
+            return []
+        entry = self._types[sid]
+        if entry[2] is None:
+            entry[2] = self.GetTileAtomKeys(entry[0], entry[1])
+        return entry[2]
+
+    def GetTileAtomKeys(self, _map, tid):
+        '''
+        :returns list:
+            (serialized atom, instance ID) of each atom on a tile type of a map, in order.
+        '''
+        fmt = self.GetFormat(_map)
+        atomkeys = self._atomkeys.setdefault(id(_map), {})
+        keys = []
+        for iid in _map.tiles[tid].instances:
+            key = atomkeys.get(iid)
+            if key is None:
+                # Read-only, so skip the copy GetInstance() would make.
+                atom = _map.instances[iid] if iid is not None else None
+                if atom is None:
+                    continue
+                key = atomkeys[iid] = fmt.SerializeAtom(atom)
+            keys.append((key, iid))
+        return keys
+
+    def GetAtomCounts(self, sid):
+        ''':returns OrderedDict: Serialized atom -> count on a tile type.'''
+        counts = collections.OrderedDict()
+        for key, _ in self.GetAtomKeys(sid):
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def GetTile(self, sid, _map):
+        '''A tile type, or an empty tile of _map for cells without one.'''
+        if sid < 0:
+            return _map.CreateTile()
+        t_map, tid, _ = self._types[sid]
+        return t_map.tiles[tid]
+
+    def GetMap(self, sid):
+        ''':returns tuple: (map, tile ID) a tile type was first found in.'''
+        return tuple(self._types[sid][:2])
+
+class MapDiff(object):
+    def __init__(self, theirs, mine):
+        '''
+        Compare two maps.  z-levels are compared by index; levels of different sizes are listed in
+        :attr:`mismatched` and skipped.
+
+        :param theirs Map:
+        :param mine Map:
+        '''
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.theirs = theirs
+        self.mine = mine
+
+        #: Indices of the z-levels that differ in size.
+        self.mismatched = []
+
+        #: Per z-level, None or the (xs, ys, theirs IDs, mine IDs) of the cells whose tile types differ, in
+        #: y, x order.  IDs are shared ones.
+        self.levels = []
+
+        #: The tile types of both maps.
+        self.types = TileTypes()
+
+        # (theirs ID, mine ID) -> TileChange, or None if the tiles hold the same atoms.
+        self._changes = {}
+
+        nz = min(len(theirs.zLevels), len(mine.zLevels))
+        if len(theirs.zLevels) != len(mine.zLevels):
+            self.log.warning('Maps have {} and {} z-levels, comparing the first {}.'.format(len(theirs.zLevels), len(mine.zLevels), nz))
+        theirs_lut = self.types.AddMap(theirs, nz)
+        mine_lut = self.types.AddMap(mine, nz)
+        for z in xrange(nz):
+            t_zlev = theirs.zLevels[z]
+            m_zlev = mine.zLevels[z]
+            if t_zlev.tiles.shape != m_zlev.tiles.shape:
+                self.mismatched.append(z)
+                self.levels.append(None)
+                continue
+            t_ids = theirs_lut[numpy.asarray(t_zlev.tiles)]
+            m_ids = mine_lut[numpy.asarray(m_zlev.tiles)]
+            ys, xs = numpy.nonzero((t_ids != m_ids).T)
+            self.levels.append((xs, ys, t_ids[xs, ys], m_ids[xs, ys]))
+
+    def GetChange(self, theirs_id, mine_id):
+        '''
+        :returns TileChange:
+            What changed between two tile types, by shared ID, or None if they hold the same atoms.
+        '''
+        key = (theirs_id, mine_id)
+        if key in self._changes:
+            return self._changes[key]
+        theirs = self.types.GetAtomCounts(theirs_id)
+        mine = self.types.GetAtomCounts(mine_id)
+        removals = []
+        additions = []
+        kept = False
+        for akey in list(theirs) + [akey for akey in mine if akey not in theirs]:
+            minecount = mine.get(akey, 0)
+            delta = minecount - theirs.get(akey, 0)
+            if delta < 0:
+                removals.append((akey, -delta, minecount))
+            elif delta > 0:
+                additions.append((akey, delta, minecount))
+            if minecount > 0 and delta <= 0:
+                kept = True
+        change = None
+        if removals or additions:
+            before = self.types.GetTile(theirs_id, self.theirs)
+            after = self.types.GetTile(mine_id, self.mine)
+            change = TileChange(before.GetHash(), after.GetHash(), self.types.GetFormat(after.map).SerializeTile(after), removals, additions, kept)
+        self._changes[key] = change
+        return change
+
+    def Changes(self):
+        '''
+        Iterate over the cells that changed, in z, y, x order.
+
+        :returns generator: (x, y, z, :class:`TileChange`) tuples.
+        '''
+        for z, level in enumerate(self.levels):
+            if level is None:
+                continue
+            xs, ys, t_ids, m_ids = level
+            for x, y, t_id, m_id in zip(xs.tolist(), ys.tolist(), t_ids.tolist(), m_ids.tolist()):
+                change = self.GetChange(t_id, m_id)
+                if change is not None:
+                    yield x, y, z, change
+
+    def WritePatch(self, f):
+        '''
+        Write the differences as a .dmmpatch, as applied by ``dmm.py patch``.
+
+        :param f file:
+        :returns dict:
+            diffs: atoms added and removed.  tilediffs: cells changed.
+        '''
+        stats = {'diffs': 0, 'tilediffs': 0}
+        def writeChanges(changes):
+            for key, amount, minecount in changes:
+                if amount > 1:
+                    f.write(' {}{} {}\n'.format(change_type, amount if minecount > 0 else '*', key))
+                else:
+                    f.write(' {} {}\n'.format(change_type, key))
+                stats['diffs'] += amount
+        for x, y, z, change in self.Changes():
+            f.write('<{},{},{}>\n'.format(x, y, z))
+            stats['tilediffs'] += 1
+            f.write(' @CHECK {before} {after} {tiledat}\n'.format(before=change.before, after=change.after, tiledat=change.tiledata))
+            if not change.kept:
+                f.write(' -ALL\n')
+            else:
+                change_type = '-'
+                writeChanges(change.removals)
+            change_type = '+'
+            writeChanges(change.additions)
+        return stats
@@ -1,4 +1,5 @@
-import logging
+import os, shutil, tempfile, logging
+from io import BytesIO
 
 _log = logging.getLogger("byond.mapformat")
 # Decorator
@@ -32,4 +33,49 @@ class BaseMapFormat:
         return
     
     def Save(self, filename, **kwargs):
-        return
\ No newline at end of file
+        return
+    
+    def LoadFile(self, f, **kwargs):
+        '''
+        Load from an open file object.  Formats that can only read files get a copy in a temporary file.
+        '''
+        fd, filename = tempfile.mkstemp(suffix='.' + _GetExtension(self))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                shutil.copyfileobj(f, tmp)
+            # The file is gone after this, so don't leave anything mapped to it.
+            kwargs['mmap'] = False
+            self.Load(filename, **kwargs)
+        finally:
+            os.remove(filename)
+    
+    def Loads(self, data, **kwargs):
+        '''Load from the contents of a map file.'''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.LoadFile(BytesIO(data), **kwargs)
+        
+    def SaveFile(self, f, **kwargs):
+        '''
+        Write the map to anything with write().  Formats that can only write files go through a temporary file.
+        '''
+        fd, filename = tempfile.mkstemp(suffix='.' + _GetExtension(self))
+        os.close(fd)
+        try:
+            self.Save(filename, **kwargs)
+            with open(filename, 'rb') as tmp:
+                shutil.copyfileobj(tmp, f)
+        finally:
+            os.remove(filename)
+    
+    def Dumps(self, **kwargs):
+        ''':returns str: What :meth:`Save` would write.'''
+        f = BytesIO()
+        self.SaveFile(f, **kwargs)
+        return f.getvalue()
+
+def _GetExtension(fmt):
+    for ext, c in MapFormat.all.items():
+        if fmt.__class__ is c:
+            return ext
+    return 'tmp'
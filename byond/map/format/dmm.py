@@ -1,13 +1,214 @@
 from byond.basetypes import *
-from byond.utils import getElapsed, do_profile
+from byond.utils import getElapsed, do_profile, md5sum, openFile, splitCompression
 # from byond.map import Tile, MapLayer
 from byond.map.format.base import BaseMapFormat, MapFormat
-import os, sys, logging, itertools, shutil, collections, math
+import os, sys, logging, itertools, shutil, collections, math, re, mmap, multiprocessing
+import numpy
 from time import clock
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+    
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 ID_ENCODING_TABLE = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 IET_SIZE = len(ID_ENCODING_TABLE)
 
+# A quoted string or file reference, with backslash escapes.  Unrolled so that long strings do not backtrack.
+_QUOTED = r'"[^"\\]*(?:\\.[^"\\]*)*"|\'[^\'\\]*(?:\\.[^\'\\]*)*\''
+
+#: One atom of a tile definition: /type/path{var = value; ...}, followed by a comma or the end of the line.
+REGEX_TILE_ATOM = re.compile(r'\s*(?P<atom>(?P<path>[^{},"\'\s]+)(?:\s*\{(?P<vars>[^"\'}]*(?:(?:' + _QUOTED + r')[^"\'}]*)*)\})?)\s*(?:,|$)')
+
+#: One var = value pair inside an atom's {} block, followed by a semicolon or the end of the block.
+REGEX_ATOM_VAR = re.compile(r'\s*(?P<key>[^=;]*)=\s*(?P<value>[^"\';]*(?:(?:' + _QUOTED + r')[^"\';]*)*)(?:;|$)')
+
+def TokenizeTileChunk(chunk):
+    '''
+    Split the inside of a tile definition into atoms and their vars in a single pass.
+    
+    :param chunk str:
+        Everything between the parentheses of a tile definition.
+    :raises ValueError: If the chunk is malformed.
+    :returns list:
+        One (atom_text, path, [(key, raw_value), ...]) tuple per atom, in order.
+    '''
+    o = []
+    chunk = chunk.strip()
+    pos = 0
+    end = len(chunk)
+    match = REGEX_TILE_ATOM.match
+    while pos < end:
+        m = match(chunk, pos)
+        if m is None or m.end() == pos:
+            raise ValueError('Malformed atom at column {}: {}'.format(pos, chunk[pos:]))
+        atom, path, block = m.group('atom', 'path', 'vars')
+        o.append((atom, path, TokenizeAtomVars(block) if block else []))
+        pos = m.end()
+    return o
+
+def TokenizeAtomVars(block):
+    '''
+    Split the contents of an atom's {} block into (key, raw_value) pairs.
+    
+    :param block str:
+        Text between the braces, or None if the atom had none.
+    :raises ValueError: If the block is malformed.
+    '''
+    o = []
+    if not block:
+        return o
+    pos = 0
+    for m in REGEX_ATOM_VAR.finditer(block):
+        if m.start() != pos or m.end() == pos:
+            break
+        key, value = m.group('key', 'value')
+        o.append((key.rstrip(), value.rstrip()))
+        pos = m.end()
+    if pos != len(block):
+        raise ValueError('Malformed var at column {}: {}'.format(pos, block[pos:]))
+    return o
+
+def DecodeZLevel(rows, idlen, key2id):
+    '''
+    Convert the rows of a z-level block into an array of tile IDs in one go.
+    
+    :param rows list:
+        Row strings of the block, top to bottom, without line endings.
+    :param idlen int:
+        Width of a tile key.
+    :param key2id dict:
+        Tile key -> tile ID.
+    :raises ValueError: If the rows are ragged.
+    :raises KeyError: If a key is not in key2id.
+    :returns numpy.ndarray:
+        Tile IDs, indexed [x, y].
+    '''
+    height = len(rows)
+    width = len(rows[0]) // idlen if height > 0 else 0
+    rowlen = width * idlen
+    for y, row in enumerate(rows):
+        if len(row) != rowlen:
+            raise ValueError('Row {} is {} characters long, expected {}.'.format(y, len(row), rowlen))
+    buf = rows[0][:0].join(rows) if height > 0 else b''
+    if not isinstance(buf, bytes):
+        buf = buf.encode('ascii')
+    return DecodeKeys(numpy.frombuffer(buf, dtype='S{}'.format(idlen)).reshape(height, width), key2id)
+
+def DecodeKeys(keys, key2id):
+    '''
+    Look up a (height, width) array of tile keys.
+    
+    :returns numpy.ndarray:
+        Tile IDs, indexed [x, y].
+    '''
+    height, width = keys.shape
+    # Only the distinct keys need a dict lookup; everything else is a table lookup.
+    uniq, inverse = numpy.unique(keys, return_inverse=True)
+    # Smallest unsigned type that holds every tile ID (see byond.map.TileIDType).
+    dtype = numpy.min_scalar_type(max(key2id.values()) if key2id else 0)
+    lut = numpy.array([key2id[key] for key in uniq.astype(str).tolist()], dtype=dtype)
+    return numpy.ascontiguousarray(lut[inverse].reshape(height, width).T)
+
+def DecodeZLevelBuffer(buf, start, end, idlen, key2id):
+    '''
+    :func:`DecodeZLevel` for a z-level block inside a buffer (bytes, bytearray or mmap), as located
+    by :func:`LocateZLevelsIn`.  Evenly laid out rows are read in place, without copying them out.
+    '''
+    nl = buf.find(b'\n', start, end)
+    if nl > start:
+        rowlen = nl - start
+        cr = 1 if buf[nl - 1:nl] == b'\r' else 0
+        stride = rowlen + 1
+        height = (end - start) // stride
+        width = (rowlen - cr) // idlen
+        if (end - start) % stride == 0 and (rowlen - cr) % idlen == 0:
+            grid = numpy.ndarray((height, stride), dtype='S1', buffer=buf, offset=start)
+            if (grid[:, -1] == b'\n').all() and (not cr or (grid[:, -2] == b'\r').all()):
+                keys = numpy.ndarray((height, width), dtype='S{}'.format(idlen), buffer=buf, offset=start, strides=(stride, idlen))
+                return DecodeKeys(keys, key2id)
+    rows = [row.rstrip(b'\r') for row in buf[start:end].split(b'\n')]
+    return DecodeZLevel([row for row in rows if row != b''], idlen, key2id)
+
+def LocateZLevels(filename):
+    '''
+    Find the z-level blocks of a .dmm without reading them.
+    
+    :returns list:
+        (z, start, end) for each block, in file order.  z is as written in the file; start and end
+        are the byte offsets of the first row and of the closing "}.
+    '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return LocateZLevelsIn(mm, filename)
+        finally:
+            mm.close()
+    
+def LocateZLevelsIn(buf, filename='BUILT-IN?'):
+    '''
+    :func:`LocateZLevels` for a .dmm already in memory (bytes, bytearray or mmap).
+    '''
+    blocks = []
+    # Dictionary entries are single lines starting with a quote, so the first line starting
+    # with ( is the first block header.
+    pos = 0 if buf[:1] == b'(' else buf.find(b'\n(')
+    while pos != -1:
+        eol = buf.find(b'\n', pos + 1)
+        if eol == -1:
+            break
+        header = buf[pos:eol].strip()
+        z = int(header[1:header.index(b')')].split(b',')[2])
+        end = buf.find(b'"}', eol)
+        if end == -1:
+            raise ValueError('{}: Unterminated z-level {}.'.format(filename, z))
+        blocks.append((z, eol + 1, end))
+        pos = buf.find(b'\n(', end)
+    return blocks
+
+def ClipBBox(bbox, width, height, what='z-level'):
+    '''
+    Clip an (x0, y0, x1, y1) box (x1 and y1 exclusive) to a width x height level.  None is the whole level.
+    
+    :raises ValueError: If nothing is left.
+    '''
+    if bbox is None:
+        return 0, 0, width, height
+    x0, y0, x1, y1 = bbox
+    x0, x1 = max(0, x0), min(width, x1)
+    y0, y1 = max(0, y0), min(height, y1)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('bbox {} is outside of {} ({}x{}).'.format(bbox, what, width, height))
+    return x0, y0, x1, y1
+
+def _str(data):
+    '''bytes read from a file -> native str.'''
+    return data if isinstance(data, str) else data.decode('ascii')
+
+# Set in each worker process by _InitZLevelWorker, so the key table is only sent once per worker.
+_worker_idlen = 0
+_worker_key2id = None
+
+def _InitZLevelWorker(idlen, key2id):
+    global _worker_idlen, _worker_key2id
+    _worker_idlen = idlen
+    _worker_key2id = key2id
+    
+def _DecodeZLevelAt(args):
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+    rows = [row.rstrip(b'\r') for row in block.split(b'\n')]
+    return DecodeZLevel([row for row in rows if row != b''], _worker_idlen, _worker_key2id)
+
 def chunker(iterable, chunksize):
     """
     Return elements from the iterable in `chunksize`-ed lists. The last returned
@@ -29,6 +230,243 @@ def DMMSortAlg(v):
     l.reverse()
     return t + tuple(l)
 
+class RawTileChunk(object):
+    '''
+    The atom list of a dictionary entry, kept as text until someone asks for the atoms.
+    '''
+    def __init__(self, text):
+        #: Everything between the parentheses of the entry.
+        self.text = text
+        
+    def Tokens(self):
+        '''
+        :returns list: Output of :func:`TokenizeTileChunk`.
+        '''
+        return TokenizeTileChunk(self.text)
+    
+    def Paths(self):
+        '''
+        :returns list: Type paths of the atoms, in map order.
+        '''
+        return [path for _, path, _ in self.Tokens()]
+    
+    def __str__(self):
+        return self.text
+    
+    def __repr__(self):
+        return '<RawTileChunk ({})>'.format(self.text)
+    
+class DMMReader(object):
+    '''
+    Walks a .dmm file one line at a time without building a :class:`byond.map.Map`.
+    
+    Dictionary entries come out of :meth:`Entries` as (key, :class:`RawTileChunk`), then grid rows
+    come out of :meth:`Rows` as (z, y, keys), both zero-based.  Iterating the reader itself yields
+    both, in file order.
+    
+    Any file object will do, so compressed history can be read with :func:`byond.utils.openFile`.
+    
+    .. code-block:: python
+    
+        with openFile('station.dmm.gz') as f:
+            reader = DMMReader(f)
+            airlocks = set(key for key, raw in reader.Entries() if '/obj/machinery/door/airlock' in raw.text)
+            for z, y, keys in reader.Rows():
+                ...
+    '''
+    def __init__(self, f, filename='BUILT-IN?'):
+        self.f = f
+        self.filename = filename
+        self.lineNumber = 0
+        
+        #: Width of a tile key, known once the first entry has been read.
+        self.idlen = 0
+        
+        self._pending = None
+        self._entriesDone = False
+        
+    def _readline(self):
+        if self._pending is not None:
+            line, self._pending = self._pending, None
+            return line
+        self.lineNumber += 1
+        return self.f.readline()
+        
+    def Entries(self):
+        '''Yield (key, RawTileChunk) for each dictionary entry.'''
+        while not self._entriesDone:
+            line = self._readline()
+            if not line.startswith('"'):
+                self._pending = line
+                self._entriesDone = True
+                return
+            e = line.index('"', 1)
+            key = line[1:e]
+            self.idlen = max(self.idlen, len(key))
+            line = line.strip()
+            yield key, RawTileChunk(line[line.index('(', e) + 1:-1])
+            
+    def Rows(self):
+        '''Yield (z, y, keys) for each grid row.  Any unread dictionary entries are skipped.'''
+        for _ in self.Entries():
+            pass
+        idlen = self.idlen
+        z = -1
+        y = 0
+        inZLevel = False
+        while True:
+            line = self._readline()
+            if line == '':
+                return
+            if line.startswith('('):
+                z = int(line[1:line.index(')')].split(',')[2]) - 1
+                y = 0
+                inZLevel = True
+                continue
+            if line.strip() == '"}':
+                inZLevel = False
+                continue
+            line = line.rstrip('\r\n')
+            if not inZLevel or line == '':
+                continue
+            if idlen == 0:
+                raise ValueError('{}:{}: Grid row before any dictionary entries.'.format(self.filename, self.lineNumber))
+            yield z, y, [line[i:i + idlen] for i in xrange(0, len(line), idlen)]
+            y += 1
+            
+    def __iter__(self):
+        for entry in self.Entries():
+            yield entry
+        for row in self.Rows():
+            yield row
+        
+class DMMIndex(object):
+    '''
+    Byte offsets of the dictionary entries and z-level blocks of a .dmm, so parts of it can be read
+    without scanning the rest.
+    
+    Saved next to the map as a .dmmi, and reused for as long as the map's hash matches.
+    '''
+    #: Only used for obliterating outdated data.
+    VERSION = 1
+    
+    def __init__(self):
+        #: Hash of the indexed .dmm.
+        self.source = None
+        #: Width of a tile key.
+        self.idlen = 0
+        #: Tile key -> (start, end) of its dictionary line.
+        self.entries = collections.OrderedDict()
+        #: (z, start, end, width, height, stride) of each z-level block, in file order.  start and
+        #: end are as in :func:`LocateZLevels`.  stride is the byte length of a row including its
+        #: line ending, or 0 if the rows are not evenly laid out.
+        self.levels = []
+        
+    @classmethod
+    def Build(cls, filename, source=None):
+        idx = cls()
+        idx.source = source or md5sum(filename)
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return idx
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = 0
+                while mm[pos:pos + 1] == b'"':
+                    eol = mm.find(b'\n', pos)
+                    if eol == -1:
+                        eol = len(mm)
+                    key = _str(mm[pos + 1:mm.find(b'"', pos + 1)])
+                    idx.idlen = max(idx.idlen, len(key))
+                    idx.entries[key] = (pos, eol)
+                    pos = eol + 1
+            finally:
+                mm.close()
+            for z, start, end in LocateZLevels(filename):
+                f.seek(start)
+                block = f.read(end - start)
+                rows = block.split(b'\n')
+                stride = len(rows[0]) + 1
+                width = len(rows[0].rstrip(b'\r')) // idx.idlen if idx.idlen else 0
+                rows = [row for row in rows if row.rstrip(b'\r') != b'']
+                # Rows can only be seeked to if they are all the same length.
+                if len(block) != stride * len(rows) or any(len(row) + 1 != stride for row in rows):
+                    stride = 0
+                idx.levels.append((z, start, end, width, len(rows), stride))
+        return idx
+    
+    @classmethod
+    def Open(cls, filename, save=True):
+        '''
+        Load the .dmmi of a map, (re)building it if it is missing or out of date.
+        
+        :param save bool:
+            Write a rebuilt index back next to the map.
+        '''
+        indexfile = os.path.splitext(filename)[0] + '.dmmi'
+        source = md5sum(filename)
+        if os.path.isfile(indexfile):
+            try:
+                with open(indexfile, 'rb') as f:
+                    data = pickle.load(f)
+                if data.get('version') == cls.VERSION and data.get('source') == source:
+                    idx = cls()
+                    idx.source = source
+                    idx.idlen = data['idlen']
+                    idx.entries = data['entries']
+                    idx.levels = data['levels']
+                    return idx
+            except Exception:
+                pass
+        idx = cls.Build(filename, source)
+        if save:
+            try:
+                idx.Save(indexfile)
+            except (IOError, OSError) as e:
+                logging.getLogger(cls.__name__).warn('Unable to write map index {}: {}'.format(indexfile, e))
+        return idx
+    
+    def Save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({
+                'version': self.VERSION,
+                'source': self.source,
+                'idlen': self.idlen,
+                'entries': self.entries,
+                'levels': self.levels,
+            }, f, 2)
+            
+    def ReadRows(self, f, level, x0=0, y0=0, x1=None, y1=None):
+        '''
+        Read part of a z-level block.
+        
+        :param f file:
+            The .dmm, opened in binary mode.
+        :param level int:
+            Index into :attr:`levels`.
+        :returns list:
+            Rows y0 to y1 (exclusive), cut down to the keys of columns x0 to x1 (exclusive).
+        '''
+        _, start, end, width, height, stride = self.levels[level]
+        x1 = width if x1 is None else x1
+        y1 = height if y1 is None else y1
+        a, b = x0 * self.idlen, x1 * self.idlen
+        if stride == 0:
+            f.seek(start)
+            rows = [row.rstrip(b'\r') for row in f.read(end - start).split(b'\n')]
+            return [row[a:b] for row in rows if row != b''][y0:y1]
+        rows = []
+        for y in xrange(y0, y1):
+            f.seek(start + y * stride + a)
+            rows.append(f.read(b - a))
+        return rows
+    
+    def ReadEntry(self, f, key):
+        '''Read the dictionary line of a tile key from the .dmm, opened in binary mode.'''
+        start, end = self.entries[key]
+        f.seek(start)
+        return _str(f.read(end - start).rstrip(b'\r'))
+
 @MapFormat('dmm')
 class DMMFormat(BaseMapFormat):
     def __init__(self, map):
@@ -65,18 +503,125 @@ class DMMFormat(BaseMapFormat):
         
         self.dump_inherited = False
         
+        #: Parse every tile type's atoms while loading, instead of on first use.
+        self.eager = False
+        
     def Load(self, filename, **kwargs):
+        '''
+        :param workers int:
+            Number of processes used to decode z-levels once the dictionary is read.  Defaults to 1 (no pool).
+        :param eager bool:
+            Parse the atoms of every tile type up front (catches bad atoms at load time).  By default, tile
+            types keep their text until something asks for their atoms.
+        :param z list:
+            Only load these (zero-based) z-levels.  See :meth:`consumePartial`.
+        :param bbox tuple:
+            Only load (x0, y0, x1, y1) of each z-level.  See :meth:`consumePartial`.
+            
+        .gz, .bz2 and .xz maps are decompressed as they are read.
+        '''
         if not os.path.isfile(filename):
             self.log.warn('File ' + filename + " does not exist.")
-        self.map.ResetTilestore()
+        self.reset(filename, **kwargs)
+        z, bbox = kwargs.get('z', None), kwargs.get('bbox', None)
+        partial = z is not None or bbox is not None
+        # Compressed maps can only be streamed, so there is no seeking around in them.
+        compressed = splitCompression(filename)[1] is not None
+        if partial and not compressed:
+            self.consumePartial(filename, z, bbox, save_index=kwargs.get('cache', False))
+            return
+        workers = kwargs.get('workers', 1) or 1
+        with openFile(filename, 'r') as f:
+            self.log.info('Reading tile types from %s...', self.filename)
+            self.consumeTiles(f)
+            if workers > 1 and not compressed:
+                self.log.info('Reading tile positions ({} workers)...'.format(workers))
+                self.consumeTileMapParallel(filename, workers)
+            else:
+                self.log.info('Reading tile positions...')
+                self.consumeTileMap(f)
+        if partial:
+            self.cropZLevels(z, bbox)
+            
+    def LoadFile(self, f, **kwargs):
+        '''
+        Load from anything with readline(): an open file, a pipe, sys.stdin...
         
+        Takes eager=, z= and bbox= like :meth:`Load`.  filename= names the map in log messages.
+        '''
+        self.reset(kwargs.get('filename', getattr(f, 'name', '<stream>')), **kwargs)
+        self.consumeTiles(f)
+        self.consumeTileMap(f)
+        if kwargs.get('z', None) is not None or kwargs.get('bbox', None) is not None:
+            self.cropZLevels(kwargs.get('z', None), kwargs.get('bbox', None))
+            
+    def Loads(self, data, **kwargs):
+        '''
+        Load from the text of a map, such as the output of ``git cat-file``.
+        
+        bytes, bytearray and mmap objects are parsed in place.  Other memoryviews and text are copied
+        to bytes first.  Takes eager=, z=, bbox= and filename= like :meth:`LoadFile`.
+        '''
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, (bytes, bytearray, mmap.mmap)):
+            data = data.encode('utf-8')
+        self.reset(kwargs.get('filename', '<string>'), **kwargs)
+        pos = 0
+        while data[pos:pos + 1] == b'"':
+            eol = data.find(b'\n', pos)
+            if eol == -1:
+                eol = len(data)
+            self.lineNumber += 1
+            self.consumeTileType(_str(bytes(data[pos:eol])))
+            pos = eol + 1
+        for z, start, end in LocateZLevelsIn(data, self.filename):
+            tiles = DecodeZLevelBuffer(data, start, end, self.idlen, self.oldID2NewID)
+            width, height = tiles.shape
+            self.map.CreateZLevel(height, width, tiles=tiles)
+        if kwargs.get('z', None) is not None or kwargs.get('bbox', None) is not None:
+            self.cropZLevels(kwargs.get('z', None), kwargs.get('bbox', None))
+            
+    def reset(self, filename, **kwargs):
+        self.eager = kwargs.get('eager', False)
+        self.map.ResetTilestore()
         self.filename = filename
         self.lineNumber = 0
-        with open(filename, 'r') as f:
-            self.log.info('Reading tile types from %s...', self.filename)
-            self.consumeTiles(f)
-            self.log.info('Reading tile positions...')
-            self.consumeTileMap(f)
+        
+    def cropZLevels(self, z=None, bbox=None):
+        '''Cut the loaded map down to what :meth:`consumePartial` would have read.'''
+        levels = self.map.zLevels
+        self.map.zLevels = []
+        for zi in (range(len(levels)) if z is None else z):
+            if not 0 <= zi < len(levels):
+                raise IndexError('{}: No z-level {} (map has {}).'.format(self.filename, zi, len(levels)))
+            layer = levels[zi]
+            x0, y0, x1, y1 = ClipBBox(bbox, layer.width, layer.height, '{}: z-level {}'.format(self.filename, zi))
+            tiles = numpy.ascontiguousarray(layer.tiles[x0:x1, y0:y1])
+            self.map.CreateZLevel(y1 - y0, x1 - x0, tiles=tiles).origin = (x0, y0, zi)
+            
+    def consumeTileMapParallel(self, filename, workers):
+        '''
+        Decode every z-level block in its own worker process.  Needs the dictionary to be loaded already.
+        '''
+        start = clock()
+        blocks = LocateZLevels(filename)
+        jobs = [(filename, bstart, bend) for _, bstart, bend in blocks]
+        if len(jobs) < 2:
+            _InitZLevelWorker(self.idlen, self.oldID2NewID)
+            levels = [_DecodeZLevelAt(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(min(workers, len(jobs)), _InitZLevelWorker, (self.idlen, self.oldID2NewID))
+            try:
+                levels = pool.map(_DecodeZLevelAt, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        for (z, _, _), tiles in zip(blocks, levels):
+            width, height = tiles.shape
+            self.map.CreateZLevel(height, width, tiles=tiles)
+            self.log.info(' * Added map layer {0} ({1}x{2})'.format(z, height, width))
+        self.log.info(' Decoded {} levels in {}'.format(len(levels), getElapsed(start)))
             
     def consumeDataValue(self, value):
         data = None
@@ -92,61 +637,43 @@ class DMMFormat(BaseMapFormat):
             data = BYONDValue(value, self.filename, self.lineNumber)
         return data
     def consumeTileMap(self, f):
-        zLevel = None
-        y = 0
         z = 0
-        inZLevel = False
-        width = 0
-        height = 0
         
         while True:
             self.lineNumber += 1
             line = f.readline()
             if line == '':
                 return
-            log_prefix="{}:{}: ".format(self.filename,self.lineNumber)
             # (1,1,1) = {"
             if line.startswith('('):
                 coordChunk = line[1:line.index(')')].split(',')
                 # print(repr(coordChunk))
                 z = int(coordChunk[2])
-                inZLevel = True
-                y = 0
-                width = 0
-                height = 0
-                
                 start = clock()
-                #print(log_prefix+' START z={}'.format(z))
-                continue
-            if line.strip() == '"}':
-                zLevel.initial_load=False
-                inZLevel = False
-                if height == 0:
-                    height = y
-                # self.map.zLevels[z] = zLevel
-                zLevel = None
-                self.log.info(' * Added map layer {0} ({1}x{2}, {3})'.format(z, height, width, getElapsed(start)))
-                continue
-            if inZLevel:
-                if zLevel is None:
-                    zLevel = self.map.CreateZLevel(height, width)  # , z-1)
-                    zLevel.initial_load=True
-                    #print(log_prefix+' CREATED z={}'.format(z))
-                if width == 0:
-                    width = len(line) / self.idlen
-                    self.log.debug('Width detected as {}.'.format(width))
-                    zLevel.Resize(width, width)
+                log_prefix="{}:{}: ".format(self.filename,self.lineNumber)
+                rows = self.consumeZLevelRows(f)
+                try:
+                    tiles = DecodeZLevel(rows, self.idlen, self.oldID2NewID)
+                except (KeyError, ValueError) as e:
+                    self.log.error('%sFailed to decode z-level %d: %s', log_prefix, z, e)
+                    raise
+                width, height = tiles.shape
                 if width > 255:
-                    self.log.warn("%sLine is {} blocks long!", log_prefix, width)
-                x = 0
-                for chunk in chunker(line.strip(), self.idlen):
-                    chunk = ''.join(chunk)
-                    tid = self.oldID2NewID[chunk]
-                    #if tid == 1:
-                    #print('[{},{}] Chunk: {}, tid: {}'.format(x,y,chunk,tid))
-                    zLevel.SetTileID(x, y, tid)
-                    x += 1
-                y += 1
+                    self.log.warn("%sLine is %d blocks long!", log_prefix, width)
+                self.map.CreateZLevel(height, width, tiles=tiles)
+                self.log.info(' * Added map layer {0} ({1}x{2}, {3})'.format(z, height, width, getElapsed(start)))
+                
+    def consumeZLevelRows(self, f):
+        '''Read the rows of a z-level block, up to and including the closing "}.'''
+        rows = []
+        while True:
+            self.lineNumber += 1
+            line = f.readline()
+            if line == '' or line.strip() == '"}':
+                return rows
+            line = line.rstrip('\r\n')
+            if line != '':
+                rows.append(line)
                 
     def consumeTiles(self, f):
         index = 0
@@ -156,20 +683,7 @@ class DMMFormat(BaseMapFormat):
             line = f.readline()
             self.lineNumber += 1
             if line.startswith('"'):
-                t = self.consumeTile(line)
-                #t.ID = index
-                t.map = self.map
-                t.UpdateHash()
-                self.tileTypes += [t]
-                self.idlen = max(self.idlen, len(t.origID))
-                if t.origID=='':
-                    self.log.warning('{}:{}: ERROR: Unable to determine origID.'.format(self.filename,self.lineNumber))
-                    sys.exit(1)
-                if t.origID == 'aaa':
-                    self.map.basetile=t
-                    self.log.debug('{}:{}: Loaded tile #{} ({}) as map.basetile.'.format(self.filename,self.lineNumber,t.ID,t.origID))
-                self.oldID2NewID[t.origID] = t.ID
-                self.tileChunk2ID[self.SerializeTile(t)] = t.ID
+                self.consumeTileType(line)
                 index += 1
                 # No longer needed, 2fast.
                 # if((index % 100) == 0):
@@ -177,28 +691,96 @@ class DMMFormat(BaseMapFormat):
             else:
                 self.log.info('{} tiles loaded, {} duplicates discarded'.format(index, self.duplicates))
                 return 
+            
+    def consumeTileType(self, line):
+        '''Add one dictionary entry to the map.'''
+        t = self.consumeTile(line, lazy=not self.eager)
+        #t.ID = index
+        t.map = self.map
+        if self.eager:
+            t.UpdateHash()
+        self.tileTypes += [t]
+        self.idlen = max(self.idlen, len(t.origID))
+        if t.origID=='':
+            self.log.warning('{}:{}: ERROR: Unable to determine origID.'.format(self.filename,self.lineNumber))
+            sys.exit(1)
+        if t.origID == 'aaa':
+            self.map.basetile=t
+            self.log.debug('{}:{}: Loaded tile #{} ({}) as map.basetile.'.format(self.filename,self.lineNumber,t.ID,t.origID))
+        self.oldID2NewID[t.origID] = t.ID
+        if self.eager:
+            self.tileChunk2ID[self.SerializeTile(t)] = t.ID
+        return t
+    
+    def consumePartial(self, filename, z=None, bbox=None, save_index=True):
+        '''
+        Read some z-levels, or part of them, through the map's :class:`DMMIndex`.  Only the dictionary
+        entries used by the selected area are parsed.
+        
+        :param z list:
+            Zero-based z-levels to load, in the order they should appear in :attr:`Map.zLevels`.
+            Defaults to all of them.
+        :param bbox tuple:
+            (x0, y0, x1, y1), zero-based, x1 and y1 exclusive.  Defaults to the whole level.
+        '''
+        start = clock()
+        idx = DMMIndex.Open(filename, save=save_index)
+        self.idlen = idx.idlen
+        if z is None:
+            z = range(len(idx.levels))
+        for zi in z:
+            if not 0 <= zi < len(idx.levels):
+                raise IndexError('{}: No z-level {} (map has {}).'.format(filename, zi, len(idx.levels)))
+        with open(filename, 'rb') as f:
+            blocks = []
+            used = set()
+            for zi in z:
+                _, _, _, width, height, _ = idx.levels[zi]
+                x0, y0, x1, y1 = ClipBBox(bbox, width, height, '{}: z-level {}'.format(filename, zi))
+                rows = idx.ReadRows(f, zi, x0, y0, x1, y1)
+                used.update(numpy.unique(numpy.frombuffer(b''.join(rows), dtype='S{}'.format(idx.idlen))).astype(str).tolist())
+                blocks.append((zi, x0, y0, rows))
+            
+            self.log.info('Reading {} of {} tile types from {}...'.format(len(used), len(idx.entries), filename))
+            # Entries are one per line at the top of the file, so the line number is the position.
+            for lineNumber, key in enumerate(idx.entries):
+                if key in used:
+                    self.lineNumber = lineNumber + 1
+                    self.consumeTileType(idx.ReadEntry(f, key))
+                    
+        for zi, x0, y0, rows in blocks:
+            tiles = DecodeZLevel(rows, self.idlen, self.oldID2NewID)
+            width, height = tiles.shape
+            layer = self.map.CreateZLevel(height, width, tiles=tiles)
+            layer.origin = (x0, y0, zi)
+            self.log.info(' * Added map layer {0} ({1}x{2} at {3},{4})'.format(zi + 1, height, width, x0, y0))
+        self.log.info(' Read {} levels in {}'.format(len(blocks), getElapsed(start)))
     
     def consumeTileAtoms(self, line):
         instances = []
-        atom_chunks = self.SplitAtoms(line)
+        try:
+            atom_tokens = TokenizeTileChunk(line)
+        except ValueError as e:
+            self.log.error('{}:{}: {}'.format(self.filename, self.lineNumber, e))
+            raise
 
-        dbg = False
-        for atom_chunk in atom_chunks:
+        for atom_chunk, path, props in atom_tokens:
             if atom_chunk in self.atomCache:
                 atom=self.atomCache[atom_chunk]
-                self.log.debug('[CACHED] Adding {} as {}.'.format(atom_chunk,str(atom)))
+                self.log.debug('[CACHED] Adding %s as %s.', atom_chunk, atom)
                 instances += [atom]
             else:
-                atom = self.consumeAtom(atom_chunk)
+                atom = self.consumeAtomTokens(path, props)
                 atom.InvalidateHash()
                 atom.UpdateMap(self.map)
-                self.log.debug('Adding {} ({}) as {}.'.format(atom_chunk,atom.GetHash(),str(atom)))
+                self.log.debug('Adding %s (%s) as %s.', atom_chunk, atom.GetIdentity(), atom)
                 self.atomCache[atom_chunk] = atom
                 instances += [atom]
             
         return [x.ID for x in instances]
     
     def SplitProperties(self, string):
+        '''Legacy var splitter.  The loader uses :func:`TokenizeAtomVars` instead.'''
         o = []
         buf = []
         inString = False
@@ -233,6 +815,7 @@ class DMMFormat(BaseMapFormat):
         return o
     
     def SplitAtoms(self, string):
+        '''Legacy atom splitter.  The loader uses :func:`TokenizeTileChunk` instead.'''
         ignoreLevel = []
         
         o = []
@@ -273,41 +856,45 @@ class DMMFormat(BaseMapFormat):
         return o + [buf]
     
     def consumeAtom(self, line):
-        if '{' not in line:
-            atom = line.strip()
-            if atom.endswith('/'):
-                self.log.warn('{file}:{line}: Malformed atom: {data} has ending slash.  Stripping slashes from right side.'.format(file=self.filename, line=self.lineNumber, data=atom))
-                atom = atom.rstrip('/')
-            currentAtom = self.map.GetAtom(atom)
-            if currentAtom is not None:
-                return currentAtom
-            else:
-                self.log.error('{file}:{line}: Failed to consumeAtom({data}):  Unable to locate atom.'.format(file=self.filename, line=self.lineNumber, data=line))
-                return None
-        chunks = line.split('{')
-        if len(chunks) < 2:
+        try:
+            atom_tokens = TokenizeTileChunk(line)
+        except ValueError as e:
+            self.log.error('{file}:{line}: Failed to consumeAtom({data}): {err}'.format(file=self.filename, line=self.lineNumber, data=line, err=e))
+            return None
+        if len(atom_tokens) != 1:
             self.log.warn('{file}:{line}: Something went wrong in consumeAtom(). line={data}'.format(file=self.filename, line=self.lineNumber, data=line))
-        atom = chunks[0].strip()
+            return None
+        _, path, props = atom_tokens[0]
+        return self.consumeAtomTokens(path, props)
+    
+    def consumeAtomTokens(self, atom, props):
+        '''
+        Build an atom from the output of :func:`TokenizeTileChunk`.
+        
+        :param atom str:
+            Type path of the atom.
+        :param props list:
+            (key, raw_value) pairs, in map order.
+        '''
         if atom.endswith('/'):
             self.log.warn('{file}:{line}: Malformed atom: {data} has ending slash.  Stripping slashes from right side.'.format(file=self.filename, line=self.lineNumber, data=atom))
             atom = atom.rstrip('/')
         currentAtom = self.map.GetAtom(atom)
-        if currentAtom is not None:
-            currentAtom = currentAtom.copy()
-        else:
+        if currentAtom is None:
+            if len(props) == 0:
+                self.log.error('{file}:{line}: Failed to consumeAtom({data}):  Unable to locate atom.'.format(file=self.filename, line=self.lineNumber, data=atom))
             return None
-        if chunks[1].endswith('}'):
-            chunks[1] = chunks[1][:-1]
-        property_chunks = self.SplitProperties(chunks[1])
+        # Only keep what the map changes; everything else reads through to the type.
+        currentAtom = currentAtom.Instantiate()
+        if len(props) == 0:
+            return currentAtom
         mapSupplied = []
-        for chunk in property_chunks:
-            if chunk.endswith('}'):
-                chunk = chunk[:-1]
-            pparts = chunk.split('=', 1)
-            key = pparts[0].strip()
-            value = pparts[1].strip()
+        for key, value in props:
             if key == '':
-                self.log.warn('{file}:{line}: Ignoring property with blank name. (given {chunk})'.format(file=self.filename, line=self.lineNumber, chunk=chunk))
+                self.log.warn('{file}:{line}: Ignoring property with blank name. (given {chunk})'.format(file=self.filename, line=self.lineNumber, chunk=value))
+                continue
+            if value == '':
+                self.log.warn('{file}:{line}: Ignoring property {key} with blank value.'.format(file=self.filename, line=self.lineNumber, key=key))
                 continue
             data = self.consumeDataValue(value)
             if key not in currentAtom.mapSpecified:
@@ -320,24 +907,23 @@ class DMMFormat(BaseMapFormat):
         if True:  # TODO: not (self.readFlags & Map.READ_NO_BASE_COMP):
             base_atom = self.map.GetAtom(currentAtom.path)
             assert base_atom != None
-            # for key in base_atom.properties.keys():
-            #    val = base_atom.properties[key]
-            #    if key not in currentAtom.properties:
-            #        currentAtom.properties[key] = val
-            for key in currentAtom.properties.iterkeys():
+            for key in mapSupplied[:]:
                 val = currentAtom.properties[key].value
                 if key in base_atom.properties and val == base_atom.properties[key].value:
-                    if key in currentAtom.mapSpecified:
-                        currentAtom.mapSpecified.remove(key)
-                        # print('Removed {0} from atom: Equivalent to base atom!')
+                    currentAtom.mapSpecified.remove(key)
                         
         return currentAtom
         
-    def consumeTile(self, line, cache=True):
+    def consumeTile(self, line, cache=True, lazy=False):
         origid = self.consumeTileID(line)
-        return self.consumeTileChunk(line, origID=origid)
+        return self.consumeTileChunk(line, origID=origid, lazy=lazy)
     
-    def consumeTileChunk(self, line, origID=None, cache=True):
+    def consumeTileChunk(self, line, origID=None, cache=True, lazy=False):
+        '''
+        :param lazy bool:
+            Register the tile type with its text only; atoms are parsed on first use (see :meth:`byond.map.Tile.SetLazy`).
+            Only meaningful while loading a map.
+        '''
         t = self.map.CreateTile()
         tileChunk = line.strip()[line.index('(') + 1:-1]
         if tileChunk == '':
@@ -353,11 +939,24 @@ class DMMFormat(BaseMapFormat):
                 return self.tileTypes[parentID]
         if origID is not None:
             t.origID = origID
-        t.instances = self.consumeTileAtoms(tileChunk)
-        t.ID=self.map.UpdateTile(t)
+        if lazy:
+            t.SetLazy(tileChunk, self.materializeTileAtoms(self.lineNumber))
+            t.master = True
+            t.ID = len(self.map.tiles)
+            self.map.tiles.append(t)
+        else:
+            t.instances = self.consumeTileAtoms(tileChunk)
+            t.ID=self.map.UpdateTile(t)
         self.tileChunk2ID[tileChunk]=t.ID
         return t
     
+    def materializeTileAtoms(self, lineNumber):
+        '''Loader for lazy tiles that reports errors against the line the tile came from.'''
+        def loader(tileChunk):
+            self.lineNumber = lineNumber
+            return self.consumeTileAtoms(tileChunk)
+        return loader
+    
     def consumeTileID(self, line):
         e = line.index('"', 1)
         return line[1:e]
@@ -382,8 +981,9 @@ class DMMFormat(BaseMapFormat):
     def SerializeTile(self, tile):
         # "aat" = (/obj/structure/grille,/obj/structure/window/reinforced{dir = 8},/obj/structure/window/reinforced{dir = 1},/obj/structure/window/reinforced,/obj/structure/cable{d1 = 2; d2 = 4; icon_state = "2-4"; tag = ""},/turf/simulated/floor/plating,/area/security/prison)
         atoms = []
-        for i in xrange(len(tile.instances)):
-            atom = self.map.GetInstance(tile.instances[i])
+        for iid in tile.instances:
+            # Read-only, so skip the copy GetInstance() would make.
+            atom = self.map.instances[iid]
             if atom and atom.path != '':
                 atoms += [self.SerializeAtom(atom)]
 
@@ -426,10 +1026,25 @@ class DMMFormat(BaseMapFormat):
     
     def Save(self, filename, **kwargs):
         self.filename = filename
+        tmpfile = filename + '.tmp'
+        self.log.info('Opening {} for write...'.format(tmpfile))
+        start = clock()
+        with openFile(tmpfile, 'w', splitCompression(filename)[1], kwargs.get('compresslevel', 9)) as f:
+            self.SaveFile(f, **kwargs)
+        if os.path.isfile(filename):
+            os.remove(filename)
+        os.rename(tmpfile, filename)
+        self.log.info('-> {} in {}'.format(filename, getElapsed(start)))
+        
+    def Dumps(self, **kwargs):
+        '''The map as .dmm text.'''
+        f = StringIO()
+        self.SaveFile(f, **kwargs)
+        return f.getvalue()
         
+    def SaveFile(self, f, **kwargs):
+        '''Write the map to anything with write().'''
         self.tileTypes = []
-        examined = []
-        hashMap = {}
         self.typeMap = {}
         self.type2TID = {}
         self.instances = []
@@ -439,80 +1054,60 @@ class DMMFormat(BaseMapFormat):
         
         # Preprocess and assign IDs.
         start = clock()
-        idlen = 0
-        it = self.map.Locations()
-        lz = -1
-        last_str = None
-        start = clock()
-        maxid = 0
-        for tile in it:
-            # print(str(tile))
-            if lz != it.z:
-                if start:
-                    self.log.info('  -> Took {}'.format(getElapsed(start)))
-                self.log.info(' * Consolidating level {}...'.format(it.z + 1))
-                start = clock()
-                lz = it.z
-            strt = tile.GetHash()  # str(tile)
-            dbg = False
-            # if strt == 'e18826df83665059358c177f43f6ac72':
-            #    dbg=True
-            if last_str == strt:
-                # if dbg: print('Continuing: Same as last examined.') 
-                continue
-            if strt in examined:
-                # if dbg: print('Continuing: Hash already examined.')
-                last_str = strt
+        used = set()
+        for z, zlevel in enumerate(self.map.zLevels):
+            used.update(numpy.unique(zlevel.tiles).tolist())
+            
+        # Tile types that serialize the same share a TID (the lowest of their IDs).
+        hashMap = {}
+        id2tid = {}
+        for tid in sorted(used):
+            strt = self.SerializeTile(self.map.tiles[tid])
+            if strt in hashMap:
+                id2tid[tid] = hashMap[strt]
                 continue
-            # tile.ID = len(examined)
-            examined += [strt]
-            tid = self.GetTID(tile)
-            if tile.origID=='aaa':
-                self.log.info('{} -> {}'.format(tile.origID,tid))
-            if tid in self.typeMap:
-                if hashMap.get(strt, None) == tid:
-                    if dbg: self.log.debug('Continuing: TID {} in typeMap, hashes match.'.format(tid))
-                    continue
-                tile.origID = ''
-                tid = len(self.typeMap)
-                while tid in self.typeMap:
-                    tid += 1
-
-                self.log.info('{} assigned to new TID {}'.format(strt,tid))
-            maxid = max(maxid, tid)
-            self.typeMap[tid] = (strt, self.SerializeTile(tile))
-            last_str = strt
             hashMap[strt] = tid
-        
+            id2tid[tid] = tid
+            self.typeMap[tid] = (strt, strt)
         self.log.info(' * Preprocessing completed in {}'.format(getElapsed(start)))
+        
+        maxid = max(self.typeMap) if self.typeMap else 0
         idlen = len(self.ID2String(maxid))
-        tmpfile = filename + '.tmp'
-        self.log.info('Opening {} for write...'.format(tmpfile))
+        # Tile ID -> key, so a whole level can be looked up at once.
+        keys = numpy.zeros(len(self.map.tiles), dtype='S{}'.format(idlen))
+        for tid, strt_tid in id2tid.items():
+            keys[tid] = self.ID2String(strt_tid, idlen)
         start = clock()
-        with open(tmpfile, 'w') as f:
-            for tid in sorted(self.typeMap.keys()):
-                stid = self.ID2String(tid, idlen)
-                strt, serdata = self.typeMap[tid]
-                if serdata == '(/turf/space,/area)':
-                    self.log.debug('{} -> {}'.format(tid,stid))
-                f.write('"{}" = {}\n'.format(stid, serdata))
-                self.type2TID[strt] = stid
-            self.log.info(' Wrote types in {}...'.format(getElapsed(start)))
-            lap = clock()
-            for z in xrange(len(self.map.zLevels)):
-                self.log.debug(' Writing z={}...'.format(z))
-                f.write('\n(1,1,{0}) = {{"\n'.format(z + 1))
-                zlevel = self.map.zLevels[z]
-                for y in xrange(zlevel.height):
-                    for x in xrange(zlevel.width):
-                        tile = self.map.GetTileAt(x, y, z)
-                        thash = tile.GetHash()
-                        f.write(self.type2TID[thash])
-                    f.write("\n")
-                f.write('"}\n')
-            self.log.info(' Wrote tiles in {}...'.format(getElapsed(lap)))
-        if os.path.isfile(filename):
-            os.remove(filename)
-        os.rename(tmpfile, filename)
-        self.log.info('-> {} in {}'.format(filename, getElapsed(start)))
+        for tid in sorted(self.typeMap.keys()):
+            stid = self.ID2String(tid, idlen)
+            strt, serdata = self.typeMap[tid]
+            f.write('"{}" = {}\n'.format(stid, serdata))
+            self.type2TID[strt] = stid
+        self.log.info(' Wrote types in {}...'.format(getElapsed(start)))
+        lap = clock()
+        for z in xrange(len(self.map.zLevels)):
+            self.log.debug(' Writing z={}...'.format(z))
+            f.write('\n(1,1,{0}) = {{"\n'.format(z + 1))
+            zlevel = self.map.zLevels[z]
+            f.write(self.SerializeZLevel(numpy.asarray(zlevel.tiles), keys))
+            f.write('"}\n')
+        self.log.info(' Wrote tiles in {}...'.format(getElapsed(lap)))
         
+    def SerializeZLevel(self, tiles, keys):
+        '''
+        Inverse of :func:`DecodeZLevel`.
+        
+        :param tiles numpy.ndarray:
+            Tile IDs, indexed [x, y].
+        :param keys numpy.ndarray:
+            Tile ID -> key, as a fixed-width bytes array.
+        :returns str:
+            The rows of the z-level block, each followed by a newline.
+        '''
+        width, height = tiles.shape
+        if width == 0 or height == 0:
+            return ''
+        idlen = keys.dtype.itemsize
+        chars = numpy.ascontiguousarray(keys[tiles.T]).view('S1').reshape(height, width * idlen)
+        chars = numpy.hstack((chars, numpy.full((height, 1), b'\n', dtype='S1')))
+        return _str(chars.tobytes())
@@ -0,0 +1,210 @@
+'''
+Binary map cache.
+
+A .dmmc file is a snapshot of a loaded :class:`byond.map.Map`, written next to
+the .dmm it came from so the text does not have to be parsed again while the
+.dmm is unchanged.
+
+Layout::
+
+    'DMMC'                  magic
+    uint64 (little endian)  length of the pickled header
+    pickle                  header (version, source hash, instance and tile tables, level layout)
+    padding                 up to a 16 byte boundary
+    raw arrays              tile table and z-level arrays, C order, so they can be mmapped
+'''
+import os, struct, logging
+import numpy
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from byond.utils import getElapsed, clock
+from byond.map.format.base import BaseMapFormat, MapFormat
+from byond.map.format.dmm import DMMFormat
+
+MAGIC = b'DMMC'
+ALIGNMENT = 16
+
+@MapFormat('dmmc')
+class DMMCFormat(BaseMapFormat):
+    #: Only used for obliterating outdated data.
+    VERSION = 2
+
+    def __init__(self, _map):
+        BaseMapFormat.__init__(self, _map)
+        self.log = logging.getLogger(self.__class__.__name__)
+        # Vars are stored in their .dmm form, so share its value parser.
+        self.dmm = DMMFormat(_map)
+
+    @classmethod
+    def ReadHeader(cls, filename):
+        '''
+        :returns tuple: (header dict, offset of the array data), or (None, 0) if unreadable.
+        '''
+        if not os.path.isfile(filename):
+            return None, 0
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None, 0
+            hlen, = struct.unpack('<Q', f.read(8))
+            try:
+                header = pickle.loads(f.read(hlen))
+            except Exception:
+                return None, 0
+        return header, _align(len(MAGIC) + 8 + hlen)
+
+    @classmethod
+    def IsCurrent(cls, filename, source_md5):
+        '''
+        Check whether a cache file exists, is of our version, and was built from a source with the given hash.
+        '''
+        header, _ = cls.ReadHeader(filename)
+        if header is None:
+            return False
+        if header.get('version') != cls.VERSION:
+            logging.getLogger(cls.__name__).warn('!!! Outdated map cache {}, rebuilding.'.format(filename))
+            return False
+        return header.get('source') == source_md5
+
+    def Load(self, filename, **kwargs):
+        start = clock()
+        header, data_offset = self.ReadHeader(filename)
+        if header is None or header.get('version') != self.VERSION:
+            raise IOError('{} is not a usable map cache.'.format(filename))
+
+        self.map.ResetTilestore()
+        self.map.zLevels = []
+
+        for iid, data in enumerate(header['instances']):
+            if data is None:
+                self.map.instances.append(None)
+                continue
+            path, props = data
+            # Built like the text loader builds them, so missing types are handled the same way.
+            atom = self.dmm.consumeAtomTokens(path, props)
+            if atom is None:
+                self.log.error('{}: Unable to locate atom {}.'.format(filename, path))
+                self.map.instances.append(None)
+                continue
+            atom.ID = iid
+            atom.InvalidateHash()
+            self.map.instances.append(atom)
+            self.map._instance_idmap.setdefault(atom.GetIdentity(), iid)
+
+        offsets, instances = self.readArrays(filename, data_offset, header['tile_table'], mmap=False)
+        self.dmm.filename = filename
+        for tid, origID in enumerate(header['tile_origIDs']):
+            if origID is None:
+                self.map.tiles.append(None)
+                continue
+            tile = self.map.CreateTile()
+            tile.ID = tid
+            tile.origID = origID
+            tile.master = True
+            raw = header['tile_raw'][tid]
+            self.map.tiles.append(tile)
+            if raw is not None:
+                tile.SetLazy(raw, self.dmm.consumeTileAtoms)
+                continue
+            tile.instances = instances[offsets[tid]:offsets[tid + 1]].tolist()
+            self.map._tile_idmap.setdefault(tile.GetIdentity(), tid)
+        basetile = header['basetile']
+        if basetile >= 0 and self.map.tiles[basetile] is not None:
+            self.map.basetile = self.map.tiles[basetile]
+
+        mmap = kwargs.get('mmap', True)
+        for layout in header['levels']:
+            tiles, = self.readArrays(filename, data_offset, [layout], mmap=mmap)
+            self.map.CreateZLevel(tiles.shape[1], tiles.shape[0], tiles=tiles)
+        self.log.info('Loaded {} ({} levels, {} tile types) in {}'.format(filename, len(self.map.zLevels), len(self.map.tiles), getElapsed(start)))
+
+    def readArrays(self, filename, data_offset, layouts, mmap=True):
+        arrays = []
+        for dtype, shape, offset in layouts:
+            count = int(numpy.prod(shape))
+            if count == 0:
+                arrays.append(numpy.zeros(shape, dtype=dtype))
+            elif mmap:
+                # Copy-on-write, so edits never reach the cache file.
+                arrays.append(numpy.memmap(filename, dtype=dtype, mode='c', offset=data_offset + offset, shape=shape))
+            else:
+                with open(filename, 'rb') as f:
+                    f.seek(data_offset + offset)
+                    arrays.append(numpy.fromfile(f, dtype=dtype, count=count).reshape(shape))
+        return arrays
+
+    def Save(self, filename, **kwargs):
+        start = clock()
+        arrays = []
+        layout = []
+        pos = [0]
+        def addArray(a):
+            a = numpy.ascontiguousarray(a)
+            layout.append((a.dtype.str, a.shape, pos[0]))
+            arrays.append(a)
+            pos[0] = _align(pos[0] + a.nbytes)
+            return layout[-1]
+
+        instances = []
+        for atom in self.map.instances:
+            if atom is None:
+                instances.append(None)
+                continue
+            props = [(key, str(atom.properties[key])) for key in atom.mapSpecified if key in atom.properties]
+            instances.append((atom.path, props))
+
+        offsets = [0]
+        tile_instances = []
+        origIDs = []
+        raws = []
+        for tile in self.map.tiles:
+            if tile is None:
+                origIDs.append(None)
+                raws.append(None)
+            else:
+                origIDs.append(tile.origID)
+                # Unparsed tiles stay unparsed.
+                raws.append(tile.GetRaw())
+                if tile.IsMaterialized():
+                    tile_instances += tile.instances
+            offsets.append(len(tile_instances))
+        tile_table = [
+            addArray(numpy.array(offsets, dtype=numpy.int64)),
+            addArray(numpy.array(tile_instances, dtype=numpy.int64)),
+        ]
+
+        levels = [addArray(zLevel.tiles) for zLevel in self.map.zLevels]
+
+        basetile = -1
+        if self.map.basetile is not None and self.map.basetile.ID is not None:
+            basetile = self.map.basetile.ID
+        header = pickle.dumps({
+            'version': self.VERSION,
+            'source': kwargs.get('source', None),
+            'instances': instances,
+            'tile_origIDs': origIDs,
+            'tile_raw': raws,
+            'tile_table': tile_table,
+            'basetile': basetile,
+            'levels': levels,
+        }, 2)
+
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            data_offset = _align(f.tell())
+            for (_, _, offset), a in zip(layout, arrays):
+                f.seek(data_offset + offset)
+                f.write(a.tobytes())
+        if os.path.isfile(filename):
+            os.remove(filename)
+        os.rename(tmpfile, filename)
+        self.log.info('-> {} in {}'.format(filename, getElapsed(start)))
+
+def _align(pos):
+    return (pos + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
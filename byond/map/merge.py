@@ -0,0 +1,203 @@
+'''
+Three-way map merge.
+
+:class:`MapMerge` compares two edited versions of a map with the version they share, a z-level array
+at a time: cells only one side changed are taken from that side in bulk, and only cells both sides
+changed differently are merged atom by atom, once per distinct (base, ours, theirs) combination.
+'''
+import logging
+import numpy
+
+from byond.basetypes import Atom, PropertyFlags
+from byond.map import TileIDType
+from byond.map.diff import TileTypes
+from byond.map.patch import CHANGE_MARKER
+
+#: Atoms a tile can only hold one of.
+EXCLUSIVE_PATHS = ('/turf', '/area')
+
+class MapMerge(object):
+    def __init__(self, base, ours, theirs):
+        '''
+        :param base Map:
+            The version both sides started from.
+        :param ours Map:
+        :param theirs Map:
+        '''
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+
+        #: Cells merged so far, by class: ours (only we changed them), theirs (only they did), same (both
+        #: made the same change), merged (both changed different atoms) and conflicts.
+        self.stats = {'ours': 0, 'theirs': 0, 'same': 0, 'merged': 0, 'conflicts': 0}
+
+        #: (x, y, z) of the cells both sides changed in incompatible ways.  They hold our version, plus
+        #: a change marker.
+        self.conflicts = []
+
+        #: z-levels both sides added, removed or resized differently.  They hold our version.
+        self.level_conflicts = []
+
+        self.types = TileTypes()
+
+        # Their instance ID -> ours, and resolved (base, ours, theirs) tile ID triples.
+        self._imported = {}
+        self._resolved = {}
+        self._marker = None
+        self._removed = set()
+
+    def Merge(self):
+        '''
+        :returns Map: The merged map.  ours and theirs are left alone.
+        '''
+        self.merged = self.ours.Snapshot()
+        luts = [self.types.AddMap(m) for m in (self.base, self.ours, self.theirs)]
+        nz = max(len(self.base.zLevels), len(self.ours.zLevels), len(self.theirs.zLevels))
+        for z in xrange(nz):
+            layers = [m.zLevels[z] if z < len(m.zLevels) else None for m in (self.base, self.ours, self.theirs)]
+            arrays = [numpy.asarray(layer.tiles) if layer is not None else None for layer in layers]
+            ids = [lut[a] if a is not None else None for lut, a in zip(luts, arrays)]
+            if any(a is None for a in arrays) or len(set(a.shape for a in arrays)) > 1:
+                self._MergeLevel(z, layers, ids)
+            else:
+                self._MergeCells(z, arrays, ids)
+        # Levels theirs removed, which can only go from the end.
+        while len(self.merged.zLevels) - 1 in self._removed:
+            self._removed.remove(len(self.merged.zLevels) - 1)
+            self.merged.zLevels.pop()
+        for z in sorted(self._removed):
+            self.log.warning('z={}: They removed the z-level, but we changed a later one.  Keeping ours.'.format(z))
+            self.level_conflicts.append(z)
+        return self.merged
+
+    def _MergeLevel(self, z, layers, ids):
+        '''Merge a z-level that is missing or sized differently on one of the sides, as a whole.'''
+        base, ours, theirs = ids
+        same = lambda a, b: (a is None and b is None) or (a is not None and b is not None and a.shape == b.shape and (a == b).all())
+        if same(theirs, base) or same(ours, theirs):
+            return
+        if not same(ours, base):
+            self.log.warning('z={}: Both sides changed the size of the z-level, keeping ours.'.format(z))
+            self.level_conflicts.append(z)
+            return
+        if theirs is None:
+            self._removed.add(z)
+            return
+        tiles = numpy.asarray(layers[2].tiles)
+        lut = self.merged.ImportTiles(self.theirs, numpy.unique(tiles).tolist())
+        tiles = lut.astype(TileIDType(len(self.merged.tiles) - 1))[tiles]
+        if z < len(self.merged.zLevels):
+            self.merged.zLevels[z].SetArray(tiles)
+        else:
+            self.merged.CreateZLevel(0, 0, tiles=tiles)
+        self.stats['theirs'] += tiles.size
+
+    def _MergeCells(self, z, arrays, ids):
+        base, ours, theirs = ids
+        ours_changed = ours != base
+        theirs_changed = theirs != base
+        theirs_only = theirs_changed & ~ours_changed
+        both = ours_changed & theirs_changed
+        same = both & (ours == theirs)
+        both &= ~same
+        self.stats['ours'] += int((ours_changed & ~theirs_changed).sum())
+        self.stats['theirs'] += int(theirs_only.sum())
+        self.stats['same'] += int(same.sum())
+
+        xs, ys = numpy.nonzero(theirs_only)
+        traw = arrays[2][xs, ys]
+        lut = self.merged.ImportTiles(self.theirs, numpy.unique(traw).tolist())
+        values = [lut[traw]]
+        cells = [(xs, ys)]
+
+        cxs, cys = numpy.nonzero(both)
+        if len(cxs):
+            braw, oraw, traw = [a[cxs, cys].astype(numpy.int64) for a in arrays]
+            no, nt = len(self.ours.tiles), len(self.theirs.tiles)
+            groups, inverse = numpy.unique((braw * no + oraw) * nt + traw, return_inverse=True)
+            results = numpy.empty(len(groups), dtype=numpy.int64)
+            conflicted = numpy.zeros(len(groups), dtype=bool)
+            for i, key in enumerate(groups.tolist()):
+                rest, ttid = divmod(key, nt)
+                btid, otid = divmod(rest, no)
+                results[i], conflicted[i] = self._MergeTile(btid, otid, ttid)
+            values.append(results[inverse])
+            cells.append((cxs, cys))
+            bad = conflicted[inverse]
+            self.stats['merged'] += int((~bad).sum())
+            self.stats['conflicts'] += int(bad.sum())
+            self.conflicts += [(x, y, z) for x, y in zip(cxs[bad].tolist(), cys[bad].tolist())]
+
+        xs = numpy.concatenate([c[0] for c in cells])
+        ys = numpy.concatenate([c[1] for c in cells])
+        self.merged.zLevels[z].SetCells(xs, ys, numpy.concatenate(values))
+
+    def _Import(self, iid):
+        '''One of their instances, as an instance ID of the merged map.'''
+        if iid not in self._imported:
+            self._imported[iid] = self.merged.UpdateAtom(self.theirs.instances[iid].copy(toNewMap=True))
+        return self._imported[iid]
+
+    def _MergeTile(self, btid, otid, ttid):
+        '''
+        Merge the atoms of a cell both sides changed.  Atoms only they added or removed are added or
+        removed from ours; anything else both sides changed is a conflict.
+
+        :returns tuple: (merged tile ID, whether it conflicted)
+        '''
+        key = (btid, otid, ttid)
+        if key in self._resolved:
+            return self._resolved[key]
+        bkeys = self.types.GetTileAtomKeys(self.base, btid)
+        okeys = self.types.GetTileAtomKeys(self.ours, otid)
+        tkeys = self.types.GetTileAtomKeys(self.theirs, ttid)
+        bcount, ocount, tcount = [_CountKeys(keys) for keys in (bkeys, okeys, tkeys)]
+
+        # Ours are the merged map's instances already, since it is a snapshot of ours.
+        result = list(okeys)
+        added = []
+        conflict = False
+        seen = set()
+        for akey, _ in okeys + tkeys + bkeys:
+            if akey in seen:
+                continue
+            seen.add(akey)
+            b, o, t = bcount.get(akey, 0), ocount.get(akey, 0), tcount.get(akey, 0)
+            if t == b or t == o:
+                continue
+            if o != b:
+                conflict = True
+            elif t < o:
+                for _ in xrange(o - t):
+                    i = max(j for j, (k, _) in enumerate(result) if k == akey)
+                    del result[i]
+            else:
+                theirs = [iid for k, iid in tkeys if k == akey]
+                added += [(akey, self._Import(iid)) for iid in theirs[:t - o]]
+        for path in EXCLUSIVE_PATHS:
+            # Both sides replacing the turf or area with different ones: keep ours.
+            if any(k.startswith(path) for k, _ in result) and any(k.startswith(path) for k, _ in added):
+                added = [(k, iid) for k, iid in added if not k.startswith(path)]
+                conflict = True
+        instances = [iid for _, iid in result + added]
+        if conflict:
+            instances.append(self._GetMarker())
+        tile = self.merged.CreateTile()
+        tile.instances = instances
+        self._resolved[key] = (self.merged.UpdateTile(tile), conflict)
+        return self._resolved[key]
+
+    def _GetMarker(self):
+        if self._marker is None:
+            marker = Atom(CHANGE_MARKER)
+            marker.setProperty('tag', 'merge', flags=PropertyFlags.MAP_SPECIFIED)
+            self._marker = self.merged.UpdateAtom(marker)
+        return self._marker
+
+def _CountKeys(keys):
+    counts = {}
+    for key, _ in keys:
+        counts[key] = counts.get(key, 0) + 1
+    return counts
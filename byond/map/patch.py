@@ -0,0 +1,270 @@
+'''
+Map patches.
+
+A .dmmpatch (written by :class:`byond.map.diff.MapDiff`) lists, per cell, the hashes of the tile before
+and after the change and the atoms to remove and add::
+
+    <x,y,z>
+     @CHECK before-hash after-hash (serialized tile)
+     -ALL
+     +2 /obj/item{name = "x"}
+     - /obj/item
+
+:class:`MapPatch` compiles a patch once: atoms are kept as deduplicated text, and cells with the same
+instructions share one operation sequence.  Applying it parses each atom once per target map, works out
+each distinct (tile type, operation sequence) transformation once, and writes the results to the
+z-level arrays in bulk.
+'''
+import os, re, logging, weakref
+import numpy
+
+from byond.basetypes import Atom, PropertyFlags
+from byond.map.format.dmm import DMMFormat, TokenizeTileChunk
+
+REG_INSTRUCTION = re.compile(r'^(?P<change>[\+\-])(?P<amount>[0-9\*]+)?\s+(?P<atom>/.*)')
+
+#: Marker added to tiles overwritten by a clobbering patch.
+CHANGE_MARKER = '/obj/effect/byondtools/changed'
+
+class MapPatch(object):
+    def __init__(self, filename=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.filename = filename
+
+        #: Atom chunks used by the patch, deduplicated.
+        self.atoms = []
+        self._atom_index = {}
+
+        #: Operation sequences, deduplicated.  Each is a tuple of (change, amount, atom index)
+        #: operations; amount None means all of them, atom None means every atom (-ALL).
+        self.sequences = []
+        self._sequence_index = {}
+
+        #: (before hash, after hash, atom indices of the patched tile) of the @CHECK lines, deduplicated.
+        self.checks = []
+        self._check_index = {}
+
+        # Per cell: x, y, z, pass, operation sequence, check (-1 for none) and line number.  A cell
+        # that appears more than once is patched again in a later pass.
+        self.cells = None
+
+        # Target map -> (parsed atom per atom chunk, DMMFormat).
+        self._parsed = weakref.WeakKeyDictionary()
+
+        if filename is not None:
+            with open(filename) as f:
+                self.Parse(f)
+
+    def _Intern(self, index, table, value):
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(table)
+            table.append(value)
+        return i
+
+    def Parse(self, lines):
+        '''
+        Compile patch text.
+
+        :param lines iterable:
+            Lines of the patch, such as an open file.
+        '''
+        cells = []
+        seen = {}
+        block = None
+        ops = []
+        def endBlock():
+            if block is not None:
+                block[4] = self._Intern(self._sequence_index, self.sequences, tuple(ops))
+                cells.append(block)
+        ln = 0
+        for line in lines:
+            ln += 1
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if line.startswith('<') and line.endswith('>'):
+                endBlock()
+                x, y, z = [int(coord) for coord in line.strip('<>').split(',')]
+                npass = seen.get((x, y, z), 0)
+                seen[(x, y, z)] = npass + 1
+                block = [x, y, z, npass, 0, -1, ln]
+                ops = []
+                continue
+            if block is None:
+                raise ValueError('{}:{}: Instruction outside of a tile block: {}'.format(self.filename, ln, line))
+            if line.startswith('@CHECK'):
+                _, before, after, serdata = line.split(' ', 3)
+                try:
+                    tokens = TokenizeTileChunk(serdata.strip()[1:-1])
+                except ValueError as e:
+                    raise ValueError('{}:{}: {}'.format(self.filename, ln, e))
+                result = tuple(self._Intern(self._atom_index, self.atoms, chunk) for chunk, _, _ in tokens)
+                block[5] = self._Intern(self._check_index, self.checks, (before, after, result))
+                continue
+            if line == '-ALL':
+                ops.append(('-', None, None))
+                continue
+            m = REG_INSTRUCTION.match(line)
+            if m is None:
+                raise ValueError('{}:{}: Malformed instruction: {}'.format(self.filename, ln, line))
+            amount = m.group('amount')
+            if amount == '*':
+                amount = None
+            else:
+                amount = int(amount or 1)
+            ops.append((m.group('change'), amount, self._Intern(self._atom_index, self.atoms, m.group('atom'))))
+        endBlock()
+        self.cells = numpy.array(cells, dtype=numpy.int64).reshape(-1, 7)
+
+    def _Parse(self, _map):
+        '''Parse our atoms for a map, once per map.'''
+        parsed = self._parsed.get(_map)
+        if parsed is None:
+            fmt = DMMFormat(_map)
+            fmt.filename = self.filename
+            atoms = []
+            for chunk in self.atoms:
+                atom = fmt.consumeAtom(chunk)
+                if atom is None:
+                    self.log.warning('{}: Unable to parse instance specified by chunk {}'.format(self.filename, chunk))
+                atoms.append(atom)
+            parsed = self._parsed[_map] = (atoms, fmt)
+        return parsed
+
+    def Transform(self, _map, ids, tid, seq):
+        '''
+        Apply an operation sequence to a tile type.
+
+        :param ids list:
+            Instance ID in the map of each of our atoms.
+        :returns tuple: (instance IDs of the new tile, atoms added, atoms removed)
+        '''
+        instances = list(_map.tiles[tid].instances)
+        added = removed = 0
+        for change, amount, aidx in self.sequences[seq]:
+            if aidx is None:
+                removed += len(instances)
+                instances = []
+                continue
+            iid = ids[aidx]
+            if iid is None:
+                continue
+            if change == '-':
+                count = instances.count(iid)
+                if amount is not None:
+                    count = min(count, amount)
+                for _ in xrange(count):
+                    instances.remove(iid)
+                removed += count
+            else:
+                instances += [iid] * (amount or 1)
+                added += amount or 1
+        return instances, added, removed
+
+    def _Register(self, _map, instances):
+        tile = _map.CreateTile()
+        tile.instances = instances
+        return _map.UpdateTile(tile)
+
+    def _Clobber(self, _map, ids, check, ln):
+        '''Overwrite a cell with the tile the patch expected, plus a change marker.'''
+        marker = Atom(CHANGE_MARKER)
+        marker.setProperty('tag', '{}:{}'.format(self.filename, ln), flags=PropertyFlags.MAP_SPECIFIED)
+        instances = [ids[i] for i in self.checks[check][2] if ids[i] is not None]
+        return self._Register(_map, instances + [_map.UpdateAtom(marker)])
+
+    def Apply(self, _map, clobber=False):
+        '''
+        Apply the patch to a map.
+
+        Cells that already match the patched tile are skipped.  Cells that match neither the tile the
+        patch was made against nor the result are conflicts: the operations are applied anyway, with a
+        warning, or with *clobber*, the cell is overwritten with the patched tile and a change marker.
+
+        :param _map Map:
+        :param clobber bool:
+        :returns dict:
+            cells: cells changed.  added/removed: atoms added and removed.  skipped: cells already
+            patched.  conflicts: cells changed since the patch was made.
+        '''
+        stats = {'cells': 0, 'added': 0, 'removed': 0, 'skipped': 0, 'conflicts': 0}
+        if self.cells is None or len(self.cells) == 0:
+            return stats
+        # Instance IDs change when the map is compacted, so look them up on every call.
+        ids = [_map.UpdateAtom(atom) if atom is not None else None for atom in self._Parse(_map)[0]]
+        hashes = {}
+        def getHash(tid):
+            if tid not in hashes:
+                hashes[tid] = _map.GetTileByID(tid).GetHash()
+            return hashes[tid]
+        nseq = len(self.sequences)
+        nchk = len(self.checks) + 1
+        for z in numpy.unique(self.cells[:, 2]).tolist():
+            if z >= len(_map.zLevels):
+                self.log.warning('{}: Skipping z={}, the map only has {} z-levels.'.format(self.filename, z, len(_map.zLevels)))
+                continue
+            layer = _map.zLevels[z]
+            zcells = self.cells[self.cells[:, 2] == z]
+            if not ((zcells[:, 0] < layer.width) & (zcells[:, 1] < layer.height)).all():
+                raise IndexError('{}: Patch goes past the edge of z-level {} ({}x{}).'.format(self.filename, z, layer.width, layer.height))
+            for npass in numpy.unique(zcells[:, 3]).tolist():
+                cells = zcells[zcells[:, 3] == npass]
+                xs, ys = cells[:, 0], cells[:, 1]
+                tids = numpy.asarray(layer.tiles)[xs, ys].astype(numpy.int64)
+                keys = (tids * nseq + cells[:, 4]) * nchk + cells[:, 5] + 1
+                groups, inverse = numpy.unique(keys, return_inverse=True)
+                counts = numpy.bincount(inverse)
+                results = numpy.empty(len(groups), dtype=numpy.int64)
+                conflicted = []
+                for i, key in enumerate(groups.tolist()):
+                    tid, rest = divmod(key, nseq * nchk)
+                    seq, check = divmod(rest, nchk)
+                    check -= 1
+                    n = int(counts[i])
+                    if check >= 0:
+                        before, after, _ = self.checks[check]
+                        curhash = getHash(tid)
+                        if curhash == after:
+                            stats['skipped'] += n
+                            results[i] = tid
+                            continue
+                        if curhash != before:
+                            stats['conflicts'] += n
+                            if clobber:
+                                results[i] = tid
+                                conflicted.append(i)
+                                continue
+                            for x, y in zip(xs[inverse == i].tolist(), ys[inverse == i].tolist()):
+                                self.log.warning('<{},{},{}> has changed.  Operations on this tile may not be accurate!'.format(x, y, z))
+                    instances, added, removed = self.Transform(_map, ids, tid, seq)
+                    if check >= 0 and curhash == before:
+                        # Take the patched tile as written, so atoms end up in the same order.
+                        instances = [ids[j] for j in self.checks[check][2] if ids[j] is not None]
+                    results[i] = self._Register(_map, instances)
+                    stats['added'] += added * n
+                    stats['removed'] += removed * n
+                new = results[inverse]
+                for i in conflicted:
+                    for j in numpy.flatnonzero(inverse == i).tolist():
+                        new[j] = self._Clobber(_map, ids, int(cells[j, 5]), int(cells[j, 6]))
+                changed = new != tids
+                if changed.any():
+                    layer.SetCells(xs[changed], ys[changed], new[changed])
+                    stats['cells'] += int(changed.sum())
+        return stats
+
+_compiled = {}
+def CompilePatch(filename):
+    '''
+    Load a .dmmpatch, reusing the compiled form while the file is unchanged.
+
+    :rtype MapPatch:
+    '''
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = (st.st_mtime, st.st_size)
+    cached = _compiled.get(filename)
+    if cached is None or cached[0] != key:
+        cached = _compiled[filename] = (key, MapPatch(filename))
+    return cached[1]
@@ -1,6 +1,14 @@
-import hashlib, ast, os, time, sys
+import hashlib, ast, os, time, sys, gzip, bz2
 import operator as op
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 def clock():
     if sys.platform == 'win32':
         return time.clock()
@@ -21,6 +29,51 @@ def md5sum(filename):
 operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
              ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor}
 
+#: Extension -> compression, for files handled by openFile().
+COMPRESSION_EXTS = {
+    '.gz': 'gz',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+}
+
+def splitCompression(filename):
+    '''
+    'station.dmm.gz' -> ('station.dmm', 'gz').  Uncompressed files give (filename, None).
+    '''
+    base, ext = os.path.splitext(filename)
+    compression = COMPRESSION_EXTS.get(ext.lower(), None)
+    if compression is None:
+        return filename, None
+    return base, compression
+
+def openFile(filename, mode='r', compression=None, level=9):
+    '''
+    Open a file, streaming it through gzip, bz2 or lzma if it has one of their extensions.
+    
+    :param compression str:
+        'gz', 'bz2' or 'xz' to use instead of guessing from the extension.
+    :param level int:
+        Compression level (1-9) when writing.
+    '''
+    if compression is None:
+        _, compression = splitCompression(filename)
+    if compression is None:
+        return open(filename, mode)
+    # None of these do newline translation, and text is all we write anyway.
+    mode = mode.replace('t', '').replace('b', '') + 'b'
+    if compression == 'gz':
+        return gzip.open(filename, mode, compresslevel=level)
+    if compression == 'bz2':
+        return bz2.BZ2File(filename, mode, compresslevel=level)
+    if compression == 'xz':
+        if lzma is None:
+            raise IOError('{} needs lzma (pip install backports.lzma on Python 2).'.format(filename))
+        if 'w' in mode:
+            return lzma.open(filename, mode, preset=level)
+        return lzma.open(filename, mode)
+    raise ValueError('Unknown compression {!r}'.format(compression))
+
 def eval_expr(expr):
     """
     >>> eval_expr('2^6')
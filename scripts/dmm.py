@@ -27,6 +27,8 @@ import sys, argparse, os, re
 from byond import ObjectTree, Map, MapRenderFlags
 from byond.basetypes import Atom, PropertyFlags
 from byond.map.format.dmm import DMMFormat
+from byond.map.diff import MapDiff
+from byond.map.patch import CompilePatch
 
 def main():
     dmmt = DMMFormat(None)
@@ -50,6 +52,12 @@ def main():
     _patch.add_argument('patches', action='append', nargs='+', help='Patch(es) to apply.', metavar='patch.dmmpatch')
     _patch.add_argument('map', type=str, help='The map to change.', metavar='map.dmm')
     
+    _merge = command.add_parser('merge', help='Three-way merge of two edited versions of a map.  Exits with 1 if there were conflicts, like a git merge driver.')
+    _merge.add_argument('-O', '--output', dest='output', type=str, help='Where to place the merged map. (Default is to overwrite ours)', metavar='merged.dmm', nargs='?')
+    _merge.add_argument('base', type=str, help='The version both sides started from.', metavar='base.dmm')
+    _merge.add_argument('ours', type=str, help='Our version.', metavar='ours.dmm')
+    _merge.add_argument('theirs', type=str, help='Their version.', metavar='theirs.dmm')
+    
     _analyze = command.add_parser('analyze', help='Generate a report of each atom on a map.  WARNING: huge')
     _analyze.add_argument('map', type=str, help='Map to analyze.', metavar='map.dmm')
     
@@ -57,6 +65,14 @@ def main():
     #_split.add_argument('-i','--isolate', help='Isolate a given z-level', metavar='NUM')
     _split.add_argument('map', type=str, help='Map to split.', metavar='map.dmm')
     
+    _join = command.add_parser('join', help='Stack the z-levels of several maps into one.')
+    _join.add_argument('-O', '--output', dest='output', type=str, required=True, help='Where to place the joined map.', metavar='joined.dmm')
+    _join.add_argument('maps', type=str, nargs='+', help='Maps to join, in z order.', metavar='map.dmm')
+    
+    _stats = command.add_parser('stats', help='Count tile types, atom types and areas on a map.')
+    _stats.add_argument('-z', dest='z', type=int, default=None, help='Only count this z-level (1-based).', metavar='NUM')
+    _stats.add_argument('map', type=str, help='Map to count.', metavar='map.dmm')
+    
     args = opt.parse_args()
     if args.MODE == 'diff':
         compare_dmm(args)
@@ -64,10 +80,16 @@ def main():
         analyze_dmm(args)
     elif args.MODE == 'split':
         split_dmm(args)
+    elif args.MODE == 'join':
+        join_dmm(args)
     elif args.MODE == 'patch':
         patch_dmm(args)
+    elif args.MODE == 'merge':
+        merge_dmm(args)
     elif args.MODE == 'transcribe':
         transcribe_dmm(args)
+    elif args.MODE == 'stats':
+        stats_dmm(args)
     else:
         print('!!! Error, unknown MODE=%r' % args.MODE)
         
@@ -85,6 +107,26 @@ def transcribe_dmm(args):
     dmm.Load(args.subject, format='dmm')
     dmm.Save(outfile, format='dmm', serialize_cleanly=True)
         
+def stats_dmm(args):
+    if not os.path.isfile(args.map):
+        print('File {0} does not exist.'.format(args.map))
+        sys.exit(1)
+    
+    dmm = Map(forgiving_atom_lookups=True)
+    dmm.Load(args.map, format='dmm')
+    
+    levels = range(len(dmm.zLevels)) if args.z is None else [args.z - 1]
+    for z in levels:
+        stats = dmm.Stats(z)
+        print('z={}: {} cells, {} tile types, {} areas'.format(z + 1, stats['cells'], stats['distinct'], len(stats['areas'])))
+    stats = dmm.Stats(None if args.z is None else args.z - 1)
+    print('Atoms:')
+    for path, count in sorted(stats['atoms'].items(), key=lambda item: (-item[1], item[0])):
+        print('  {:>8} {}'.format(count, path))
+    print('Areas:')
+    for path, count in sorted(stats['areas'].items(), key=lambda item: (-item[1], item[0])):
+        print('  {:>8} {}'.format(count, path))
+        
 def split_dmm(args):
     if not os.path.isfile(args.map):
         print('File {0} does not exist.'.format(args.mine))
@@ -103,17 +145,23 @@ def split_dmm(args):
         basename,ext = os.path.splitext(args.map)
         outfile='{0}-{1}{2}'.format(basename,z+1,ext)
         print('>>> Splitting z={}/{} to {}'.format(z+1,nz,outfile))
-        output = Map(forgiving_atom_lookups=True)
-        currentZLevel = dmm.zLevels[z]
-        newZLevel = output.CreateZLevel(currentZLevel.height, currentZLevel.width)
-        #newZLevel.initial_load=True
-        for y in range(currentZLevel.width):
-            for x in range(currentZLevel.height):
-                newTile = newZLevel.GetTile(x, y)
-                for atom in currentZLevel.GetTile(x,y).GetAtoms():
-                    newTile.AppendAtom(atom.copy(toNewMap=True))
-        #newZLevel.initial_load=False
-        output.Save(outfile, format='dmm')
+        dmm.ExtractZ(z).Save(outfile, format='dmm')
+
+def join_dmm(args):
+    for filename in args.maps:
+        if not os.path.isfile(filename):
+            print('File {0} does not exist.'.format(filename))
+            sys.exit(1)
+    
+    maps = []
+    for filename in args.maps:
+        dmm = Map(forgiving_atom_lookups=True)
+        dmm.Load(filename, format='dmm')
+        maps.append(dmm)
+    
+    joined = Map.JoinZ(maps)
+    print('>>> Joined {} z-levels to {}'.format(len(joined.zLevels), args.output))
+    joined.Save(args.output, format='dmm')
 
 def patch_dmm(args):
     print(repr(args.patches))
@@ -123,7 +171,7 @@ def patch_dmm(args):
             print('File {0} does not exist.'.format(patch))
             sys.exit(1)
     if not os.path.isfile(args.map):
-        print('File {0} does not exist.'.format(args.mine))
+        print('File {0} does not exist.'.format(args.map))
         sys.exit(1)
     if not os.path.isfile(args.project):
         print('DM Environment File {0} does not exist.'.format(args.project))
@@ -132,123 +180,44 @@ def patch_dmm(args):
     dmm = Map(forgiving_atom_lookups=True)
     dmm.Load(args.map, format='dmm')
     
-    fmt = DMMFormat(dmm)
-
-    context = None
-    added = 0
-    removed = 0
-    
-    currentpatch = ''
+    for patch in args.patches[0]:
+        print('* Applying {}...'.format(patch))
+        try:
+            stats = CompilePatch(patch).Apply(dmm, clobber=args.clobber)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(' {} tiles changed: +{} -{} ({} already applied, {} conflicts)'.format(stats['cells'], stats['added'], stats['removed'], stats['skipped'], stats['conflicts']))
     
-    def changeMarker(ln):
-        a = Atom('/obj/effect/byondtools/changed')
-        a.setProperty('tag','{}:{}'.format(currentpatch,ln),flags=PropertyFlags.MAP_SPECIFIED)
-        return a
+    dmm.Compact()
+    print('Saving...')
+    dmm.Save(args.output if args.output else args.map)
     
-    def printReport(context, added, removed):
-        if context is not None:
-            x, y, z = context
-            print(' Z={} +{} -{}'.format(z, added, removed))
+def merge_dmm(args):
+    for filename in (args.base, args.ours, args.theirs):
+        if not os.path.isfile(filename):
+            print('File {0} does not exist.'.format(filename))
+            sys.exit(1)
+        
+    maps = []
+    for filename in (args.base, args.ours, args.theirs):
+        dmm = Map(forgiving_atom_lookups=True)
+        dmm.Load(filename, format='dmm')
+        maps.append(dmm)
     
-    REG_INSTRUCTION = re.compile(r'^(?P<change>[\+\-])(?P<amount>[0-9\*]+)?\s+(?P<atom>/.*)')
-    
-    for i in range(len(args.patches[0])):
-        patch=args.patches[0][i]
-        print('* Applying {}...'.format(patch))
-        currentpatch=patch
-        with open(patch) as f:
-            ln = 0
-            lz = -1
-            skip_block = False
-            for line in f:
-                ln += 1
-                line = line.strip()
-                if line == '': continue
-                if line.startswith('#'): continue
-                if line.startswith('<') and line.endswith('>'):
-                    strcoords = line.strip('<>').split(',')
-                    newcoords = []
-                    for coord in strcoords:
-                        newcoords += [int(coord)]
-                    if context is not None and lz != context[2]:
-                        printReport(context, added, removed)
-                        lz = context[2]
-                        added = removed = 0
-                    context = newcoords
-                    skip_block = False
-                    continue
-                if line.startswith('@') and not skip_block:
-                    # @CHECK before-hash after-hash atoms-block
-    
-                    x, y, z = context
-                    
-                    if line.startswith('@CHECK'):
-                        _, beforehash, afterhash, serdata = line.split(' ', 3)
-                        
-                        if args.clobber:
-                            #print('WARNING: <{},{},{}> has changed and will be overwritten. (--clobber)'.format(x, y, z))
-                            t=fmt.consumeTileChunk(serdata, cache=False)
-                            t.AppendAtom(changeMarker(ln))
-                            dmm.SetTileAt(x, y, z, t)
-                            skip_block = True
-                            continue
-                        curhash = dmm.GetTileAt(x, y, z).GetHash()
-                        if afterhash == curhash:
-                            print('Skipping <{},{},{}> (already what we expected)'.format(x, y, z))
-                            skip_block = True
-                            continue
-                        #else: print('PRE {} != {}: OK'.format(curhash,afterhash))
-                        if beforehash != curhash:
-                            print('WARNING: <{},{},{}> has changed.  Operations on this tile may not be accurate!'.format(x, y, z))
-                            continue
-                        #else: print('OLD {} == {}: OK'.format(curhash,beforehash))
-                              
-                if not skip_block and (line.startswith('+') or line.startswith('-')):
-                    if line == '-ALL':
-                        dmm.SetTileAt(x, y, z, dmm.CreateTile())
-                        continue
-                    m = REG_INSTRUCTION.match(line)
-                    if m is None:
-                        print('{}:{}: MALFORMED INSTRUCTION: {}'.format(args.patch, ln, line))
-                        sys.exit(1)
-                    amount = m.group('amount')
-                    if amount == '*':
-                        amount = 9999
-                    else:
-                        amount = int(m.group('amount') or 1)
-                    change = m.group('change')
-                    
-                    atom = fmt.consumeAtom(m.group('atom'), ln)
-                    atom.filename = args.patch
-                    atom.line = ln
-                    if atom is None:
-                        print('{}:{}: WARNING: Unable to parse instance specified by chunk {}'.format(args.patch, ln, m.group('atom')))
-                        continue
-    
-                    x, y, z = context
-                    if x == 0 and y == 0 and z == 0:
-                        print('WE AT <0,0,0> SOMEFIN WRONG')
-                        
-                    if z >= len(dmm.zLevels): continue
-                    
-                    tile = dmm.GetTileAt(x, y, z)
-                    if change == '-':
-                        for _ in range(amount):
-                            if tile.CountAtom(atom) > 0:
-                                tile.RemoveAtom(atom, hash=False)
-                                removed += 1
-                            else: break
-                    elif change == '+':
-                        for _ in range(amount):
-                            tile.AppendAtom(atom, hash=False)
-                        added += amount
-                    tile.UpdateHash()
-                    # dmm.SetTileAt(x, y, z, tile)
-                    # print('{} - {}'.format((x,y,z),tile))
-            printReport(context, added, removed)
+    print('Merging maps...')
+    merged, merge = Map.Merge3(*maps)
+    print(' {ours} tiles from ours, {theirs} from theirs, {same} changed the same, {merged} merged, {conflicts} conflicts.'.format(**merge.stats))
+    for x, y, z in merge.conflicts:
+        print('CONFLICT <{},{},{}>'.format(x, y, z))
+    for z in merge.level_conflicts:
+        print('CONFLICT: Both sides changed the size of z-level {}, kept ours.'.format(z))
     
+    merged.Compact()
     print('Saving...')
-    dmm.Save(args.output if args.output else args.map)
+    merged.Save(args.output if args.output else args.ours)
+    if merge.conflicts or merge.level_conflicts:
+        sys.exit(1)
     
 def compare_dmm(args):
     if not os.path.isfile(args.theirs):
@@ -270,114 +239,20 @@ def compare_dmm(args):
     ttitle, _ = os.path.splitext(os.path.basename(args.theirs))
     mtitle, _ = os.path.splitext(os.path.basename(args.mine))
     
-    format = DMMFormat(theirs_dmm)
-    
     output = '{} - {}.dmmpatch'.format(ttitle, mtitle)
     
     if args.output:
         output = args.output
+    print('Comparing maps...')
+    diff = MapDiff(theirs_dmm, mine_dmm)
+    for z in diff.mismatched:
+        t_zlev = theirs_dmm.zLevels[z]
+        m_zlev = mine_dmm.zLevels[z]
+        print('!!! ZLEVEL {} HEIGHT/WIDTH MISMATCH: ({},{}) != ({},{})'.format(z, t_zlev.height, t_zlev.width, m_zlev.height, m_zlev.width))
     with open(output, 'w') as f:
-        stats = {
-            'diffs':0,
-            'tilediffs':0,
-            'tiles':0,
-            'atoms':0
-        }
-        print('Comparing maps...')
-        for z in xrange(len(theirs_dmm.zLevels)):
-            t_zlev = theirs_dmm.zLevels[z]
-            m_zlev = mine_dmm.zLevels[z]
-            if t_zlev.height != m_zlev.height or t_zlev.width != m_zlev.width:
-                print('!!! ZLEVEL {} HEIGHT/WIDTH MISMATCH: ({},{}) != ({},{})'.format(z, t_zlev.height, t_zlev.width, m_zlev.height, m_zlev.width))
-                continue
-            print(" Scanning z-level {} ({}x{})...".format(z, t_zlev.height, t_zlev.width))
-            for y in range(t_zlev.height):
-                for x in range(t_zlev.width):
-                    CHANGES = {}
-                    
-                    tTile = theirs_dmm.GetTileAt(x, y, z)
-                    # if tTile is None:
-                    #    print('!!! THEIRS <{},{},{}>: Tile object is None!'.format(x, y, z))
-                    #    #return
-                    mTile = mine_dmm.GetTileAt(x, y, z)
-                    # if tTile is None:
-                    #    print('!!! MINE <{},{},{}>: Tile object is None!'.format(x, y, z))
-                    #    #return
-                    
-                    theirs = {}
-                    mine = {}
-                    all_keys = set()
-                    
-                    if tTile:
-                        for A in tTile.GetAtoms():
-                            key = format.SerializeAtom(A)
-                            all_keys.add(key)
-                            if key not in theirs:
-                                theirs[key] = [A, 0]
-                            theirs[key][1] += 1
-                    if mTile:
-                        for A in mTile.GetAtoms():
-                            key = format.SerializeAtom(A)
-                            all_keys.add(key)
-                            if key not in mine:
-                                mine[key] = [A, 0]
-                            mine[key][1] += 1
-
-                    removals = set()
-                    additions = set()
-                    kept = {}
-                    
-                    for key in all_keys:
-                        change = None
-                        minecount = 0
-                        if key in mine:
-                            minecount = mine[key][1]
-                        theircount = 0
-                        if key in theirs:
-                            theircount = theirs[key][1]
-                        delta = minecount - theircount
-                        if delta < 0:
-                            change = '-'
-                            removals.add(key)
-                        elif delta > 0:
-                            change = '+'
-                            additions.add(key)
-                        if minecount > 0 and delta <= 0:
-                            kept[key] = minecount
-                        if change is not None:
-                            CHANGES[key] = [change, abs(delta), minecount, theircount]
-                        stats['tiles'] += 1
-                    
-                    def writeChanges(f, source, CHANGES):
-                        for key in source:
-                            change, amount, mc, tc = CHANGES[key]
-                            # change, amount, _, _ = changedat
-                            # f.write(' # {} vs {}\n'.format(mc, tc))
-                            abs_amt = abs(amount)
-                            if abs_amt > 1:
-                                f.write(' {}{} {}\n'.format(change, abs_amt if mc > 0 else '*', key))
-                            else:
-                                f.write(' {} {}\n'.format(change, key))
-                            stats['diffs'] += abs_amt
-                            
-                    if len(CHANGES) > 0:
-                        f.write('<{},{},{}>\n'.format(x, y, z))
-                        stats['tilediffs'] += 1
-                        f.write(' @CHECK {before} {after} {tiledat}\n'.format(before=tTile.GetHash(), after=mTile.GetHash(), tiledat=format.SerializeTile(mTile)))
-                        if len(kept) == 0:
-                            f.write(' -ALL\n')
-                        else:
-                            writeChanges(f, removals, CHANGES)
-                        """
-                        for key,count in kept.items():
-                            if count > 1:
-                                f.write(' ={} {}\n'.format(count, key))
-                            else:
-                                f.write(' = {}\n'.format(key))
-                        """
-                        writeChanges(f, additions, CHANGES)
-        print('Compared maps: {} differences in {} tiles.'.format(stats['diffs'], stats['tilediffs']))
-        print('Total: {} atoms, {} tiles.'.format(stats['diffs'], stats['tilediffs']))
+        stats = diff.WritePatch(f)
+    print('Compared maps: {} differences in {} tiles.'.format(stats['diffs'], stats['tilediffs']))
+    print('Total: {} atoms, {} tiles.'.format(stats['diffs'], stats['tilediffs']))
 
 
 def analyze_dmm(args):
@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+'''
+Usage:
+    $ python dmmbench.py dict [--entries 20000] [map.dmm]
+    $ python dmmbench.py load [--size 255] [--levels 7] [--workers 4] [map.dmm]
+    $ python dmmbench.py save [--size 255] [--levels 7] [map.dmm]
+    $ python dmmbench.py read [--size 255] [--levels 1] [map.dmm]
+    $ python dmmbench.py edit [--size 255] [--levels 1] [map.dmm]
+    $ python dmmbench.py memory [--entries 20000] [--vars 300]
+    $ python dmmbench.py find [--size 255] [--levels 1] [--type /obj/machinery] [map.dmm]
+
+dmmbench.py - Throughput benchmarks for the DMM map code.
+
+Without a map, a synthetic /vg/-sized dictionary is generated so runs are
+comparable between machines.
+'''
+import argparse, gc, logging, os, random, resource, StringIO, sys, tempfile, time
+
+from byond.map import Map
+from byond.map.diff import MapDiff
+from byond.map.patch import CompilePatch
+from byond.map.format.dmm import DMMFormat, TokenizeTileChunk
+from byond.objtree import ObjectTree
+from byond.basetypes import Atom, BYONDString, BYONDValue
+
+SAMPLE_ATOMS = [
+    '/obj/structure/grille',
+    '/obj/structure/lattice',
+    '/obj/structure/window/reinforced{dir = 8}',
+    '/obj/structure/cable{d1 = 2; d2 = 4; icon_state = "2-4"; tag = ""}',
+    '/obj/machinery/atmospherics/pipe/simple/supply/hidden{dir = 4}',
+    '/obj/structure/sign/securearea{desc = "A warning sign which reads \'HIGH VOLTAGE\'; keep out"; icon_state = "shock"; name = "HIGH VOLTAGE"; pixel_y = -32}',
+    '/obj/machinery/door/airlock/glass{name = "Bar"; req_access_txt = "25"}',
+    '/obj/item/weapon/paper{info = "list(1, 2); {\\"x\\"}"; name = "note"}',
+]
+SAMPLE_TURFS = [
+    '/turf/space',
+    '/turf/simulated/floor{icon_state = "floorgrime"}',
+    '/turf/simulated/floor/plating',
+    '/turf/simulated/wall/r_wall',
+]
+SAMPLE_AREAS = ['/area', '/area/security/prison', '/area/crew_quarters/bar']
+
+def synthetic_dictionary(entries, seed=0):
+    '''Build tile chunks (the text between the parentheses) shaped like a real station map.'''
+    rng = random.Random(seed)
+    chunks = []
+    seen = set()
+    while len(chunks) < entries:
+        atoms = [rng.choice(SAMPLE_ATOMS) for _ in xrange(rng.randint(0, 5))]
+        atoms += [rng.choice(SAMPLE_TURFS), rng.choice(SAMPLE_AREAS)]
+        chunk = ','.join(atoms)
+        if chunk not in seen:
+            seen.add(chunk)
+            chunks.append(chunk)
+    return chunks
+
+def synthetic_map(filename, entries=2000, size=255, levels=7, seed=0):
+    '''Write a size x size x levels map using a synthetic dictionary.'''
+    rng = random.Random(seed)
+    fmt = DMMFormat(None)
+    chunks = synthetic_dictionary(entries, seed)
+    idlen = len(fmt.ID2String(len(chunks) - 1))
+    keys = [fmt.ID2String(i, idlen) for i in xrange(len(chunks))]
+    with open(filename, 'w') as f:
+        for key, chunk in zip(keys, chunks):
+            f.write('"{}" = ({})\n'.format(key, chunk))
+        for z in xrange(levels):
+            f.write('\n(1,1,{}) = {{"\n'.format(z + 1))
+            for _ in xrange(size):
+                f.write(''.join(rng.choice(keys) for _ in xrange(size)) + '\n')
+            f.write('"}\n')
+
+def dictionary_from_map(filename):
+    chunks = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.startswith('"'):
+                break
+            line = line.strip()
+            chunks.append(line[line.index('(') + 1:-1])
+    return chunks
+
+def report(label, count, unit, elapsed):
+    print('  {:<12} {:>10.0f} {}/s ({:.3f}s)'.format(label, count / elapsed, unit, elapsed))
+
+def bench_dictionary(args):
+    if args.map:
+        chunks = dictionary_from_map(args.map)
+    else:
+        chunks = synthetic_dictionary(args.entries)
+    fmt = DMMFormat(Map())
+    print('Dictionary parse, {} entries:'.format(len(chunks)))
+
+    start = time.time()
+    for chunk in chunks:
+        for atom in fmt.SplitAtoms(chunk):
+            if '{' not in atom:
+                continue
+            for prop in fmt.SplitProperties(atom.split('{', 1)[1][:-1]):
+                key, value = prop.split('=', 1)
+                fmt.consumeDataValue(value.strip())
+    report('before', len(chunks), 'entries', time.time() - start)
+
+    start = time.time()
+    for chunk in chunks:
+        for _, _, props in TokenizeTileChunk(chunk):
+            for key, value in props:
+                fmt.consumeDataValue(value)
+    report('after', len(chunks), 'entries', time.time() - start)
+
+def bench_load(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    sidecars = [os.path.splitext(filename)[0] + ext for ext in ('.dmmc', '.dmmi')]
+    try:
+        dmm = Map()
+        start = time.time()
+        dmm.Load(filename, cache=False)
+        elapsed = time.time() - start
+        cells = sum(z.width * z.height for z in dmm.zLevels)
+        print('Map load, {} levels, {} tile types:'.format(len(dmm.zLevels), len(dmm.tiles)))
+        report('text', cells, 'cells', elapsed)
+
+        start = time.time()
+        Map().Load(filename, cache=False, eager=True)
+        report('text, eager', cells, 'cells', time.time() - start)
+
+        if args.workers > 1:
+            start = time.time()
+            Map().Load(filename, cache=False, workers=args.workers)
+            report('{} workers'.format(args.workers), cells, 'cells', time.time() - start)
+
+        Map().Load(filename, cache=True)
+        start = time.time()
+        Map().Load(filename, cache=True)
+        report('cached', cells, 'cells', time.time() - start)
+
+        Map().Load(filename, z=[0], cache=True)
+        start = time.time()
+        Map().Load(filename, z=[0], cache=True)
+        elapsed = time.time() - start
+        print('  {:<12} {:.3f}s'.format('one z', elapsed))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+            for sidecar in sidecars:
+                if os.path.isfile(sidecar):
+                    os.remove(sidecar)
+
+def bench_save(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    fd, outfile = tempfile.mkstemp(suffix='.dmm')
+    os.close(fd)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        cells = sum(z.width * z.height for z in dmm.zLevels)
+        print('Map save, {} levels, {} tile types:'.format(len(dmm.zLevels), len(dmm.tiles)))
+        start = time.time()
+        dmm.Save(outfile)
+        report('first', cells, 'cells', time.time() - start)
+        # Tile types are parsed and hashed by now.
+        start = time.time()
+        dmm.Save(outfile)
+        report('again', cells, 'cells', time.time() - start)
+    finally:
+        os.remove(outfile)
+        if args.map is None:
+            os.remove(filename)
+
+def bench_read(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False, eager=True)
+        cells = sum(z.width * z.height for z in dmm.zLevels)
+        print('Read every atom on every tile, {} levels:'.format(len(dmm.zLevels)))
+        for label, get in (('GetTileAt', dmm.GetTileAt), ('ViewTileAt', dmm.ViewTileAt)):
+            start = time.time()
+            for z, zlevel in enumerate(dmm.zLevels):
+                for y in xrange(zlevel.height):
+                    for x in xrange(zlevel.width):
+                        for atom in get(x, y, z).GetAtoms():
+                            atom.path
+            report(label, cells, 'cells', time.time() - start)
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_edit(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        start = time.time()
+        dmm = Map()
+        dmm.Load(filename, cache=False, eager=True)
+        cells = sum(z.width * z.height for z in dmm.zLevels)
+        report('eager load', cells, 'cells', time.time() - start)
+        
+        # Add a lattice to every tile, then take it off again.
+        lattice = DMMFormat(dmm).consumeAtom('/obj/structure/lattice')
+        start = time.time()
+        edits = 0
+        for z, zlevel in enumerate(dmm.zLevels):
+            for y in xrange(zlevel.height):
+                for x in xrange(zlevel.width):
+                    tile = dmm.GetTileAt(x, y, z)
+                    tile.AppendAtom(lattice)
+                    tile.RemoveAtom(lattice)
+                    dmm.SetTileAt(x, y, z, tile)
+                    edits += 2
+        report('edit', edits, 'edits', time.time() - start)
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def synthetic_tree(nvars):
+    '''An object tree holding the sample types, each with nvars vars, like a real codebase's /atom.'''
+    tree = ObjectTree()
+    for chunk in SAMPLE_ATOMS + SAMPLE_TURFS + SAMPLE_AREAS:
+        atom = Atom(chunk.split('{')[0])
+        for i in xrange(nvars):
+            atom.properties['var{}'.format(i)] = BYONDValue(str(i))
+        for _, _, props in TokenizeTileChunk(chunk):
+            for key, _ in props:
+                atom.properties[key] = BYONDString('')
+        atom.ob_inherited = True
+        tree.Atoms[atom.path] = atom
+    return tree
+
+def bench_memory(args):
+    fd, filename = tempfile.mkstemp(suffix='.dmm')
+    os.close(fd)
+    fmt = DMMFormat(None)
+    # Every entry gets its own sign, so every entry is a distinct instance.
+    with open(filename, 'w') as f:
+        idlen = len(fmt.ID2String(args.entries - 1))
+        keys = [fmt.ID2String(i, idlen) for i in xrange(args.entries)]
+        for i, key in enumerate(keys):
+            f.write('"{}" = (/obj/structure/sign/securearea{{name = "sign {}"; pixel_y = {}}},/turf/space,/area)\n'.format(key, i, i % 64))
+        f.write('\n(1,1,1) = {{"\n{}\n"}}\n'.format(''.join(keys[:100])))
+    try:
+        tree = synthetic_tree(args.vars)
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        dmm = Map(tree)
+        dmm.Load(filename, cache=False, eager=True)
+        elapsed = time.time() - start
+        gc.collect()
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        print('Eager load of {} instances over {}-var types:'.format(len(dmm.instances), args.vars))
+        print('  {:<12} {:>10.1f} MB ({:.3f}s)'.format('peak RSS +', grown / 1024.0, elapsed))
+    finally:
+        os.remove(filename)
+
+def bench_find(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        print('Find every {} (and subtypes), {} levels:'.format(args.type, len(dmm.zLevels)))
+        start = time.time()
+        found = 0
+        for tile in dmm.Locations():
+            for atom in tile.GetAtoms():
+                if atom.path == args.type or atom.path.startswith(args.type + '/'):
+                    found += 1
+                    break
+        print('  {:<12} {:>10} tiles ({:.3f}s)'.format('Locations()', found, time.time() - start))
+        
+        start = time.time()
+        found = len(dmm.FindByType(args.type))
+        print('  {:<12} {:>10} tiles ({:.3f}s)'.format('FindByType', found, time.time() - start))
+        start = time.time()
+        dmm.FindByType(args.type)
+        print('  {:<12} {:>10} tiles ({:.3f}s)'.format('  again', found, time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_areas(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        areas = dmm.GetAreaTable()[1:]
+        print('Count and bound {} areas, {} levels:'.format(len(areas), len(dmm.zLevels)))
+        start = time.time()
+        for area in areas:
+            for z in xrange(len(dmm.zLevels)):
+                layer = dmm.zLevels[z]
+                for y in xrange(layer.height):
+                    for x in xrange(layer.width):
+                        for atom in layer.ViewTile(x, y).GetAtoms():
+                            if atom.path == area:
+                                break
+        print('  {:<12} {:>10} areas ({:.3f}s)'.format('per atom', len(areas), time.time() - start))
+        
+        dmm.InvalidateTypeIndex()
+        start = time.time()
+        for area in areas:
+            dmm.CountArea(area)
+            for z in xrange(len(dmm.zLevels)):
+                dmm.GetAreaBBox(area, z)
+        print('  {:<12} {:>10} areas ({:.3f}s)'.format('area table', len(areas), time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_stats(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        print('Count atom types, {} levels:'.format(len(dmm.zLevels)))
+        start = time.time()
+        counts = {}
+        for tile in dmm.Locations():
+            for atom in tile.GetAtoms():
+                counts[atom.path] = counts.get(atom.path, 0) + 1
+        print('  {:<12} {:>10} types ({:.3f}s)'.format('Locations()', len(counts), time.time() - start))
+        
+        start = time.time()
+        found = len(dmm.Stats()['atoms'])
+        print('  {:<12} {:>10} types ({:.3f}s)'.format('Stats', found, time.time() - start))
+        dmm.SetTileAt(0, 0, 0, dmm.GetTileAt(1, 1, 0))
+        start = time.time()
+        dmm.Stats()
+        print('  {:<12} {:>10} types ({:.3f}s)'.format('  1 edit', found, time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_region(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        layer = dmm.zLevels[0]
+        old = dmm.GetTileAt(0, 0, 0)
+        new = dmm.GetTileAt(1, 0, 0)
+        print('Replace one tile type and clear z=0, {}x{}:'.format(layer.width, layer.height))
+        start = time.time()
+        for x in xrange(layer.width):
+            for y in xrange(layer.height):
+                if layer.tiles[x, y] == old.ID:
+                    dmm.SetTileAt(x, y, 0, new)
+        for x in xrange(layer.width):
+            for y in xrange(layer.height):
+                dmm.SetTileAt(x, y, 0, old)
+        print('  {:<12} {:>10} cells ({:.3f}s)'.format('SetTileAt', layer.width * layer.height, time.time() - start))
+        
+        start = time.time()
+        dmm.ReplaceTiles(0, {old: new})
+        dmm.Fill(0, None, old)
+        print('  {:<12} {:>10} cells ({:.3f}s)'.format('region', layer.width * layer.height, time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def synthetic_edits(dmm, edits, seed=0):
+    '''A snapshot of a map with random atoms added to random cells.'''
+    mine = dmm.Snapshot()
+    rng = random.Random(seed)
+    for _ in xrange(edits):
+        z = rng.randrange(len(mine.zLevels))
+        layer = mine.zLevels[z]
+        tile = mine.GetTileAt(rng.randrange(layer.width), rng.randrange(layer.height), z)
+        tile.AppendAtom(mine.GetInstance(mine.GetTileAt(rng.randrange(layer.width), rng.randrange(layer.height), z).instances[0]))
+        mine.SetTileAt(rng.randrange(layer.width), rng.randrange(layer.height), z, tile)
+    return mine
+
+def bench_diff(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        theirs = Map()
+        theirs.Load(filename, cache=False)
+        mine = synthetic_edits(theirs, args.edits)
+        cells = sum(layer.width * layer.height for layer in theirs.zLevels)
+        print('Diff {} levels after {} edits:'.format(len(theirs.zLevels), args.edits))
+        start = time.time()
+        stats = MapDiff(theirs, mine).WritePatch(StringIO.StringIO())
+        print('  {:<12} {:>10} cells, {} changed ({:.3f}s)'.format('MapDiff', cells, stats['tilediffs'], time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_patch(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    fd, patchfile = tempfile.mkstemp(suffix='.dmmpatch')
+    os.close(fd)
+    try:
+        theirs = Map()
+        theirs.Load(filename, cache=False)
+        with open(patchfile, 'w') as f:
+            MapDiff(theirs, synthetic_edits(theirs, args.edits)).WritePatch(f)
+        print('Apply a patch of {} edits to {} levels:'.format(args.edits, len(theirs.zLevels)))
+        start = time.time()
+        patch = CompilePatch(patchfile)
+        print('  {:<12} {:>10} cells ({:.3f}s)'.format('compile', len(patch.cells), time.time() - start))
+        for label in ('apply', 'reapply'):
+            start = time.time()
+            stats = CompilePatch(patchfile).Apply(theirs)
+            print('  {:<12} {:>10} cells ({:.3f}s)'.format(label, stats['cells'] + stats['skipped'], time.time() - start))
+    finally:
+        os.remove(patchfile)
+        if args.map is None:
+            os.remove(filename)
+
+def bench_merge(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=args.levels)
+    try:
+        base = Map()
+        base.Load(filename, cache=False)
+        ours = synthetic_edits(base, args.edits, seed=1)
+        theirs = synthetic_edits(base, args.edits, seed=2)
+        cells = sum(layer.width * layer.height for layer in base.zLevels)
+        print('Merge two sets of {} edits to {} levels:'.format(args.edits, len(base.zLevels)))
+        start = time.time()
+        _, merge = Map.Merge3(base, ours, theirs)
+        print('  {:<12} {:>10} cells, {} conflicts ({:.3f}s)'.format('Merge3', cells, merge.stats['conflicts'], time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+def bench_stamp(args):
+    filename = args.map
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.dmm')
+        os.close(fd)
+        synthetic_map(filename, size=args.size, levels=1)
+    try:
+        dmm = Map()
+        dmm.Load(filename, cache=False)
+        layer = dmm.zLevels[0]
+        size = args.prefab
+        prefab = Map()
+        prefab.CreateZLevel(size, size)
+        prefab.Blit(dmm, (0, 0, size, size), 0, (0, 0))
+        rng = random.Random(0)
+        spots = [(rng.randrange(layer.width - size), rng.randrange(layer.height - size), rng.randrange(4) * 90) for _ in xrange(args.stamps)]
+        print('Stamp a {0}x{0} prefab {1} times:'.format(size, args.stamps))
+        
+        start = time.time()
+        for x, y, _ in spots[:max(args.stamps // 10, 1)]:
+            for px in xrange(size):
+                for py in xrange(size):
+                    dmm.SetTileAt(x + px, y + py, 0, prefab.GetTileAt(px, py, 0))
+        elapsed = (time.time() - start) * args.stamps / max(args.stamps // 10, 1)
+        print('  {:<12} {:>10} cells ({:.3f}s, extrapolated)'.format('SetTileAt', args.stamps * size * size, elapsed))
+        
+        for label, kwargs in (('Stamp', {}), ('keep_area', {'keep_area': True})):
+            start = time.time()
+            for x, y, rotate in spots:
+                dmm.Stamp(prefab, 0, x, y, rotate=rotate, **kwargs)
+            print('  {:<12} {:>10} cells ({:.3f}s)'.format(label, args.stamps * size * size, time.time() - start))
+    finally:
+        if args.map is None:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    opt = argparse.ArgumentParser()
+    command = opt.add_subparsers(help='The benchmark to run', dest='MODE')
+
+    _dict = command.add_parser('dict', help='Tile dictionary tokenizing throughput.')
+    _dict.add_argument('--entries', type=int, default=20000, help='Number of synthetic dictionary entries.')
+    _dict.add_argument('map', type=str, nargs='?', default=None, help='Use the dictionary of a real map instead.', metavar='map.dmm')
+
+    _load = command.add_parser('load', help='Whole-map load throughput.')
+    _load.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _load.add_argument('--levels', type=int, default=7, help='Number of z-levels in the synthetic map.')
+    _load.add_argument('--workers', type=int, default=4, help='Process count for the parallel z-level decode.')
+    _load.add_argument('map', type=str, nargs='?', default=None, help='Load a real map instead.', metavar='map.dmm')
+
+    _save = command.add_parser('save', help='Whole-map save throughput.')
+    _save.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _save.add_argument('--levels', type=int, default=7, help='Number of z-levels in the synthetic map.')
+    _save.add_argument('map', type=str, nargs='?', default=None, help='Save a real map instead.', metavar='map.dmm')
+
+    _read = command.add_parser('read', help='Per-cell read throughput.')
+    _read.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _read.add_argument('--levels', type=int, default=1, help='Number of z-levels in the synthetic map.')
+    _read.add_argument('map', type=str, nargs='?', default=None, help='Read a real map instead.', metavar='map.dmm')
+
+    _edit = command.add_parser('edit', help='Eager load and per-tile edit throughput.')
+    _edit.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _edit.add_argument('--levels', type=int, default=1, help='Number of z-levels in the synthetic map.')
+    _edit.add_argument('map', type=str, nargs='?', default=None, help='Edit a real map instead.', metavar='map.dmm')
+
+    _memory = command.add_parser('memory', help='Memory used by map instances (Linux only).')
+    _memory.add_argument('--entries', type=int, default=20000, help='Number of distinct instances.')
+    _memory.add_argument('--vars', type=int, default=300, help='Vars on each type in the synthetic tree.')
+
+    _find = command.add_parser('find', help='Type lookup over a whole map.')
+    _find.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _find.add_argument('--levels', type=int, default=1, help='Number of z-levels in the synthetic map.')
+    _find.add_argument('--type', type=str, default='/obj/machinery', help='Type path to look for.')
+    _find.add_argument('map', type=str, nargs='?', default=None, help='Search a real map instead.', metavar='map.dmm')
+
+    _areas = command.add_parser('areas', help='Per-area tile counts and bounding boxes.')
+    _areas.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _areas.add_argument('--levels', type=int, default=1, help='Number of z-levels in the synthetic map.')
+    _areas.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _stats = command.add_parser('stats', help='Atom type counts over a whole map.')
+    _stats.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _stats.add_argument('--levels', type=int, default=3, help='Number of z-levels in the synthetic map.')
+    _stats.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _region = command.add_parser('region', help='Whole-level replace and fill.')
+    _region.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _region.add_argument('--levels', type=int, default=1, help='Number of z-levels in the synthetic map.')
+    _region.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _diff = command.add_parser('diff', help='Patch generation between two versions of a map.')
+    _diff.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _diff.add_argument('--levels', type=int, default=7, help='Number of z-levels in the synthetic map.')
+    _diff.add_argument('--edits', type=int, default=2000, help='Number of random tile edits.')
+    _diff.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _patch = command.add_parser('patch', help='Patch application.')
+    _patch.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _patch.add_argument('--levels', type=int, default=7, help='Number of z-levels in the synthetic map.')
+    _patch.add_argument('--edits', type=int, default=2000, help='Number of random tile edits.')
+    _patch.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _merge = command.add_parser('merge', help='Three-way merge.')
+    _merge.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _merge.add_argument('--levels', type=int, default=7, help='Number of z-levels in the synthetic map.')
+    _merge.add_argument('--edits', type=int, default=5000, help='Number of random tile edits on each side.')
+    _merge.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    _stamp = command.add_parser('stamp', help='Repeated prefab stamping.')
+    _stamp.add_argument('--size', type=int, default=255, help='Width and height of the synthetic map.')
+    _stamp.add_argument('--prefab', type=int, default=15, help='Width and height of the prefab.')
+    _stamp.add_argument('--stamps', type=int, default=500, help='Number of stamps.')
+    _stamp.add_argument('map', type=str, nargs='?', default=None, help='Use a real map instead.', metavar='map.dmm')
+
+    args = opt.parse_args()
+    if args.MODE == 'dict':
+        bench_dictionary(args)
+    elif args.MODE == 'load':
+        bench_load(args)
+    elif args.MODE == 'save':
+        bench_save(args)
+    elif args.MODE == 'read':
+        bench_read(args)
+    elif args.MODE == 'edit':
+        bench_edit(args)
+    elif args.MODE == 'memory':
+        bench_memory(args)
+    elif args.MODE == 'find':
+        bench_find(args)
+    elif args.MODE == 'areas':
+        bench_areas(args)
+    elif args.MODE == 'stats':
+        bench_stats(args)
+    elif args.MODE == 'region':
+        bench_region(args)
+    elif args.MODE == 'diff':
+        bench_diff(args)
+    elif args.MODE == 'patch':
+        bench_patch(args)
+    elif args.MODE == 'merge':
+        bench_merge(args)
+    elif args.MODE == 'stamp':
+        bench_stamp(args)
+    else:
+        print('!!! Error, unknown MODE=%r' % args.MODE)
+        sys.exit(1)
@@ -154,6 +154,7 @@ for tile in it:
 with open(args.map + '.missing', 'w') as f:
     for atom in sorted(dmm.missing_atoms):
         f.write(atom + "\n")
+dmm.Compact()
 print('--- Saving...')
 dmm.Save(args.output if args.output else args.map + '.fixed')        
 #dmm.writeMap2(args.map.replace('.dmm', '.dmm2') + '.fixed')
@@ -35,6 +35,46 @@ class AtomTest(unittest.TestCase):
         
         # Check it
         self.assertEqual(str(atom), atom_serialized)
+        
+    def test_identity(self):
+        from byond.basetypes import Atom, BYONDString, BYONDValue, PropertyFlags
+        atom = Atom('/datum/test',__file__,0)
+        atom.properties['dir']=BYONDValue(2)
+        atom.properties['name']=BYONDString('test datum')
+        atom.mapSpecified=['dir']
+        
+        self.assertEqual(atom.GetIdentity(), ('/datum/test', (('dir', '2'),)))
+        
+        # Only map-specified vars count.
+        atom2=atom.copy()
+        atom2.properties['name']=BYONDString('other datum')
+        atom2.InvalidateHash()
+        self.assertEqual(atom.GetIdentity(), atom2.GetIdentity())
+        
+        atom2.setProperty('name', 'other datum', PropertyFlags.MAP_SPECIFIED)
+        self.assertNotEqual(atom.GetIdentity(), atom2.GetIdentity())
+
+    def test_instantiate(self):
+        from byond.basetypes import Atom, BYONDString, BYONDValue
+        atom = Atom('/datum/test',__file__,0)
+        atom.properties['dir']=BYONDValue(2)
+        atom.properties['name']=BYONDString('test datum')
+        
+        instance = atom.Instantiate()
+        self.assertEqual(str(instance), str(atom))
+        
+        instance.properties['dir']=BYONDValue(4)
+        instance.properties['tag']=BYONDString('x')
+        del instance.properties['name']
+        self.assertEqual(str(instance), '/datum/test{dir=4;tag="x"}')
+        self.assertEqual(len(instance.properties), 2)
+        self.assertNotIn('name', instance.properties)
+        self.assertEqual(str(atom), '/datum/test{dir=2;name="test datum"}')
+        
+        # Copies don't share overrides.
+        instance2 = instance.copy()
+        instance2.properties['dir']=BYONDValue(8)
+        self.assertEqual(instance.getProperty('dir'), 4)
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
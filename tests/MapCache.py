@@ -0,0 +1,179 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest, os, shutil, tempfile
+
+TEST_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.dmm')
+
+class MapCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mapfile = os.path.join(self.tmpdir, 'test.dmm')
+        shutil.copy(TEST_MAP, self.mapfile)
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def test_cache_roundtrip(self):
+        from byond.map import Map
+        text = Map()
+        text.Load(self.mapfile, cache=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'test.dmmc')))
+        
+        cached = Map()
+        cached.Load(self.mapfile, cache=True)
+        self.assertListEqual([str(t) for t in cached.tiles], [str(t) for t in text.tiles])
+        for a, b in zip(cached.zLevels, text.zLevels):
+            self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+            
+        # Edits stay in memory.
+        cached.zLevels[0].tiles[0, 0] = 3
+        again = Map()
+        again.Load(self.mapfile, cache=True)
+        self.assertEqual(again.zLevels[0].tiles[0, 0], 0)
+        
+    def test_cache_invalidation(self):
+        from byond.map import Map
+        from byond.map.format.dmmc import DMMCFormat
+        from byond.utils import md5sum
+        Map().Load(self.mapfile, cache=True)
+        with open(self.mapfile, 'a') as f:
+            f.write('\n')
+        self.assertFalse(DMMCFormat.IsCurrent(os.path.join(self.tmpdir, 'test.dmmc'), md5sum(self.mapfile)))
+        
+        Map().Load(self.mapfile, cache=True)
+        self.assertTrue(DMMCFormat.IsCurrent(os.path.join(self.tmpdir, 'test.dmmc'), md5sum(self.mapfile)))
+
+    def test_cache_opt_in(self):
+        from byond.map import Map
+        Map().Load(self.mapfile)
+        Map().Load(self.mapfile, z=[1])
+        self.assertListEqual(os.listdir(self.tmpdir), ['test.dmm'])
+        
+    def test_cache_missing_atoms(self):
+        from byond import ObjectTree
+        from byond.map import Map
+        # None of the map's types are in the tree, so every atom is a missing one.
+        loaded = []
+        for _ in range(2):
+            dmm = Map(ObjectTree(), forgiving_atom_lookups=True)
+            dmm.Load(self.mapfile, cache=True)
+            loaded.append(dmm)
+        text, cached = loaded
+        self.assertListEqual([str(t) for t in cached.tiles], [str(t) for t in text.tiles])
+        self.assertIn('/obj/structure/lattice', cached.missing_atoms)
+        self.assertSetEqual(cached.missing_atoms, text.missing_atoms)
+        self.assertTrue(all(atom is not None for atom in cached.instances))
+
+    def test_partial_load(self):
+        from byond.map import Map
+        full = Map()
+        full.Load(self.mapfile, cache=False)
+
+        part = Map()
+        part.Load(self.mapfile, z=[1], bbox=(1, 1, 3, 3), cache=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'test.dmmi')))
+        self.assertEqual(len(part.zLevels), 1)
+        self.assertEqual(part.zLevels[0].origin, (1, 1, 1))
+        # Only the tile types inside the box are read.
+        self.assertListEqual(sorted(t.origID for t in part.tiles), ['aaa', 'aab'])
+        for x in range(2):
+            for y in range(2):
+                self.assertEqual(str(part.GetTileAt(x, y, 0)), str(full.GetTileAt(x + 1, y + 1, 1)))
+
+        # Reusing the index gives the same result.
+        again = Map()
+        again.Load(self.mapfile, z=[1, 0], cache=True)
+        origIDs = lambda m, z: [[m.tiles[i].origID for i in col] for col in m.zLevels[z].tiles.tolist()]
+        self.assertListEqual(origIDs(again, 0), origIDs(full, 1))
+        self.assertListEqual(origIDs(again, 1), origIDs(full, 0))
+
+    def test_save_roundtrip(self):
+        from byond.map import Map
+        original = Map()
+        original.Load(self.mapfile, cache=False)
+        outfile = os.path.join(self.tmpdir, 'out.dmm')
+        original.Save(outfile)
+        
+        saved = Map()
+        saved.Load(outfile, cache=False)
+        self.assertEqual(len(saved.zLevels), len(original.zLevels))
+        for z in range(len(original.zLevels)):
+            for y in range(original.zLevels[z].height):
+                for x in range(original.zLevels[z].width):
+                    self.assertEqual(str(saved.GetTileAt(x, y, z)), str(original.GetTileAt(x, y, z)))
+
+    def test_compressed_io(self):
+        from byond.map import Map
+        from byond.utils import lzma
+        original = Map()
+        original.Load(self.mapfile, cache=False)
+        exts = ['.gz', '.bz2']
+        if lzma is not None:
+            exts.append('.xz')
+        for ext in exts:
+            outfile = os.path.join(self.tmpdir, 'out.dmm' + ext)
+            original.Save(outfile, compresslevel=1)
+            with open(outfile, 'rb') as f:
+                self.assertNotEqual(f.read(1), b'"', ext)
+                
+            loaded = Map()
+            loaded.Load(outfile)
+            self.assertFalse(os.path.isfile(os.path.join(self.tmpdir, 'out.dmmc')))
+            self.assertListEqual([str(t) for t in loaded.tiles], [str(t) for t in original.tiles])
+            for a, b in zip(loaded.zLevels, original.zLevels):
+                self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+            
+            part = Map()
+            part.Load(outfile, z=[1], bbox=(1, 1, 3, 3))
+            self.assertEqual(part.zLevels[0].origin, (1, 1, 1))
+            self.assertListEqual(part.zLevels[0].tiles.tolist(), original.zLevels[1].tiles[1:3, 1:3].tolist())
+
+    def test_memory_io(self):
+        import mmap
+        from byond.map import Map
+        original = Map()
+        original.Load(self.mapfile, cache=False)
+        text = original.Dumps()
+        
+        with open(self.mapfile, 'rb') as f:
+            data = f.read()
+            f.seek(0)
+            streamed = Map()
+            streamed.LoadFile(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for source in (data, bytearray(data), memoryview(data), mm, text, data.replace(b'\n', b'\r\n')):
+                loaded = Map()
+                loaded.Loads(source)
+                self.assertListEqual([str(t) for t in loaded.tiles], [str(t) for t in original.tiles])
+                for a, b in zip(loaded.zLevels, original.zLevels):
+                    self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+        finally:
+            mm.close()
+        for a, b in zip(streamed.zLevels, original.zLevels):
+            self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+        self.assertEqual(loaded.Dumps(), text)
+        
+        part = Map()
+        part.Loads(data, z=[1], bbox=(1, 1, 3, 3))
+        self.assertListEqual(part.zLevels[0].tiles.tolist(), original.zLevels[1].tiles[1:3, 1:3].tolist())
+        
+    def test_memory_io_generic(self):
+        import StringIO
+        from byond.map import Map
+        # .dmmc only reads and writes files; the base format goes through a temporary file for it.
+        original = Map()
+        original.Load(self.mapfile, cache=False)
+        data = original.Dumps(format='dmmc')
+        self.assertEqual(data[:4], b'DMMC')
+        for load in (lambda m: m.Loads(data, format='dmmc'), lambda m: m.LoadFile(StringIO.StringIO(data), format='dmmc')):
+            loaded = Map()
+            load(loaded)
+            self.assertListEqual([str(t) for t in loaded.tiles], [str(t) for t in original.tiles])
+            for a, b in zip(loaded.zLevels, original.zLevels):
+                self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+            self.assertEqual(loaded.Dumps(), original.Dumps())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,526 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest, os, numpy
+
+TEST_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.dmm')
+
+class MapEditingTest(unittest.TestCase):
+    def setUp(self):
+        from byond.map import Map
+        self.map = Map()
+        self.map.Load(TEST_MAP, cache=False)
+        
+    def test_views_copy_on_write(self):
+        view = self.map.ViewTileAt(2, 0, 0)
+        copy = self.map.GetTileAt(2, 0, 0)
+        self.assertEqual(str(view), str(copy))
+        self.assertEqual(view.coords, (2, 0, 0))
+        self.assertIs(view.instances, self.map.tiles[view.ID].instances)
+        
+        cable = view.GetAtom(0)
+        self.assertEqual(cable.path, '/obj/structure/cable')
+        self.assertEqual(cable.mapSpecified, ('d1', 'd2', 'icon_state', 'tag'))
+        master = self.map.instances[cable.ID]
+        
+        cable.properties['d1'] = cable.properties['d2']
+        self.assertTrue(cable.IsDetached())
+        self.assertEqual(str(master.properties['d1']), '1')
+        self.assertEqual(str(cable.properties['d1']), '2')
+        
+        view.RemoveAtom(self.map.instances[view.instances[0]])
+        self.assertTrue(view.IsDetached())
+        self.assertEqual(len(view.instances), 2)
+        self.assertEqual(len(self.map.tiles[copy.ID].instances), 3)
+        self.assertEqual(str(self.map.ViewTileAt(2, 0, 0)), str(copy))
+
+    def test_FindByType(self):
+        found = self.map.FindByType('/obj/structure/lattice', z=0)
+        self.assertListEqual(sorted(map(tuple, found.tolist())), [(0, 1, 0), (1, 0, 0), (1, 1, 0), (3, 3, 0)])
+        
+        self.assertEqual(len(self.map.FindByType('/area')), 32)
+        self.assertEqual(len(self.map.FindByType('/area', subtypes=False)), 24)
+        self.assertEqual(len(self.map.FindByType('/obj/structure', subtypes=False)), 0)
+        self.assertEqual(len(self.map.FindByType('/obj/structure', z=1)), 12)
+        
+        # Edits are picked up.
+        tile = self.map.GetTileAt(0, 0, 0)
+        tile.AppendAtom(self.map.GetInstance(self.map.GetTileAt(1, 0, 0).instances[0]))
+        self.map.SetTileAt(0, 0, 0, tile)
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice', z=0)), 5)
+        
+    def test_FindByType_master_edit(self):
+        from byond.map import Map
+        eager = Map()
+        eager.Load(TEST_MAP, cache=False, eager=True)
+        self.assertEqual(len(eager.FindByType('/obj/structure/lattice')), 8)
+        self.assertEqual(eager.CountArea('/area'), 24)
+        
+        # Edit the tile types themselves, as the map holds them.
+        tile = eager.tiles[1]
+        self.assertTrue(tile.master)
+        lattice = [eager.instances[iid] for iid in tile.instances if eager.instances[iid].path == '/obj/structure/lattice'][0]
+        tile.RemoveAtom(lattice)
+        self.assertEqual(tile.ID, 1)
+        self.assertEqual(len(eager.FindByType('/obj/structure/lattice')), 0)
+        tile.RemoveAtom(eager.instances[tile.instances[-1]])
+        self.assertEqual(eager.CountArea('/area'), 16)
+
+    def test_areas(self):
+        table = self.map.GetAreaTable()
+        self.assertEqual(table[0], None)
+        self.assertItemsEqual(table[1:], ['/area', '/area/security/prison'])
+        
+        prison = '/area/security/prison'
+        mask = self.map.GetAreaMask(prison, 0)
+        self.assertListEqual(sorted(zip(*numpy.nonzero(mask))), [(0, 2), (2, 0), (2, 1), (3, 1)])
+        self.assertEqual(self.map.CountArea(prison), 8)
+        self.assertEqual(self.map.CountArea([prison, '/area'], 0), 16)
+        self.assertEqual(self.map.CountArea('/area/nowhere'), 0)
+        self.assertEqual(self.map.GetAreaBBox(prison, 0), (0, 0, 4, 3))
+        self.assertEqual(self.map.GetAreaBBox(prison, 1), (0, 3, 4, 4))
+        self.assertEqual(self.map.GetAreaBBox('/area/nowhere', 1), None)
+        
+        # Edits are picked up.
+        self.map.SetTileAt(3, 3, 0, self.map.GetTileAt(2, 0, 0))
+        self.assertEqual(self.map.CountArea(prison, 0), 5)
+        self.assertEqual(self.map.GetAreaBBox(prison, 0), (0, 0, 4, 4))
+        self.map.zLevels[0].tiles[:, :] = self.map.zLevels[0].tiles[0, 0]
+        self.map.zLevels[0].Touch()
+        self.assertEqual(self.map.GetAreaBBox(prison, 0), None)
+        
+    def test_area_mask_unassigned(self):
+        # Area-mode rendering draws the selected areas and tiles with no area at all.
+        prison = '/area/security/prison'
+        tile = self.map.GetTileAt(0, 0, 0)
+        tile.RemoveAtom(tile.GetAtoms()[-1])
+        self.map.SetTileAt(3, 3, 0, tile)
+        self.assertListEqual(sorted(zip(*numpy.nonzero(self.map.GetAreaMask(prison, 0)))), [(0, 2), (2, 0), (2, 1), (3, 1)])
+        mask = self.map.GetAreaMask(prison, 0, unassigned=True)
+        self.assertListEqual(sorted(zip(*numpy.nonzero(mask))), [(0, 2), (2, 0), (2, 1), (3, 1), (3, 3)])
+        self.assertEqual(self.map.GetAreaMask('/area/security', 0, unassigned=True).sum(), 1)
+        
+    def test_region_edits(self):
+        cable = self.map.GetTileAt(2, 0, 0)
+        ntiles = len(self.map.tiles)
+        self.assertEqual(self.map.Fill(1, (1, 1, 9, 3), cable), 6)
+        self.assertEqual(len(self.map.tiles), ntiles)
+        self.assertEqual(self.map.Stats(1)['areas']['/area/security/prison'], 10)
+        self.assertEqual(str(self.map.GetTileAt(3, 2, 1)), str(cable))
+        self.assertRaises(ValueError, self.map.Fill, 1, (4, 4, 5, 5), 0)
+        self.assertRaises(KeyError, self.map.Fill, 1, None, 99)
+        
+        space = self.map.GetTileAt(0, 0, 0).ID
+        lattice = self.map.GetTileAt(1, 0, 0).ID
+        self.assertEqual(self.map.ReplaceTiles(0, {lattice: space}), 4)
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice', z=0)), 0)
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice', z=1)), 1)
+        self.assertEqual(self.map.ReplaceTiles(None, {lattice: space}), 1)
+        
+        # Within the map, and clipped to the destination.
+        self.assertEqual(self.map.Blit(self.map, (0, 0, 2, 2), 1, (3, 3)), 1)
+        self.assertEqual(self.map.GetTileAt(3, 3, 1).ID, self.map.GetTileAt(0, 0, 0).ID)
+        
+        from byond.map import Map
+        other = Map()
+        other.CreateZLevel(5, 5)
+        self.assertEqual(other.Blit(self.map, (1, 1, 4, 3), 0, (3, 2), src_z=0), 4)
+        for x in range(2):
+            for y in range(2):
+                self.assertEqual(str(other.GetTileAt(3 + x, 2 + y, 0)), str(self.map.GetTileAt(1 + x, 1 + y, 0)))
+        self.assertEqual(str(other.GetTileAt(2, 2, 0)), str(other.basetile))
+        self.assertEqual(len(other.Stats()['atoms']), 6)
+        
+    def test_Snapshot(self):
+        grid = lambda m, z: [[str(m.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)]
+        before = [grid(self.map, z) for z in range(2)]
+        snap = self.map.Snapshot()
+        self.assertIs(snap.zLevels[0].tiles, self.map.zLevels[0].tiles)
+        self.assertIs(snap.tiles, self.map.tiles)
+        self.assertRaises(ValueError, self.map.zLevels[0].tiles.__setitem__, (0, 0), 1)
+        
+        tile = self.map.GetTileAt(0, 0, 0)
+        tile.AppendAtom(self.map.GetInstance(self.map.GetTileAt(1, 0, 0).instances[0]))
+        self.map.SetTileAt(0, 0, 0, tile)
+        self.map.Fill(0, (2, 2, 4, 4), tile)
+        self.assertIsNot(snap.zLevels[0].tiles, self.map.zLevels[0].tiles)
+        self.assertIs(snap.zLevels[1].tiles, self.map.zLevels[1].tiles)
+        self.assertListEqual(grid(snap, 0), before[0])
+        self.assertEqual(len(snap.FindByType('/obj/structure/lattice', z=0)), 4)
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice', z=0)), 8)
+        
+        # Edits to the snapshot don't reach the original either, and compacting one leaves the other intact.
+        snap.SetTileAt(1, 1, 1, tile)
+        self.assertListEqual(grid(self.map, 1), before[1])
+        after = [grid(self.map, z) for z in range(2)]
+        self.map.Compact()
+        self.assertIsNot(snap.tiles, self.map.tiles)
+        self.assertListEqual(grid(snap, 0), before[0])
+        self.assertEqual(str(snap.GetTileAt(1, 1, 1)), str(tile))
+        self.assertListEqual([grid(self.map, z) for z in range(2)], after)
+        
+    def test_Snapshot_tile_edit(self):
+        grid = lambda m, z: [[str(m.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)]
+        before = [grid(self.map, z) for z in range(2)]
+        snap = self.map.Snapshot()
+        
+        # Editing one of the shared tile types in place stops the sharing, and the snapshot keeps it as it was.
+        tile = self.map.tiles[self.map.zLevels[0].tiles[1, 0]]
+        tile.RemoveAtom(self.map.instances[tile.instances[0]])
+        self.assertIsNot(snap.tiles, self.map.tiles)
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice')), 0)
+        self.assertEqual(len(snap.FindByType('/obj/structure/lattice')), 8)
+        self.assertListEqual([grid(snap, z) for z in range(2)], before)
+        self.assertEqual(str(self.map.GetTileAt(1, 0, 0)), '/turf/space{},/area{}')
+        
+    def test_MapDiff(self):
+        import StringIO
+        from byond.map.diff import MapDiff
+        theirs = self.map.Snapshot()
+        self.assertEqual(MapDiff(theirs, self.map).WritePatch(StringIO.StringIO()), {'diffs': 0, 'tilediffs': 0})
+        
+        tile = self.map.GetTileAt(0, 0, 0)
+        tile.AppendAtom(self.map.GetInstance(self.map.GetTileAt(1, 0, 0).instances[0]))
+        self.map.SetTileAt(0, 0, 0, tile)
+        cable = self.map.GetTileAt(2, 0, 0)
+        self.map.Fill(1, (2, 2, 4, 3), cable)
+        diff = MapDiff(theirs, self.map)
+        self.assertEqual([(x, y, z) for x, y, z, _ in diff.Changes()], [(0, 0, 0), (2, 2, 1), (3, 2, 1)])
+        
+        f = StringIO.StringIO()
+        self.assertEqual(diff.WritePatch(f), {'diffs': 7, 'tilediffs': 3})
+        lines = f.getvalue().splitlines()
+        self.assertEqual(lines[0], '<0,0,0>')
+        self.assertEqual(lines[1], ' @CHECK {} {} (/turf/space,/area,/obj/structure/lattice)'.format(theirs.GetTileAt(0, 0, 0).GetHash(), tile.GetHash()))
+        self.assertListEqual(lines[2:4], [' + /obj/structure/lattice', '<2,2,1>'])
+        self.assertTrue(lines[4].startswith(' @CHECK '))
+        self.assertListEqual(lines[5:9], [' -ALL'] + [' + ' + a for a in ['/obj/structure/cable{d1 = 1; d2 = 2; icon_state = "1-2"; tag = ""}', '/turf/simulated/floor{icon_state = "floorgrime"}', '/area/security/prison']])
+        
+    def test_MapPatch(self):
+        import StringIO
+        from byond.map.diff import MapDiff
+        from byond.map.patch import MapPatch
+        grid = lambda m, z: [[str(m.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)]
+        theirs = self.map.Snapshot()
+        tile = self.map.GetTileAt(0, 0, 0)
+        tile.AppendAtom(self.map.GetInstance(self.map.GetTileAt(1, 0, 0).instances[0]))
+        self.map.SetTileAt(0, 0, 0, tile)
+        self.map.Fill(1, (2, 2, 4, 3), self.map.GetTileAt(2, 0, 0))
+        tile = self.map.GetTileAt(1, 1, 0)
+        tile.RemoveAtom(self.map.GetInstance(tile.instances[0]))
+        self.map.SetTileAt(1, 1, 0, tile)
+        f = StringIO.StringIO()
+        MapDiff(theirs, self.map).WritePatch(f)
+        
+        patch = MapPatch()
+        patch.Parse(f.getvalue().splitlines())
+        self.assertEqual(len(patch.cells), 4)
+        self.assertEqual(len(patch.sequences), 3)
+        conflicted = theirs.Snapshot()
+        stats = patch.Apply(theirs)
+        self.assertEqual(stats, {'cells': 4, 'added': 7, 'removed': 5, 'skipped': 0, 'conflicts': 0})
+        self.assertListEqual([grid(theirs, z) for z in range(2)], [grid(self.map, z) for z in range(2)])
+        self.assertEqual(MapDiff(theirs, self.map).WritePatch(StringIO.StringIO())['tilediffs'], 0)
+        self.assertEqual(patch.Apply(theirs)['skipped'], 4)
+        
+        conflicted.SetTileAt(3, 2, 1, conflicted.GetTileAt(0, 1, 0))
+        stats = patch.Apply(conflicted, clobber=True)
+        self.assertEqual((stats['cells'], stats['conflicts']), (4, 1))
+        self.assertEqual(str(conflicted.GetTileAt(2, 2, 1)), str(self.map.GetTileAt(2, 2, 1)))
+        self.assertEqual(conflicted.GetTileAt(3, 2, 1).GetAtom(-1).path, '/obj/effect/byondtools/changed')
+        self.assertRaises(ValueError, MapPatch().Parse, ['<0,0,0>', ' ~ /obj'])
+        
+    def test_patch_cli(self):
+        import shutil, subprocess, sys, tempfile
+        from byond.map import Map
+        from byond.map.diff import MapDiff
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        grid = lambda m, z: [[str(m.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)]
+        def run(*args):
+            env = dict(os.environ, PYTHONPATH=root)
+            return subprocess.call([sys.executable, os.path.join(root, 'scripts', 'dmm.py'), '--project', TEST_MAP] + list(args), env=env, stdout=open(os.devnull, 'w'))
+        
+        mine = self.map.Snapshot()
+        mine.ReplaceTiles(None, {1: 2})
+        tmpdir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(tmpdir, 'test.dmm')
+            shutil.copy(TEST_MAP, target)
+            patchfile = os.path.join(tmpdir, 'test.dmmpatch')
+            with open(patchfile, 'w') as f:
+                MapDiff(self.map, mine).WritePatch(f)
+            
+            # Loads lazily, applies, compacts and saves.
+            self.assertEqual(run('patch', '-O', os.path.join(tmpdir, 'patched.dmm'), patchfile, target), 0)
+            patched = Map()
+            patched.Load(os.path.join(tmpdir, 'patched.dmm'), cache=False)
+            self.assertListEqual([grid(patched, z) for z in range(2)], [grid(mine, z) for z in range(2)])
+            
+            ours = os.path.join(tmpdir, 'ours.dmm')
+            shutil.copy(os.path.join(tmpdir, 'patched.dmm'), ours)
+            self.assertEqual(run('merge', '-O', os.path.join(tmpdir, 'merged.dmm'), target, ours, target), 0)
+            merged = Map()
+            merged.Load(os.path.join(tmpdir, 'merged.dmm'), cache=False)
+            self.assertListEqual([grid(merged, z) for z in range(2)], [grid(mine, z) for z in range(2)])
+        finally:
+            shutil.rmtree(tmpdir)
+        
+    def test_Merge3(self):
+        from byond.map import Map
+        from byond.basetypes import PropertyFlags
+        ours = self.map.Snapshot()
+        theirs = self.map.Snapshot()
+        space, lattice, cable, sign = [self.map.GetTileAt(x, 0, 0) for x in range(4)]
+        def edit(m, x, y, z, remove=(), add=()):
+            tile = m.GetTileAt(x, y, z)
+            for path in remove:
+                tile.RemoveAtom([a for a in tile.GetAtoms() if a.path == path][0])
+            for atom in add:
+                tile.AppendAtom(atom)
+            m.SetTileAt(x, y, z, tile)
+        lattice_atom = self.map.GetInstance(lattice.instances[0])
+        floor = self.map.GetInstance(cable.instances[1])
+        edit(ours, 0, 0, 0, add=[lattice_atom])
+        theirs.SetTileAt(3, 0, 0, space)
+        ours.SetTileAt(0, 2, 1, cable)
+        theirs.SetTileAt(0, 2, 1, cable)
+        # Different atoms of the same cell.
+        edit(ours, 2, 0, 0, add=[lattice_atom])
+        edit(theirs, 2, 0, 0, remove=['/obj/structure/cable'])
+        # The same atom, differently.
+        edit(ours, 1, 1, 1, add=[lattice_atom])
+        edit(theirs, 1, 1, 1, remove=['/obj/structure/lattice'])
+        # Two new turfs.
+        edit(ours, 2, 2, 1, remove=['/turf/space'], add=[floor])
+        floor.setProperty('icon_state', 'floor', flags=PropertyFlags.MAP_SPECIFIED)
+        edit(theirs, 2, 2, 1, remove=['/turf/space'], add=[floor])
+        
+        merged, merge = Map.Merge3(self.map, ours, theirs)
+        self.assertEqual(merge.stats, {'ours': 1, 'theirs': 1, 'same': 1, 'merged': 1, 'conflicts': 2})
+        self.assertListEqual(sorted(merge.conflicts), [(1, 1, 1), (2, 2, 1)])
+        paths = lambda x, y, z: [a.path for a in merged.GetTileAt(x, y, z).GetAtoms()]
+        self.assertEqual(str(merged.GetTileAt(0, 0, 0)), str(ours.GetTileAt(0, 0, 0)))
+        self.assertEqual(str(merged.GetTileAt(3, 0, 0)), str(space))
+        self.assertEqual(str(merged.GetTileAt(0, 2, 1)), str(cable))
+        self.assertListEqual(paths(2, 0, 0), ['/turf/simulated/floor', '/area/security/prison', '/obj/structure/lattice'])
+        for x, y, z in merge.conflicts:
+            self.assertEqual(str(merged.GetTileAt(x, y, z)), str(ours.GetTileAt(x, y, z)) + ',/obj/effect/byondtools/changed{tag="merge"}')
+        self.assertEqual(str(self.map.GetTileAt(3, 0, 0)), str(sign))
+        
+        # A z-level only they added.
+        theirs.CreateZLevel(2, 3)
+        merged, merge = Map.Merge3(self.map, ours, theirs)
+        self.assertEqual(len(merged.zLevels), 3)
+        self.assertEqual(merged.zLevels[2].tiles.shape, (3, 2))
+        self.assertEqual(str(merged.GetTileAt(1, 1, 2)), str(theirs.GetTileAt(1, 1, 2)))
+        
+    def test_ExtractZ_JoinZ(self):
+        from byond.map import Map
+        grid = lambda m, z: [[str(m.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)]
+        levels = [self.map.ExtractZ(z) for z in range(2)]
+        self.assertEqual(len(levels[1].zLevels), 1)
+        self.assertListEqual(grid(levels[1], 0), grid(self.map, 1))
+        self.assertEqual(len(levels[1].FindByType('/obj/structure/sign/securearea', z=0)), 4)
+        
+        joined = Map.JoinZ(levels[::-1])
+        self.assertEqual(len(joined.zLevels), 2)
+        self.assertListEqual([grid(joined, z) for z in range(2)], [grid(self.map, 1), grid(self.map, 0)])
+        self.assertEqual(Map.JoinZ(levels).Dumps(), self.map.Dumps())
+        
+        # Only what the level uses.
+        self.map.Fill(1, None, self.map.GetTileAt(0, 0, 0))
+        space = self.map.ExtractZ(1)
+        self.assertListEqual([a.path for a in space.instances], ['/turf/space', '/area'])
+        self.assertListEqual(space.zLevels[0].tiles.tolist(), [[space.GetTileAt(0, 0, 0).ID] * 4] * 4)
+        
+    def test_Stamp(self):
+        from byond.map import Map
+        prefab = Map()
+        prefab.CreateZLevel(3, 2)
+        prefab.Blit(self.map, (0, 0, 2, 3), 0, (0, 0))
+        grid = lambda m, z, w, h, x=0, y=0: numpy.array([[str(m.GetTileAt(x + i, y + j, z)) for j in range(h)] for i in range(w)])
+        expected = grid(prefab, 0, 2, 3)
+        
+        self.assertEqual(self.map.Stamp(prefab, 1, 1, 0), 6)
+        self.assertTrue((grid(self.map, 1, 2, 3, 1) == expected).all())
+        ntiles = len(self.map.tiles)
+        self.assertEqual(self.map.Stamp(prefab, 1, 0, 1, rotate=90), 6)
+        self.assertEqual(len(self.map.tiles), ntiles)
+        self.assertTrue((grid(self.map, 1, 3, 2, 0, 1) == numpy.rot90(expected)).all())
+        self.assertEqual(str(self.map.GetTileAt(2, 1, 1)), str(prefab.GetTileAt(0, 0, 0)))
+        self.assertRaises(ValueError, self.map.Stamp, prefab, 1, 0, 0, rotate=45)
+        
+        # Lattice cells show through, and stamped cells keep our area.
+        before = grid(self.map, 0, 4, 4)
+        self.assertEqual(self.map.Stamp(prefab, 0, 2, 1, mask='/obj/structure/lattice', keep_area=True), 3)
+        after = grid(self.map, 0, 4, 4)
+        self.assertListEqual(zip(*numpy.nonzero(after != before)), [(2, 1), (2, 3), (3, 3)])
+        self.assertEqual(after[2, 1], '/turf/space{},/area/security/prison{}')
+        self.assertEqual(after[3, 3], str(prefab.GetTileAt(1, 2, 0)))
+        
+    def test_journal(self):
+        grid = lambda: [[[self.map.GetTileAt(x, y, z).ID for y in range(4)] for x in range(4)] for z in range(2)]
+        self.map.EnableJournal()
+        self.assertFalse(self.map.Undo())
+        states = [grid()]
+        cable = self.map.GetTileAt(2, 0, 0)
+        self.map.SetTileAt(0, 0, 0, cable)
+        self.map.SetTileAt(0, 1, 0, cable)
+        self.map.Checkpoint('cells')
+        states.append(grid())
+        self.map.Fill(1, None, cable)
+        self.map.ReplaceTiles(None, {cable: self.map.GetTileAt(1, 0, 0)})
+        self.map.Checkpoint()
+        states.append(grid())
+        self.map.Blit(self.map, (0, 0, 3, 3), 1, (1, 1))
+        self.map.zLevels[0].Resize(2, 6)
+        
+        for state in reversed(states):
+            self.assertTrue(self.map.Undo())
+            self.assertListEqual(grid(), state)
+        self.assertFalse(self.map.Undo())
+        for state in states[1:]:
+            self.assertTrue(self.map.Redo())
+            self.assertListEqual(grid(), state)
+        self.assertTrue(self.map.Redo())
+        self.assertEqual(self.map.zLevels[0].tiles.shape, (6, 2))
+        self.assertFalse(self.map.Redo())
+        
+        # A new edit drops what was undone.
+        self.map.Undo()
+        self.map.SetTileAt(3, 3, 0, cable)
+        self.assertFalse(self.map.Redo())
+        
+    def test_Stats(self):
+        stats = self.map.Stats()
+        self.assertEqual(stats['cells'], 32)
+        self.assertEqual(stats['distinct'], 4)
+        self.assertEqual(sum(stats['tiles'].values()), 32)
+        self.assertEqual(stats['atoms']['/turf/space'], 24)
+        self.assertEqual(stats['atoms']['/obj/structure/lattice'], len(self.map.FindByType('/obj/structure/lattice')))
+        self.assertDictEqual(stats['areas'], {'/area': 24, '/area/security/prison': 8})
+        self.assertEqual(self.map.Stats(1)['atoms']['/obj/structure/sign/securearea'], 4)
+        
+        # Only the edited level is counted again.
+        cached = self.map.zLevels[1].GetStats()
+        self.map.SetTileAt(0, 0, 0, self.map.GetTileAt(2, 0, 0))
+        self.assertIs(self.map.zLevels[1].GetStats(), cached)
+        stats = self.map.Stats(0)
+        self.assertEqual(stats['areas']['/area/security/prison'], 5)
+        self.assertEqual(stats['atoms']['/turf/space'], 11)
+        
+    def test_Compact(self):
+        self.map.Materialize()
+        refs = self.map.GetTileRefcounts()
+        self.assertListEqual(refs.tolist(), [10, 8, 8, 6])
+        
+        # Turn every aab tile into aac, and leave an edited copy of the cable tile behind.
+        before = []
+        for x, y, z in self.map.FindByType('/obj/structure/lattice').tolist():
+            self.map.zLevels[z].SetTileID(x, y, 2)
+        tile = self.map.GetTileAt(2, 0, 0)
+        tile.RemoveAtom(self.map.instances[tile.instances[0]])
+        self.map.SetTileAt(2, 0, 0, tile)
+        self.map.SetTileAt(2, 0, 0, self.map.GetTileAt(2, 1, 0))
+        for z in range(len(self.map.zLevels)):
+            before.append([[str(self.map.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)])
+        
+        self.assertEqual(self.map.GetTileRefcounts()[1], 0)
+        irefs = self.map.GetInstanceRefcounts()
+        self.assertEqual(len(irefs), len(self.map.instances))
+        self.assertEqual(irefs[self.map.GetTileAt(0, 0, 0).instances[0]], 16)
+        
+        ntiles, ninstances = len(self.map.tiles), len(self.map.instances)
+        self.assertEqual(self.map.Compact(), (2, 1))
+        self.assertEqual(len(self.map.tiles), ntiles - 2)
+        self.assertEqual(len(self.map.instances), ninstances - 1)
+        self.assertTrue(all(self.map.GetTileRefcounts() > 0))
+        self.assertTrue(all(self.map.GetInstanceRefcounts() > 0))
+        for z in range(len(self.map.zLevels)):
+            self.assertListEqual([[str(self.map.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)], before[z])
+        self.assertEqual(len(self.map.FindByType('/obj/structure/lattice')), 0)
+        self.assertEqual(self.map.Compact(), (0, 0))
+        
+    def test_Compact_lazy(self):
+        from byond.map import Map
+        expected = Map()
+        expected.Load(TEST_MAP, cache=False, eager=True)
+        expected.ReplaceTiles(None, {1: 2})
+        
+        # Only parse one tile type, so the rest are parsed after their instances are renumbered.
+        self.assertFalse(self.map.tiles[0].IsMaterialized())
+        str(self.map.GetTileAt(1, 0, 0))
+        self.map.ReplaceTiles(None, {1: 2})
+        self.assertEqual(self.map.Compact(), (1, 1))
+        for z in range(len(self.map.zLevels)):
+            self.assertListEqual([[str(self.map.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)],
+                                 [[str(expected.GetTileAt(x, y, z)) for y in range(4)] for x in range(4)])
+        
+    def test_layer_dtype(self):
+        self.assertEqual(self.map.zLevels[0].tiles.dtype, numpy.uint8)
+        layer = self.map.CreateZLevel(3, 5)
+        self.assertEqual(layer.tiles.shape, (5, 3))
+        self.assertEqual(layer.tiles.dtype, numpy.uint8)
+        self.assertTrue((layer.tiles == self.map.basetile.ID).all())
+        
+        # Widens once the tile table outgrows uint8.
+        cable = self.map.GetInstance(self.map.GetTileAt(2, 0, 0).instances[0])
+        tile = self.map.GetTileAt(0, 0, 0)
+        for i in range(300):
+            cable.setProperty('d2', i)
+            tile.AppendAtom(cable)
+        self.map.SetTileAt(1, 2, 2, tile)
+        self.assertGreater(len(self.map.tiles), 256)
+        self.assertEqual(layer.tiles.dtype, numpy.uint16)
+        self.assertEqual(str(self.map.GetTileAt(1, 2, 2)), str(tile))
+        self.assertEqual(self.map.GetTileAt(0, 0, 2).ID, self.map.basetile.ID)
+        self.assertEqual(self.map.zLevels[0].tiles.dtype, numpy.uint8)
+        
+        layer.Resize(2, 6)
+        self.assertEqual(layer.tiles.shape, (6, 2))
+        self.assertEqual(layer.tiles[1, 1], self.map.basetile.ID)
+        self.assertEqual(layer.tiles[5, 0], self.map.basetile.ID)
+        
+    def test_sparse_layer(self):
+        from byond.map import ChunkedTiles
+        layer = self.map.CreateZLevel(100, 70, sparse=True)
+        self.assertIsInstance(layer.tiles, ChunkedTiles)
+        self.assertEqual(layer.tiles.nbytes, 0)
+        cable = self.map.GetTileAt(2, 0, 0)
+        self.map.SetTileAt(65, 99, 2, cable)
+        self.map.SetTileAt(3, 4, 2, cable)
+        self.assertEqual(len(layer.tiles.chunks), 2)
+        self.assertEqual(str(self.map.GetTileAt(65, 99, 2)), str(cable))
+        
+        dense = numpy.asarray(layer.tiles)
+        self.assertEqual(dense.shape, (70, 100))
+        self.assertEqual(int((dense == cable.ID).sum()), 2)
+        self.assertListEqual(layer.tiles[60:70, 90:].tolist(), dense[60:70, 90:].tolist())
+        self.assertListEqual(layer.tiles[3].tolist(), dense[3].tolist())
+        self.assertListEqual(layer.tiles[:, 4].tolist(), dense[:, 4].tolist())
+        self.assertEqual(ChunkedTiles.FromArray(dense).chunks.keys(), layer.tiles.chunks.keys())
+        
+        self.assertEqual(self.map.CountArea('/area/security/prison', 2), 2)
+        self.assertListEqual(sorted(map(tuple, self.map.FindByType('/obj/structure/cable', z=2).tolist())), [(3, 4, 2), (65, 99, 2)])
+        self.map.Compact()
+        self.assertEqual(self.map.GetTileAt(3, 4, 2).ID, self.map.GetTileAt(2, 0, 0).ID)
+        self.assertTrue(layer.IsSparse())
+        
+        text = self.map.Dumps()
+        from byond.map import Map
+        loaded = Map()
+        loaded.Loads(text, sparse=True)
+        self.assertFalse(loaded.zLevels[0].IsSparse())
+        self.assertTrue(loaded.zLevels[2].IsSparse())
+        self.assertListEqual(loaded.zLevels[2].tiles.tolist(), layer.tiles.tolist())
+        self.assertEqual(loaded.Dumps(), text)
+        
+    def test_ResetTilestore(self):
+        # Loading starts from empty ID tables, so an empty tile is a new tile type rather than the old basetile.
+        self.map.SetTileAt(0, 0, 0, self.map.CreateTile())
+        self.assertNotEqual(self.map.zLevels[0].tiles[0, 0], 0)
+        self.assertEqual(str(self.map.GetTileAt(0, 0, 0)), '')
+        self.assertEqual(str(self.map.tiles[0]), '/turf/space{},/area{}')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,6 +26,85 @@ class MapParserTest(unittest.TestCase):
         out = self.dmm.SplitProperties(testStr)
         self.assertListEqual(out, expectedOutput)
     
+    def test_TokenizeTileChunk_quoting(self):
+        from byond.map.format.dmm import TokenizeTileChunk
+        testStr = '/obj/item/weapon/paper{info = "a; b, {c}"; name = "\\"note\\""},/turf/space,/area'
+        expectedOutput = [
+            ('/obj/item/weapon/paper{info = "a; b, {c}"; name = "\\"note\\""}', '/obj/item/weapon/paper', [('info', '"a; b, {c}"'), ('name', '"\\"note\\""')]),
+            ('/turf/space', '/turf/space', []),
+            ('/area', '/area', [])
+        ]
+
+        out = TokenizeTileChunk(testStr)
+        self.assertListEqual(out, expectedOutput)
+
+        self.assertRaises(ValueError, TokenizeTileChunk, '/obj/item/weapon/paper{info = "unterminated}')
+
+    def test_DecodeZLevel_operation(self):
+        from byond.map.format.dmm import DecodeZLevel
+        rows = ['aaaaabaac', 'aacaabaaaaaa']
+        key2id = {'aaa':0, 'aab':1, 'aac':2}
+
+        self.assertRaises(ValueError, DecodeZLevel, rows, 3, key2id)
+
+        rows[1] = 'aacaabaaa'
+        out = DecodeZLevel(rows, 3, key2id)
+        self.assertEqual(out.shape, (3, 2))
+        self.assertListEqual(out[:, 0].tolist(), [0, 1, 2])
+        self.assertListEqual(out[:, 1].tolist(), [2, 1, 0])
+
+        self.assertRaises(KeyError, DecodeZLevel, ['aad'], 3, key2id)
+
+    def test_DMMReader_streaming(self):
+        import os
+        from byond.map.format.dmm import DMMReader
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.dmm'), 'r') as f:
+            reader = DMMReader(f)
+            entries = list(reader.Entries())
+            self.assertListEqual([key for key, _ in entries], ['aaa', 'aab', 'aac', 'aad'])
+            self.assertListEqual(entries[1][1].Paths(), ['/obj/structure/lattice', '/turf/space', '/area'])
+            
+            rows = list(reader.Rows())
+            self.assertEqual(len(rows), 8)
+            self.assertEqual(rows[0], (0, 0, ['aaa', 'aab', 'aac', 'aad']))
+            self.assertEqual(rows[-1], (1, 3, ['aac', 'aac', 'aac', 'aac']))
+
+    def test_parallel_zlevels(self):
+        import os
+        from byond.map import Map
+        from byond.map.format.dmm import LocateZLevels
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.dmm')
+        self.assertListEqual([z for z, _, _ in LocateZLevels(filename)], [1, 2])
+        
+        serial = Map()
+        serial.Load(filename, cache=False)
+        parallel = Map()
+        parallel.Load(filename, cache=False, workers=2)
+        self.assertEqual(len(parallel.zLevels), 2)
+        for a, b in zip(serial.zLevels, parallel.zLevels):
+            self.assertListEqual(a.tiles.tolist(), b.tiles.tolist())
+
+    def test_lazy_tiles(self):
+        import os
+        from byond.map import Map
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'test.dmm')
+
+        lazy = Map()
+        lazy.Load(filename, cache=False)
+        self.assertFalse(any(tile.IsMaterialized() for tile in lazy.tiles))
+        self.assertEqual(len(lazy.instances), 0)
+
+        tile = lazy.GetTileAt(0, 0, 0)
+        self.assertListEqual([atom.path for atom in tile.GetAtoms()], ['/turf/space', '/area'])
+        self.assertTrue(lazy.tiles[tile.ID].IsMaterialized())
+
+        eager = Map()
+        eager.Load(filename, cache=False, eager=True)
+        self.assertTrue(all(tile.IsMaterialized() for tile in eager.tiles))
+        lazy.Materialize()
+        for a, b in zip(lazy.tiles, eager.tiles):
+            self.assertEqual(str(a), str(b))
+
     def test_basic_consumeTile_operation(self):
         from byond.map import Map, Tile
         '''
@@ -1,6 +1,8 @@
 import unittest
 
 from Atom import *
+from MapCache import *
+from MapEditing import *
 from MapParser import *
 from MapRendering import *
 from ObjectTree import *